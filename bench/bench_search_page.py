@@ -0,0 +1,74 @@
+"""
+Microbenchmark: cached search page read + audio lookup.
+
+Compares the old path (deepcopy of a list of dicts on every read and write,
+linear scan by id) with immutable SearchPage records (no copying, O(1) index).
+
+Usage: python bench/bench_search_page.py [--number N]
+"""
+import argparse
+import os
+import sys
+import timeit
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from records import AudioRecord, SearchPage  # noqa: E402
+
+
+PAGE_SIZE = 50
+
+
+def make_items():
+    return [
+        {
+            'id': '{:08x}'.format(i * 2654435761 & 0xFFFFFFFF),
+            'artist': 'Артист {}'.format(i),
+            'title': 'Some long song title number {}'.format(i),
+            'duration': 180 + i,
+            'mp3': 'https://cs1-23v4.vkuseraudio.net/p1/{:032x}.mp3?extra=abcdef'.format(i)
+        }
+        for i in range(PAGE_SIZE)
+    ]
+
+
+def old_path(store, key, audio_id):
+    page = deepcopy(store[key])
+    for item in page:
+        if item['id'] == audio_id:
+            return deepcopy(item)
+    return None
+
+
+def new_path(store, key, audio_id):
+    return store[key].get(audio_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    items = make_items()
+    old_store = {'key': deepcopy(items)}
+    new_store = {'key': SearchPage(AudioRecord.from_dict(item) for item in items)}
+    # worst case for the scan: the last item of the page
+    audio_id = items[-1]['id']
+
+    assert old_path(old_store, 'key', audio_id)['id'] == new_path(new_store, 'key', audio_id).id
+
+    results = {}
+    for name, func, store in (('deepcopy+scan', old_path, old_store),
+                              ('records+index', new_path, new_store)):
+        elapsed = min(timeit.repeat(
+            lambda: func(store, 'key', audio_id), number=args.number, repeat=3
+        ))
+        results[name] = elapsed / args.number * 1e6
+        print('{:<16} {:10.3f} us/op'.format(name, results[name]))
+
+    print('speedup: {:.0f}x'.format(results['deepcopy+scan'] / results['records+index']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Microbenchmark: cleaning and ranking a search page, sanitizing file names.
+
+Compares the old path (raw patterns passed to re on every call, bad chars
+alternation rebuilt for every sanitize) with precompiled, memoized text module.
+Metadata mixes Cyrillic and Latin names; strings recur like in real search results.
+
+Usage: python bench/bench_text.py [--pages N] [--number N]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+os.environ.setdefault('ACCESS_TOKEN', '')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from unidecode import unidecode  # noqa: E402
+
+import text  # noqa: E402
+from records import AudioRecord  # noqa: E402
+from settings import SEARCH_SETTINGS  # noqa: E402
+
+
+PAGE_SIZE = 50
+
+ARTISTS = [
+    'Кино', 'Сплин', 'Земфира', 'Мумий Тролль', 'Би-2', 'Ляпис Трубецкой', 'Баста', 'Макс Корж',
+    'Океан Ельзи', 'Noize MC', 'Monetochka', 'Coldplay', 'Daft Punk', 'Ólafur Arnalds', 'The xx', 'Sia',
+    'Imagine Dragons', 'Lana Del Rey', 'Ludovico Einaudi', 'Hans Zimmer'
+]
+TITLES = [
+    'Группа крови', 'Выхожу один я на дорогу', 'Хочешь?', 'Невеста', 'Моя любовь',
+    'Get Lucky', 'Yellow', 'Intro', 'Summertime Sadness', 'Time', 'Nuvole Bianche', 'Chandelier'
+]
+SUFFIXES = [
+    '', '', '', '', ' (remix)', ' [bass boosted]', ' (cover)', ' (acoustic)', ' vk.com/club123',
+    ' | vkontakte.ru', ' (DJ Smash edit)', ' рингтон', ' — live'
+]
+
+
+def make_pages(count: int, seed: int = 1):
+    rnd = random.Random(seed)
+
+    def pick(items):
+        # popular strings come up much more often
+        return items[min(int(rnd.paretovariate(1.2)) - 1, len(items) - 1)]
+
+    return [
+        [
+            AudioRecord(
+                id='{:08x}'.format(rnd.getrandbits(32)),
+                artist=pick(ARTISTS) + rnd.choice(SUFFIXES[:4] + SUFFIXES[8:10]),
+                title=pick(TITLES) + rnd.choice(SUFFIXES),
+                duration=rnd.randint(60, 600),
+                mp3=''
+            )
+            for _ in range(PAGE_SIZE)
+        ]
+        for _ in range(count)
+    ]
+
+
+def old_is_bad_match(strings):
+    if len(''.join(strings)) > 100:
+        return True
+    for string in strings:
+        if re.search(SEARCH_SETTINGS['sort_regex'], string):
+            return True
+    return False
+
+
+def old_clean_page(audios, query):
+    sortable = not old_is_bad_match([query])
+    head, tail = [], []
+    for audio in audios:
+        artist = re.sub(SEARCH_SETTINGS['bad_words_regex'], '', audio.artist)
+        title = re.sub(SEARCH_SETTINGS['bad_words_regex'], '', audio.title)
+        if sortable and old_is_bad_match([artist, title]):
+            tail.append((audio, artist, title))
+        else:
+            head.append((audio, artist, title))
+    return head + tail
+
+
+def old_sanitize(string):
+    bad_chars = ['~', '`', '!', '@', '#', '$', '%', '^', '&', '*', '(', ')', '_', '=', '+',
+                 '[', '{', ']', '}', '\\', '|', ';', ':', '"', "'", '—', '–', ',', '<', '>', '/', '?',
+                 '‘', '’', '“', '”']
+    string = re.sub(r'|'.join(map(re.escape, bad_chars)), '', string)
+    string = unidecode(string)
+    string = string.strip()
+    string = re.sub(r'\s+', ' ', string)
+    return string
+
+
+def new_sanitize(string):
+    return text.sanitize(string, to_lower=False)
+
+
+def run_pages(clean, pages):
+    for page in pages:
+        clean(page, 'кино')
+
+
+def run_names(sanitize, pages):
+    for page in pages:
+        for audio in page:
+            sanitize('{} - {}'.format(audio.artist, audio.title))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args()
+
+    pages = make_pages(args.pages)
+    for page in pages:
+        assert old_clean_page(page, 'кино') == text.clean_page(page, 'кино')
+        for audio in page:
+            name = '{} - {}'.format(audio.artist, audio.title)
+            assert old_sanitize(name) == new_sanitize(name)
+
+    items = args.pages * PAGE_SIZE
+    for title, runner, old, new in (('clean page', run_pages, old_clean_page, text.clean_page),
+                                    ('sanitize', run_names, old_sanitize, new_sanitize)):
+        results = {}
+        for name, func in (('old', old), ('new', new)):
+            elapsed = min(timeit.repeat(lambda: runner(func, pages), number=args.number, repeat=3))
+            results[name] = elapsed / args.number / items * 1e6
+            print('{:<12} {:<4} {:10.3f} us/item'.format(title, name, results[name]))
+        print('{:<12} speedup: {:.1f}x'.format(title, results['old'] / results['new']))
+
+
+if __name__ == '__main__':
+    main()
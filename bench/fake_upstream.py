@@ -0,0 +1,135 @@
+"""
+Local stand-in for VK api (audio.search, audio.getById) and mp3 CDN with configurable latency and bandwidth.
+
+Usage: python bench/fake_upstream.py [--upstream-port 9300] [--vk-latency 0.1] [--cdn-latency 0.05]
+                                     [--bandwidth 10485760] [--file-size 1048576] [--url-ttl 86400]
+"""
+import argparse
+import asyncio
+import time
+import zlib
+
+from tornado import web
+from tornado.ioloop import IOLoop
+
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz frame header
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0x64])
+FRAME_SIZE = 417
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_mp3(size: int) -> bytes:
+    frame = FRAME_HEADER + b'\x00' * (FRAME_SIZE - len(FRAME_HEADER))
+    return (frame * (size // FRAME_SIZE + 1))[:size // FRAME_SIZE * FRAME_SIZE]
+
+
+def audio_id(query: str, offset: int, number: int) -> int:
+    return zlib.crc32('{}:{}'.format(query, offset + number).encode())
+
+
+def mp3_url(cdn_url: str, id_, ttl: int) -> str:
+    return '{}{}.mp3?extra=token&expires={}'.format(cdn_url, id_, int(time.time()) + ttl)
+
+
+class SearchHandler(web.RequestHandler):
+    async def get(self):
+        options = self.settings['options']
+        self.settings['counters']['search'] += 1
+        await asyncio.sleep(options.vk_latency)
+        query = self.get_argument('q')
+        offset = int(self.get_argument('offset', 0))
+        count = int(self.get_argument('count', 50))
+        cdn_url = '{}://{}/cdn/'.format(self.request.protocol, self.request.host)
+        items = [
+            {
+                'id': audio_id(query, offset, number),
+                'owner_id': 1,
+                'artist': 'Исполнитель {}'.format(number % 7) if number % 2 else 'Artist {}'.format(number % 5),
+                'title': '{} song {} (remix)'.format(query, offset + number) if number % 5 == 4 else
+                         '{} song {}'.format(query, offset + number),
+                'duration': 180 + number,
+                'url': mp3_url(cdn_url, audio_id(query, offset, number), options.url_ttl)
+            }
+            for number in range(count)
+        ]
+        self.write({'response': {'count': 1000, 'items': items}})
+
+
+class GetByIdHandler(web.RequestHandler):
+    async def get(self):
+        options = self.settings['options']
+        self.settings['counters']['get_by_id'] += 1
+        await asyncio.sleep(options.vk_latency)
+        cdn_url = '{}://{}/cdn/'.format(self.request.protocol, self.request.host)
+        items = []
+        for vk_id in self.get_argument('audios').split(','):
+            owner_id, id_ = vk_id.split('_')[:2]
+            items.append({
+                'id': int(id_),
+                'owner_id': int(owner_id),
+                'artist': 'Artist',
+                'title': 'Song {}'.format(id_),
+                'duration': 180,
+                'url': mp3_url(cdn_url, id_, options.url_ttl)
+            })
+        self.write({'response': items})
+
+
+class CdnHandler(web.RequestHandler):
+    async def get(self, name):
+        options = self.settings['options']
+        self.settings['counters']['cdn'] += 1
+        body = self.settings['mp3']
+        await asyncio.sleep(options.cdn_latency)
+        self.set_header('Content-Type', 'audio/mpeg')
+        self.set_header('Content-Length', len(body))
+        for start in range(0, len(body), CHUNK_SIZE):
+            self.write(body[start:start + CHUNK_SIZE])
+            await self.flush()
+            if options.bandwidth:
+                await asyncio.sleep(CHUNK_SIZE / options.bandwidth)
+
+
+class CountersHandler(web.RequestHandler):
+    def get(self):
+        self.write(self.settings['counters'])
+
+
+def make_app(options) -> web.Application:
+    return web.Application(
+        [
+            (r'/method/audio.search', SearchHandler),
+            (r'/method/audio.getById', GetByIdHandler),
+            (r'/cdn/([^/]+)', CdnHandler),
+            (r'/counters', CountersHandler)
+        ],
+        options=options,
+        counters={'search': 0, 'get_by_id': 0, 'cdn': 0},
+        mp3=make_mp3(options.file_size)
+    )
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--upstream-port', type=int, default=9300)
+    parser.add_argument('--vk-latency', type=float, default=0.1, help='seconds per search request')
+    parser.add_argument('--cdn-latency', type=float, default=0.05, help='seconds before first byte')
+    parser.add_argument('--bandwidth', type=int, default=10 * 1024 ** 2, help='bytes per second, 0 for no limit')
+    parser.add_argument('--url-ttl', type=int, default=24 * 60 * 60, help='seconds until mp3 urls expire')
+    parser.add_argument('--file-size', type=int, default=1024 ** 2, help='mp3 size in bytes')
+
+
+def serve(options):
+    make_app(options).listen(options.upstream_port, '127.0.0.1')
+    IOLoop.current().start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    serve(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""
+Load test: runs the app (src/main.py) against local stand-in of VK api and mp3 CDN (bench/fake_upstream.py)
+and measures throughput, latency and memory of the app in repeatable scenarios:
+
+    search_cold      unique queries, every one goes to VK
+    search_hot       the same query, served from cache
+    download_cold    unique tracks, every one is downloaded from CDN
+    download_warm    tracks downloaded before, served from disk
+    stream_range     random byte ranges of downloaded tracks
+    burst_duplicate  many clients request the same track at once, CDN must be hit once
+
+Results are printed as a table and can be saved as JSON (--json) and compared with a previous run (--compare).
+
+Usage: python bench/loadtest.py [--requests 200] [--concurrency 10] [--workers 1] [--scenarios search_hot,...]
+                                [--json results.json] [--compare old.json] [fake upstream options]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+import fake_upstream
+
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+SCENARIOS = ('search_cold', 'search_hot', 'download_cold', 'download_warm', 'stream_range', 'burst_duplicate')
+
+RANGE_SIZE = 64 * 1024
+
+# method, url, headers
+Request = Tuple[str, str, Dict[str, str]]
+
+
+def serve_app(options, root: str):
+    """ Runs the app in a child process, with its data in `root` and VK api of fake upstream """
+    os.environ['ACCESS_TOKEN'] = 'bench'
+    os.environ['VK_API_URL'] = 'http://127.0.0.1:{}/'.format(options.upstream_port)
+    os.environ['LOG_LEVEL'] = options.log_level
+    os.environ['WORKERS'] = str(options.workers)
+    sys.path.insert(0, SRC)
+
+    import settings
+    for values in (settings.PATHS, settings.CACHE_SETTINGS):
+        for key, value in values.items():
+            if isinstance(value, str) and value.startswith('/cache'):
+                values[key] = root + value[len('/cache'):]
+    settings.SERVER_SETTINGS['port'] = options.port
+    # fake VK has no rate limit, the app should not be limited by it either
+    settings.TOKEN_SETTINGS.update(rate=options.vk_rate, burst=max(1, int(options.vk_rate)))
+
+    import main
+    main.main()
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def read_memory(pids: List[int]) -> Dict[str, float]:
+    """ Current and peak resident memory of app processes in MB, from /proc """
+    memory = {'rss_mb': 0.0, 'peak_rss_mb': 0.0}
+    for pid in pids:
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        memory['rss_mb'] += int(line.split()[1]) / 1024
+                    elif line.startswith('VmHWM:'):
+                        memory['peak_rss_mb'] += int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return {key: round(value, 1) for key, value in memory.items()}
+
+
+def app_pids(pid: int) -> List[int]:
+    """ App process and its forked workers """
+    pids = [pid]
+    try:
+        with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+            pids.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+class LoadTest:
+    def __init__(self, options, app_pid: int):
+        self.options = options
+        self.app_pid = app_pid
+        self.app_url = 'http://127.0.0.1:{}'.format(options.port)
+        self.upstream_url = 'http://127.0.0.1:{}'.format(options.upstream_port)
+        self.random = random.Random(options.seed)
+        self.session = None  # type: aiohttp.ClientSession
+        self._queries = 0
+        self._tracks = []  # type: List[Dict]
+
+    async def run(self, scenarios: List[str]) -> Dict:
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=self.options.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.session:
+            await self._wait_ready()
+            results = {}
+            for name in scenarios:
+                results[name] = await getattr(self, name)()
+                print('{:<16} done'.format(name), file=sys.stderr)
+            return results
+
+    async def search_cold(self) -> Dict:
+        requests = [self._search_request(self._new_query()) for _ in range(self.options.requests)]
+        return await self._measure(requests, self.options.concurrency)
+
+    async def search_hot(self) -> Dict:
+        query = self._new_query()
+        await self._search(query)
+        requests = [self._search_request(query) for _ in range(self.options.requests)]
+        return await self._measure(requests, self.options.concurrency)
+
+    async def download_cold(self) -> Dict:
+        tracks = await self._new_tracks(self.options.requests)
+        self._tracks.extend(tracks)
+        requests = [('GET', track['download'], {}) for track in tracks]
+        return await self._measure(requests, self.options.concurrency, ttfb=True)
+
+    async def download_warm(self) -> Dict:
+        tracks = await self._warm_tracks()
+        requests = [('GET', self.random.choice(tracks)['download'], {}) for _ in range(self.options.requests)]
+        return await self._measure(requests, self.options.concurrency, ttfb=True)
+
+    async def stream_range(self) -> Dict:
+        tracks = await self._warm_tracks()
+        size = self.options.file_size // fake_upstream.FRAME_SIZE * fake_upstream.FRAME_SIZE
+        requests = []
+        for _ in range(self.options.requests):
+            start = self.random.randrange(0, max(1, size - RANGE_SIZE))
+            headers = {'Range': 'bytes={}-{}'.format(start, min(size, start + RANGE_SIZE) - 1)}
+            requests.append(('GET', self.random.choice(tracks)['stream'], headers))
+        return await self._measure(requests, self.options.concurrency, ttfb=True)
+
+    async def burst_duplicate(self) -> Dict:
+        track, = await self._new_tracks(1)
+        requests = [('GET', track['stream'], {}) for _ in range(self.options.burst)]
+        # all at once
+        return await self._measure(requests, len(requests), ttfb=True)
+
+    async def _measure(self, requests: List[Request], concurrency: int, ttfb: bool = False) -> Dict:
+        latencies = []
+        first_bytes = []
+        statuses = {}  # type: Dict[str, int]
+        received = 0
+        pending = iter(requests)
+
+        async def worker():
+            nonlocal received
+            for method, url, headers in pending:
+                started = time.perf_counter()
+                try:
+                    async with self.session.request(method, url, headers=headers) as response:
+                        first_byte = None
+                        async for chunk in response.content.iter_any():
+                            if first_byte is None:
+                                first_byte = time.perf_counter() - started
+                            received += len(chunk)
+                        status = str(response.status)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status = type(e).__name__
+                    first_byte = None
+                latencies.append(time.perf_counter() - started)
+                if first_byte is not None:
+                    first_bytes.append(first_byte)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        counters = await self._upstream_counters()
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(min(concurrency, len(requests)))])
+        duration = time.perf_counter() - started
+        counters_after = await self._upstream_counters()
+
+        result = {
+            'requests': len(requests),
+            'concurrency': min(concurrency, len(requests)),
+            'errors': sum(count for status, count in statuses.items() if not status.startswith(('2', '3'))),
+            'statuses': statuses,
+            'duration': round(duration, 3),
+            'rps': round(len(requests) / duration, 1),
+            'mb_per_s': round(received / 1024 ** 2 / duration, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(max(latencies) * 1000, 2),
+            'upstream': {key: counters_after[key] - counters[key] for key in counters}
+        }
+        if ttfb:
+            result['ttfb_p50_ms'] = round(percentile(first_bytes, 50) * 1000, 2)
+            result['ttfb_p99_ms'] = round(percentile(first_bytes, 99) * 1000, 2)
+        result.update(read_memory(app_pids(self.app_pid)))
+        return result
+
+    async def _wait_ready(self):
+        deadline = time.time() + 30
+        while True:
+            try:
+                async with self.session.get(self.app_url + '/stats/') as response:
+                    async with self.session.get(self.upstream_url + '/counters') as upstream:
+                        if response.status == 200 and upstream.status == 200:
+                            return
+            except aiohttp.ClientError:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError('App did not start in 30 seconds')
+            await asyncio.sleep(0.2)
+
+    async def _upstream_counters(self) -> Dict[str, int]:
+        async with self.session.get(self.upstream_url + '/counters') as response:
+            return await response.json()
+
+    def _new_query(self) -> str:
+        self._queries += 1
+        return 'bench {} {}'.format(self.options.seed, self._queries)
+
+    def _search_request(self, query: str, page: int = 0) -> Request:
+        url = '{}/search/?q={}&page={}'.format(self.app_url, query.replace(' ', '+'), page)
+        return 'GET', url, {}
+
+    async def _search(self, query: str) -> List[Dict]:
+        _, url, _ = self._search_request(query)
+        async with self.session.get(url) as response:
+            return (await response.json())['data']
+
+    async def _new_tracks(self, number: int) -> List[Dict]:
+        tracks = []
+        while len(tracks) < number:
+            tracks.extend(await self._search(self._new_query()))
+        return tracks[:number]
+
+    async def _warm_tracks(self) -> List[Dict]:
+        """ Tracks which are on disk already: from download_cold or downloaded here """
+        if not self._tracks:
+            tracks = await self._new_tracks(min(self.options.requests, self.options.concurrency))
+            for track in tracks:
+                async with self.session.get(track['download']) as response:
+                    await response.read()
+            self._tracks.extend(tracks)
+        return self._tracks
+
+
+def print_results(results: Dict, previous: Optional[Dict] = None):
+    columns = ('requests', 'errors', 'rps', 'mb_per_s', 'p50_ms', 'p99_ms', 'ttfb_p50_ms', 'rss_mb', 'peak_rss_mb')
+    print('{:<16}'.format('scenario') + ''.join('{:>13}'.format(column) for column in columns))
+    for name, result in results.items():
+        cells = []
+        for column in columns:
+            value = result.get(column, '')
+            old = (previous or {}).get(name, {}).get(column)
+            if old and isinstance(value, (int, float)) and column not in ('requests', 'errors'):
+                value = '{} {:+.0f}%'.format(value, (value - old) / old * 100)
+            cells.append('{:>13}'.format(value))
+        print('{:<16}'.format(name) + ''.join(cells))
+        print('{:<16}upstream: {}, statuses: {}'.format('', result['upstream'], result['statuses']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9400, help='port of the app')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the app')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests at the same time')
+    parser.add_argument('--burst', type=int, default=50, help='requests of burst_duplicate scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds per request')
+    parser.add_argument('--vk-rate', type=float, default=1000, help='VK requests per second allowed to the app')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the app')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='show changes against results saved before')
+    fake_upstream.add_arguments(parser)
+    options = parser.parse_args()
+
+    scenarios = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('Unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)['results']
+
+    root = tempfile.mkdtemp(prefix='thatmusic-bench-')
+    # both are started before the event loop of load generator is created
+    upstream = Process(target=fake_upstream.serve, args=(options,), daemon=True)
+    app = Process(target=serve_app, args=(options, root), daemon=True)
+    upstream.start()
+    app.start()
+    try:
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(LoadTest(options, app.pid).run(scenarios))
+    finally:
+        # forked workers are not stopped together with their parent
+        for pid in reversed(app_pids(app.pid)):
+            os.kill(pid, signal.SIGTERM)
+        app.join(10)
+        upstream.terminate()
+        upstream.join()
+        shutil.rmtree(root, ignore_errors=True)
+
+    print_results(results, previous)
+    if options.json:
+        report = {
+            'options': {key: value for key, value in vars(options).items() if key not in ('json', 'compare')},
+            'results': results
+        }
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,290 @@
-from copy import deepcopy
-from typing import Optional, List, Dict
+import os
+import pickle
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Optional, Dict, Any, List, Tuple
 
-from beaker.cache import CacheManager
+from beaker.cache import CacheManager, Cache
 from beaker.util import parse_cache_config_options
 
+from metrics import PHASE_DURATION
+from records import AudioRecord, SearchPage
 from settings import HASH, CACHE_SETTINGS
+from snapshot import SnapshotRecord
 from utils import md5, uni_hash, setup_logger, BasicHandler
 
 
+class CacheRegion(ABC):
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with PHASE_DURATION.time('cache_lookup'):
+            value = self._load(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def peek(self, key: str) -> Optional[Any]:
+        """ Same as get, but not counted in stats """
+        return self._load(key)
+
+    def put(self, key: str, value: Any):
+        self.puts += 1
+        self._store(key, value)
+
+    @abstractmethod
+    def remove(self, key: str):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'puts': self.puts
+        }
+
+    @abstractmethod
+    def _load(self, key: str) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    def _store(self, key: str, value: Any):
+        pass
+
+
+class BeakerRegion(CacheRegion):
+    def __init__(self, name: str, cache: Cache):
+        super().__init__(name)
+        self._cache = cache
+
+    def remove(self, key: str):
+        try:
+            self._cache.remove_value(key)
+        except KeyError:
+            pass
+
+    def clear(self):
+        self._cache.clear()
+
+    def _load(self, key: str):
+        try:
+            return self._cache.get(key)
+        except KeyError:
+            return None
+
+    def _store(self, key: str, value: Any):
+        self._cache.put(key, value)
+
+
+class MemoryRegion(CacheRegion):
+    """
+    Region in memory of the process. Unlike Beaker memory cache it can be saved
+    into snapshot and restored from it with remaining expiration time of entries.
+    """
+    CLEANUP_EVERY = 1000  # puts
+
+    def __init__(self, name: str, expire: Optional[int] = None):
+        super().__init__(name)
+        self._expire = expire
+        self._entries = {}  # type: Dict[str, Tuple[Optional[float], Any]]  # key -> expires, value
+
+    def remove(self, key: str):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def snapshot(self) -> List[SnapshotRecord]:
+        now = time.time()
+        return [
+            (key, expires, value) for key, (expires, value) in self._entries.items()
+            if expires is None or expires > now
+        ]
+
+    def restore(self, records: List[SnapshotRecord]):
+        """ Adds entries from snapshot, entries stored since start are newer and kept """
+        for key, expires, value in records:
+            if key not in self._entries:
+                self._entries[key] = (expires, value)
+
+    def stats(self) -> Dict:
+        return dict(super().stats(), entries=len(self._entries))
+
+    def _load(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= time.time():
+            del self._entries[key]
+            return None
+        return value
+
+    def _store(self, key: str, value: Any):
+        now = time.time()
+        self._entries[key] = (None if self._expire is None else now + self._expire, value)
+        if self.puts % self.CLEANUP_EVERY == 0:
+            self._entries = {
+                key: entry for key, entry in self._entries.items() if entry[0] is None or entry[0] > now
+            }
+
+
+class SqliteRegion(CacheRegion):
+    """
+    Region stored in sqlite database, shared by all worker processes.
+    Values are pickled, so they must be picklable.
+    """
+    CLEANUP_EVERY = 1000  # puts
+
+    def __init__(self, name: str, data_dir: str, expire: Optional[int] = None):
+        super().__init__(name)
+        self._expire = expire
+        os.makedirs(data_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(data_dir, '{}.sqlite'.format(name)), timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL'
+            ') WITHOUT ROWID'
+        )
+        self._db.commit()
+
+    def remove(self, key: str):
+        with self._db:
+            self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._db:
+            self._db.execute('DELETE FROM entries')
+
+    def close(self):
+        self._db.close()
+
+    def _load(self, key: str):
+        row = self._db.execute(
+            'SELECT value FROM entries WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())
+        ).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def _store(self, key: str, value: Any):
+        now = time.time()
+        expires = None if self._expire is None else now + self._expire
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)',
+                (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+            )
+            if self.puts % self.CLEANUP_EVERY == 0:
+                self._db.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+
+
+class AppCache:
+    """
+    Cache regions shared by all handlers of the application.
+    Must be opened once on startup and closed on shutdown.
+    """
+    logger = setup_logger('cache')
+
+    def __init__(self, settings: Dict = None):
+        self._settings = CACHE_SETTINGS if settings is None else settings
+        self._manager = None
+        self._regions = {}
+
+    @property
+    def is_open(self):
+        return self._manager is not None
+
+    def open(self):
+        if self.is_open:
+            return
+        options = parse_cache_config_options(self._settings)
+        self._manager = CacheManager(**options)
+        for name, region_options in options['cache_regions'].items():
+            if region_options['type'] == 'sqlite':
+                region = SqliteRegion(name, region_options['data_dir'], region_options['expire'])
+            elif region_options['type'] == 'memory':
+                region = MemoryRegion(name, region_options['expire'])
+            else:
+                region = BeakerRegion(name, self._manager.get_cache_region('default', name))
+            self._regions[name] = region
+        self.logger.info('Cache regions opened: {}'.format(', '.join(self._regions)))
+
+    def close(self):
+        if not self.is_open:
+            return
+        for region in self._regions.values():
+            region.close()
+        self._regions.clear()
+        self._manager = None
+        self.logger.info('Cache regions closed')
+
+    def flush(self, name: Optional[str] = None):
+        regions = self._regions.values() if name is None else [self.region(name)]
+        for region in regions:
+            region.clear()
+
+    def region(self, name: str) -> CacheRegion:
+        if not self.is_open:
+            raise RuntimeError('Cache is not opened')
+        return self._regions[name]
+
+    def stats(self) -> Dict:
+        return {name: region.stats() for name, region in self._regions.items()}
+
+
+def search_cache_key(query: str, page: int) -> str:
+    if not len(query):
+        query = md5('random')
+
+    return uni_hash(HASH['cache'], '{}.{}'.format(query, page))
+
+
 # noinspection PyAbstractClass
 class CachedHandler(BasicHandler):
     logger = setup_logger('cache')
 
     def __init__(self, application, request, **kwargs):
         super().__init__(application, request, **kwargs)
-        cache_manager = CacheManager(
-            **parse_cache_config_options(CACHE_SETTINGS)
-        )
-        self._search_pages_cache = cache_manager.get_cache_region('default', 'search_pages')
-        self._audio_info_cache = cache_manager.get_cache_region('default', 'audio_info')
+        cache = self.settings['cache']
+        self._search_pages_cache = cache.region('search_pages')
+        self._audio_info_cache = cache.region('audio_info')
 
     @staticmethod
     def _get_search_cache_key(query: str, page: int):
-        if not len(query):
-            query = md5('random')
+        return search_cache_key(query, page)
 
-        return uni_hash(HASH['cache'], '{}.{}'.format(query, page))
-
-    def _get_cached_search_result(self, cache_key: str) -> Optional[List[Dict]]:
-        self.logger.debug('Trying to get search result from cache: {}'.format(cache_key))
-        try:
-            return deepcopy(self._search_pages_cache.get(cache_key))
-        except KeyError:
+    def _get_cached_search_result(self, cache_key: str) -> Optional[SearchPage]:
+        self.logger.debug('Trying to get search result from cache: %s', cache_key)
+        result = self._search_pages_cache.get(cache_key)
+        if result is None:
             self.logger.debug('Cache miss')
-            return None
+        return result
 
-    def _cache_search_result(self, cache_key: str, result: List[Dict]):
-        self.logger.debug('Store search result into cache...')
-        self._search_pages_cache.put(cache_key, deepcopy(result))
-
-    def _get_audio_info_cache(self, audio_id: str):
-        self.logger.debug('Getting audio item from cache: {}'.format(audio_id))
-        try:
-            return deepcopy(self._audio_info_cache.get(audio_id))
-        except KeyError:
+    def _get_audio_info_cache(self, audio_id: str) -> Optional[AudioRecord]:
+        self.logger.debug('Getting audio item from cache: %s', audio_id)
+        result = self._audio_info_cache.get(audio_id)
+        if result is None:
             self.logger.debug('Cache miss')
-            return None
+        elif isinstance(result, dict):  # stored by older versions
+            result = AudioRecord.from_dict(result)
+        return result
 
-    def _cache_audio_info(self, item: Dict):
-        self.logger.debug('Store audio item into cache: {}'.format(item['id']))
-        self._audio_info_cache.put(item['id'], deepcopy(item))
+    def _cache_audio_info(self, item: AudioRecord):
+        self.logger.debug('Store audio item into cache: %s', item.id)
+        self._audio_info_cache.put(item.id, item)
@@ -0,0 +1,99 @@
+from typing import Dict, Optional
+
+import aiohttp
+
+from settings import HTTP_SETTINGS
+from utils import setup_logger
+
+
+class HttpClient:
+    """
+    Long-lived aiohttp session with keep-alive connection pool,
+    shared by all handlers of the application.
+    """
+    logger = setup_logger('http')
+
+    def __init__(self, settings: Dict = None):
+        self._settings = HTTP_SETTINGS if settings is None else settings
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+        self._connector = None  # type: Optional[aiohttp.TCPConnector]
+        self._counters = dict.fromkeys(
+            ('requests', 'errors', 'connections_created', 'connections_reused',
+             'dns_cache_hits', 'dns_cache_misses'),
+            0
+        )
+
+    @property
+    def is_open(self):
+        return self._session is not None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if not self.is_open:
+            raise RuntimeError('HTTP client is not opened')
+        return self._session
+
+    async def open(self):
+        if self.is_open:
+            return
+        self._connector = aiohttp.TCPConnector(
+            limit=self._settings['limit'],
+            limit_per_host=self._settings['limit_per_host'],
+            keepalive_timeout=self._settings['keepalive_timeout'],
+            use_dns_cache=True,
+            ttl_dns_cache=self._settings['dns_cache_ttl']
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            timeout=self.timeout(),
+            trace_configs=[self._build_trace_config()]
+        )
+        self.logger.info('HTTP client opened (proxy={})'.format(self._settings['proxy']))
+
+    async def close(self):
+        if not self.is_open:
+            return
+        await self._session.close()
+        self._session = None
+        self._connector = None
+        self.logger.info('HTTP client closed')
+
+    def get(self, url, **kwargs):
+        if self._settings['proxy'] is not None:
+            kwargs.setdefault('proxy', self._settings['proxy'])
+        return self.session.get(url, **kwargs)
+
+    def timeout(self, total: Optional[float] = None) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(
+            total=total,
+            connect=self._settings['connect_timeout'],
+            sock_read=self._settings['read_timeout']
+        )
+
+    def stats(self) -> Dict:
+        result = dict(self._counters)
+        if self.is_open:
+            # aiohttp does not expose pool state publicly
+            result.update({
+                'limit': self._connector.limit,
+                'limit_per_host': self._connector.limit_per_host,
+                'acquired': len(self._connector._acquired),
+                'idle': sum(len(conns) for conns in self._connector._conns.values())
+            })
+        return result
+
+    def _build_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        for event, counter in (('on_request_start', 'requests'),
+                               ('on_request_exception', 'errors'),
+                               ('on_connection_create_end', 'connections_created'),
+                               ('on_connection_reuseconn', 'connections_reused'),
+                               ('on_dns_cache_hit', 'dns_cache_hits'),
+                               ('on_dns_cache_miss', 'dns_cache_misses')):
+            getattr(trace_config, event).append(self._make_counter(counter))
+        return trace_config
+
+    def _make_counter(self, name: str):
+        async def increment(session, context, params):
+            self._counters[name] += 1
+        return increment
@@ -0,0 +1,320 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional, Callable, List, Tuple
+
+from settings import DISK_CACHE_SETTINGS, DOWNLOAD_SETTINGS
+from snapshot import SnapshotRecord
+from storage import LocalStorage, IndexEntry, AccessEntry
+from utils import setup_logger
+
+
+class DiskEntry:
+    __slots__ = ('size', 'created', 'last_access', 'hits', 'audio_id')
+
+    def __init__(self, size: int, created: float, last_access: float, audio_id: Optional[str] = None):
+        self.size = size
+        self.created = created
+        self.last_access = last_access
+        self.hits = 0
+        self.audio_id = audio_id
+
+
+class DiskCache:
+    """
+    Keeps audio files storage within byte and entry budget.
+    Files are evicted in background by LRU or LFU policy and by age;
+    pinned files (being served or downloaded) are never evicted.
+    All files are identified by storage key.
+    """
+    logger = setup_logger('disk_cache')
+
+    EVICTED_PREFIX = '.evicted-'
+    INDEX_OVERLAP = 60  # in seconds, index rows of other processes may be written a bit later than their files
+
+    def __init__(self, storage: LocalStorage, settings: Dict = None,
+                 on_evict: Optional[Callable[[str], None]] = None, evict: bool = True, shared: bool = False):
+        """
+        With several worker processes only one of them should evict files (evict=True, shared=True):
+        it reloads the index before every eviction to know about files downloaded by other processes.
+        Others (evict=False) keep no entries, they only save accesses of files into the index for it.
+        """
+        self._storage = storage
+        self._settings = DISK_CACHE_SETTINGS if settings is None else settings
+        self._on_evict = on_evict
+        self._evict = evict
+        self._shared = shared
+        self._entries = OrderedDict()  # type: OrderedDict[str, DiskEntry]  # least recent first
+        self._pins = {}  # type: Dict[str, int]
+        self._accesses = {}  # type: Dict[str, Tuple[float, int]]  # not saved yet, when not evicting
+        self._size = 0
+        self._ready = False
+        self._index_loaded = 0.0
+        self._restored = []  # type: List[SnapshotRecord]  # applied when index is loaded
+        self._reorder = False
+        self._task = None
+        self._wakeup = None  # type: Optional[asyncio.Event]
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+    async def open(self):
+        self._wakeup = asyncio.Event()
+        if self._evict:
+            self._task = asyncio.ensure_future(self._run())
+        elif self._shared:
+            self._task = asyncio.ensure_future(self._run_saving())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+        self._save_accesses()
+
+    def touch(self, key: str, audio_id: Optional[str] = None):
+        if not self._evict:
+            _, hits = self._accesses.get(key, (0, 0))
+            self._accesses[key] = (time.time(), hits + 1)
+            return
+        entry = self._entries.get(key)
+        if entry is None:
+            # index is not loaded yet
+            return
+        entry.last_access = time.time()
+        entry.hits += 1
+        if entry.audio_id is None and audio_id is not None:
+            # files moved from old layout are indexed without audio id
+            entry.audio_id = audio_id
+            self._storage.index_put(key, audio_id, entry.size, entry.created)
+        self._entries.move_to_end(key)
+
+    def add(self, key: str, size: int, audio_id: Optional[str] = None):
+        if not self._evict:
+            # evicting process gets it from the index
+            return
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._size -= old_entry.size
+        now = time.time()
+        self._entries[key] = DiskEntry(size, now, now, audio_id)
+        self._size += size
+        if self._evict and self._is_over_budget():
+            self._wakeup.set()
+
+    @contextmanager
+    def pinned(self, key: str):
+        self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            self._pins[key] -= 1
+            if not self._pins[key]:
+                del self._pins[key]
+
+    def is_pinned(self, key: str) -> bool:
+        return key in self._pins
+
+    async def evict(self):
+        """ Evicts files until cache fits into budget, returns number of evicted files """
+        if not self._ready:
+            return 0
+
+        if self._reorder:
+            # least recent first again after access times are restored
+            self._entries = OrderedDict(sorted(self._entries.items(), key=lambda item: item[1].last_access))
+            self._reorder = False
+        victims = self._select_victims()
+        # rename is cheap and atomic, so a file is either evicted before anyone pins it or not at all
+        removed = []
+        removed_frames = []
+        for key in victims:
+            entry = self._entries.get(key)
+            if entry is None or self.is_pinned(key):
+                continue
+            self._move_to_temp(self._storage.path_for(key), removed)
+            # frame index goes together with its file
+            self._move_to_temp(self._storage.frames_path_for(key), removed_frames)
+            self._storage.index_remove(key)
+            del self._entries[key]
+            self._size -= entry.size
+            self.evicted += 1
+            self.evicted_bytes += entry.size
+            if entry.audio_id is not None and self._on_evict is not None:
+                self._on_evict(entry.audio_id)
+
+        if removed or removed_frames:
+            await asyncio.get_event_loop().run_in_executor(None, self._remove_files, removed + removed_frames)
+            self.logger.info('Evicted {} files from disk cache'.format(len(removed)))
+        return len(removed)
+
+    def snapshot(self) -> List[SnapshotRecord]:
+        """ Access times and hits are not in storage index, they are kept in snapshot """
+        if not self._ready:
+            return list(self._restored)
+        return [(key, None, (entry.last_access, entry.hits)) for key, entry in self._entries.items()]
+
+    def restore(self, records: List[SnapshotRecord]):
+        if not self._ready:
+            self._restored.extend(records)
+            return
+        for key, _, (last_access, hits) in records:
+            entry = self._entries.get(key)
+            # files accessed since start are kept as they are
+            if entry is not None and entry.last_access < last_access:
+                entry.last_access = last_access
+                entry.hits += hits
+                self._reorder = True
+
+    def stats(self) -> Dict:
+        return {
+            'ready': self._ready,
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'pinned': len(self._pins),
+            'evicted': self.evicted,
+            'evicted_bytes': self.evicted_bytes,
+            'max_entries': self._settings['max_entries'],
+            'max_bytes': self._settings['max_bytes']
+        }
+
+    async def _run(self):
+        await self._scan()
+        while True:
+            try:
+                await self._maintain()
+            except OSError as e:
+                self.logger.error('Disk cache eviction failed: {}'.format(e))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._settings['eviction_interval'])
+            except asyncio.TimeoutError:
+                pass
+
+    async def _maintain(self):
+        """ Single pass of background task """
+        if self._shared:
+            # only files downloaded since the last pass, whole index is too big to merge every time
+            since = self._index_loaded - self.INDEX_OVERLAP
+            self._index_loaded = time.time()
+            self._merge_index(await self._storage.load_index(since), recent=True)
+            self._merge_accesses(await self._storage.pop_accesses())
+        await self.evict()
+
+    async def _run_saving(self):
+        while True:
+            await asyncio.sleep(self._settings['access_save_interval'])
+            self._save_accesses()
+
+    def _save_accesses(self):
+        if not self._accesses:
+            return
+        self._storage.index_accesses([
+            (key, last_access, hits) for key, (last_access, hits) in self._accesses.items()
+        ])
+        self._accesses = {}
+
+    async def _scan(self):
+        started = time.time()
+        await asyncio.get_event_loop().run_in_executor(None, self._clean_temp_dir)
+        self._index_loaded = time.time()
+        self._merge_index(await self._storage.load_index())
+        self._ready = True
+        records, self._restored = self._restored, []
+        self.restore(records)
+        self.logger.info('Disk cache loaded: {} files, {:.02f}MB ({:.02f}s)'.format(
+            len(self._entries), self._size / 1024 ** 2, time.time() - started
+        ))
+
+    def _merge_index(self, files: List[IndexEntry], recent: bool = False):
+        """
+        Adds unknown files from index as least recently used ones
+        or as most recently used ones if they were just downloaded by other processes.
+        """
+        for key, audio_id, size, mtime in sorted(files, key=lambda item: item[3], reverse=not recent):
+            if key in self._entries:
+                continue
+            self._entries[key] = DiskEntry(size, mtime, mtime, audio_id)
+            if not recent:
+                self._entries.move_to_end(key, last=False)
+            self._size += size
+
+    def _merge_accesses(self, accesses: List[AccessEntry]):
+        """ Accesses of files in other processes, they are at most `access_save_interval` late """
+        for key, last_access, hits in sorted(accesses, key=lambda item: item[1]):
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            entry.hits += hits
+            if entry.last_access < last_access:
+                entry.last_access = last_access
+                self._entries.move_to_end(key)
+
+    def _clean_temp_dir(self):
+        # files left after crash
+        stale_before = time.time() - 2 * DOWNLOAD_SETTINGS['timeout']
+        for item in os.scandir(self._storage.temp_dir):
+            if item.name.startswith(self.EVICTED_PREFIX) or item.stat().st_mtime < stale_before:
+                self._remove_files([item.path])
+
+    def _move_to_temp(self, path: str, moved: List[str]):
+        evicted_path = os.path.join(self._storage.temp_dir, self.EVICTED_PREFIX + os.path.basename(path))
+        try:
+            os.rename(path, evicted_path)
+        except FileNotFoundError:
+            pass
+        else:
+            moved.append(evicted_path)
+
+    @staticmethod
+    def _remove_files(paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _is_over_budget(self) -> bool:
+        return (
+            self._size > self._settings['max_bytes'] or
+            len(self._entries) > self._settings['max_entries']
+        )
+
+    def _select_victims(self) -> List[str]:
+        now = time.time()
+        max_age = self._settings['max_age']
+        victims = []
+        if max_age is not None:
+            victims = [
+                key for key, entry in self._entries.items() if now - entry.created > max_age
+            ]
+
+        if not self._is_over_budget():
+            return victims
+
+        # evict a bit more than needed, so eviction does not run on every new file
+        watermark = self._settings['low_watermark']
+        max_bytes = self._settings['max_bytes'] * watermark
+        max_entries = self._settings['max_entries'] * watermark
+        size, count = self._size, len(self._entries)
+        for key in victims:
+            size -= self._entries[key].size
+            count -= 1
+
+        if self._settings['policy'] == 'lfu':
+            entries = self._entries
+            candidates = sorted(entries, key=lambda k: (entries[k].hits, entries[k].last_access))
+        else:
+            candidates = iter(self._entries)
+
+        expired = set(victims)
+        for key in candidates:
+            if size <= max_bytes and count <= max_entries:
+                break
+            if key in expired or self.is_pinned(key):
+                continue
+            victims.append(key)
+            size -= self._entries[key].size
+            count -= 1
+        return victims
@@ -1,103 +1,300 @@
+import asyncio
 import os
+import re
 import stat
-from typing import Dict
+import uuid
+from typing import Optional
 
-from tornado import web
 import aiohttp
+from tornado import web, httputil
+from tornado.iostream import StreamClosedError
 
 from cache import CachedHandler
-from settings import PATHS, HASH, DOWNLOAD_SETTINGS
+from fileio import iter_file_range
+from frames import Position
+from metrics import PHASE_DURATION, SENT_BYTES
+from ranges import parse_range_header, format_content_range, parse_http_date, build_multipart_ranges
+from records import AudioRecord
+from scheduler import SchedulerFull, PRIORITY_STREAM, PRIORITY_DOWNLOAD
+from settings import SEND_SETTINGS, REFRESH_SETTINGS, HASH
+from text import sanitize
+from transfer import Transfer, TransferError
+from utils import uni_hash
+from vk import VkError
 
-from utils import uni_hash, sanitize, set_id3_tag
+
+VK_ID_REGEX = re.compile(r'^-?\d+_\d+(_[0-9a-zA-Z]+)?$')  # owner_id, id and optional access key
 
 
-# TODO add S3 support
 # noinspection PyAbstractClass
 class DownloadHandler(CachedHandler):
-    def __init__(self, application, request, **kwargs):
-        super().__init__(application, request, **kwargs)
-        self._cache_path = PATHS['mp3']
-        os.makedirs(self._cache_path, exist_ok=True)
-
     @web.addslash
     async def get(self, *args, **kwargs):
         await self.download(kwargs['key'], kwargs['id'], stream=False)
 
-    async def download(self, cache_key: str, audio_id: str, stream: bool = False):
-        file_path = self._build_file_path(audio_id)
+    async def download(self, cache_key: str, audio_id: str, stream: bool = False,
+                       start_time: Optional[float] = None):
+        storage = self.settings['storage']
+        key = storage.key_for(audio_id)
+        file_path = storage.path_for(key)
 
-        if os.path.exists(file_path):
-            self.logger.debug('Audio file already exist: {}'.format(file_path))
-            audio_info = self._get_audio_info_cache(audio_id)
-            if audio_info is None:
-                audio_info = self._get_audio_info_from_cached_search(cache_key, audio_id)
-            if audio_info is None:
-                audio_name = '{}.mp3'.format(audio_id)
-            else:
-                audio_name = self._format_audio_name(audio_info)
-        else:
+        prefetcher = self.settings['prefetcher']
+        if prefetcher is not None:
+            prefetcher.downloaded(key)
+
+        transfer = self.settings['transfers'].get(audio_id)
+        if transfer is None and os.path.exists(file_path):
+            self.logger.debug('Audio file already exist: %s', file_path)
+            disk_cache = self.settings['disk_cache']
+            # file must be pinned before any await, so it is not evicted while sending
+            with disk_cache.pinned(key):
+                disk_cache.touch(key, audio_id)
+                audio_info = self._get_audio_info_cache(audio_id)
+                if audio_info is None:
+                    audio_info = self._get_audio_info_from_cached_search(cache_key, audio_id)
+                if audio_info is None:
+                    audio_name = '{}.mp3'.format(audio_id)
+                else:
+                    audio_name = self._format_audio_name(audio_info)
+
+                try:
+                    sent = await self._send_from_local_cache(file_path, audio_name, stream, start_time)
+                except FileNotFoundError:
+                    # evicted by other worker process, download it again
+                    if self._headers_written:
+                        raise
+                    # status and headers of local file (206, Content-Range, Etag...) must not leak into transfer
+                    self.clear()
+                    sent = None
+            if sent is not None:
+                if not sent:
+                    raise web.HTTPError(502)
+                return
+
+        if transfer is None:
             audio_info = self._get_audio_info_from_cached_search(cache_key, audio_id)
+            if audio_info is None:
+                audio_info = self._get_audio_info_cache(audio_id)
+            audio_info = await self._refresh_audio_info(audio_id, audio_info)
             if audio_info is None:
                 raise web.HTTPError(404)
-            audio_name = self._format_audio_name(audio_info)
-
-            if not await self._download_audio(audio_info, file_path):
-                raise web.HTTPError(502)
+            # could have been started by other request while refreshing
+            transfer = self.settings['transfers'].get(audio_id)
+        try:
+            # joining running download gives it stream priority if it is still waiting
+            transfer = self.settings['transfers'].start(
+                audio_info if transfer is None else transfer.audio_info,
+                self.request.remote_ip,
+                PRIORITY_STREAM if stream else PRIORITY_DOWNLOAD
+            )
+        except SchedulerFull as e:
+            # error is written here, send_error would drop Retry-After header
+            self.set_status(503)
+            self.set_header('Retry-After', e.retry_after)
+            self.finish({'success': 0, 'error': str(e), 'error_code': 503})
+            return
 
-        if not await self._send_from_local_cache(file_path, audio_name, stream):
+        audio_name = self._format_audio_name(transfer.audio_info)
+        if not await self._send_from_transfer(transfer, audio_name, start_time):
             raise web.HTTPError(502)
 
-    # TODO add proxy support
-    async def _download_audio(self, audio_info: Dict, path: str):
-        self.logger.debug('Downloading from vk: {}'.format(audio_info['mp3']))
-        try:
-            with open(path, 'wb') as f:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        audio_info['mp3'],
-                        timeout=DOWNLOAD_SETTINGS['timeout']
-                    ) as response:
-                        async for chunk in response.content.iter_chunked(64 * 1024):
-                            f.write(chunk)
-            set_id3_tag(path, audio_info)
-        except (aiohttp.ClientError, IOError):
-            if os.path.exists(path):
-                os.remove(path)
-            return False
+    async def _send_from_local_cache(self, path: str, file_name: str, stream: bool,
+                                     start_time: Optional[float] = None):
+        self.logger.debug('Sending file from local storage [streaming=%s]: %s', stream, file_name)
+        stat_result = os.stat(path)
+        size = stat_result[stat.ST_SIZE]
+        mtime = int(stat_result[stat.ST_MTIME])
+        etag = self._build_etag(size, mtime)
+        start = 0
+        if start_time is not None:
+            start_time, start = await self.settings['seeker'].seek(path, stat_result.st_mtime, start_time)
+            # rest of the file is another representation
+            etag = self._build_etag(size, mtime, start)
+            self.set_header('X-Start-Time', '{:.3f}'.format(start_time))
+
+        self._set_headers(file_name)
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', httputil.format_timestamp(mtime))
+        if self._is_not_modified(mtime):
+            self.set_status(304)
+            self.finish()
+            return True
+
+        # ranges are not supported together with start time
+        ranges = self._get_requested_ranges(size, etag, mtime) if start_time is None else None
+        if ranges is None:
+            parts, closing = [(b'', (start, size))], b''
+        elif not ranges:
+            self.set_status(416)
+            self.set_header('Content-Range', format_content_range(None, size))
+            self.finish()
+            return True
+        elif len(ranges) == 1:
+            self.set_status(206)
+            self.set_header('Content-Range', format_content_range(ranges[0], size))
+            parts, closing = [(b'', ranges[0])], b''
+        else:
+            boundary = uuid.uuid4().hex
+            parts, closing = build_multipart_ranges(ranges, size, 'audio/mpeg', boundary)
+            self.set_status(206)
+            self.set_header('Content-Type', 'multipart/byteranges; boundary={}'.format(boundary))
 
+        self.set_header('Content-Length', sum(
+            len(header) + end - start for header, (start, end) in parts
+        ) + len(closing))
+        with PHASE_DURATION.time('file_send'):
+            for header, (start, end) in parts:
+                self.write(header)
+                async for chunk in iter_file_range(path, start, end):
+                    self.write(chunk)
+                    SENT_BYTES.inc('cache', amount=len(chunk))
+                    # wait until chunk is sent, so slow clients do not pile up buffers
+                    await self.flush()
+            self.write(closing)
+            self.finish()
         return True
 
-    async def _send_from_local_cache(self, path: str, file_name: str, stream: bool):
-        self.logger.debug('Sending file from local storage [streaming={}]: {}'.format(stream, file_name))
-        self._set_headers(path, file_name, stream)
-        for chunk in self._get_content(path):
-            self.write(chunk)
-            if stream:
-                await self.flush()
-        if not stream:
-            await self.flush()
+    async def _send_from_transfer(self, transfer: Transfer, file_name: str, start_time: Optional[float] = None,
+                                  chunk_size=SEND_SETTINGS['chunk_size']):
+        self.logger.debug('Sending file while downloading from vk: %s', file_name)
+        with transfer.open() as reader, PHASE_DURATION.time('transfer_send'):
+            # do not respond until upstream has sent anything
+            await transfer.wait(0)
+            start, end = 0, None
+            if start_time is not None:
+                start_time, start = await self._seek_transfer(transfer, start_time)
+            if transfer.failed:
+                return False
+
+            self._set_headers(file_name)
+            if start_time is not None:
+                self.set_header('X-Start-Time', '{:.3f}'.format(start_time))
+            else:
+                # final size is unknown until the file is tagged,
+                # so only ranges with explicit end are supported
+                byte_range = self._get_requested_transfer_range()
+                if byte_range is not None:
+                    start, end = byte_range
+                    size = await self._wait_transfer_size(transfer, end)
+                    if transfer.failed:
+                        return False
+                    if size is not None and start >= size:
+                        self.set_status(416)
+                        self.set_header('Content-Range', format_content_range(None, size))
+                        self.finish()
+                        return True
+                    if size is not None:
+                        end = min(end, size)
+                    self.set_status(206)
+                    self.set_header('Content-Range', format_content_range((start, end), size))
+                    self.set_header('Content-Length', end - start)
+
+            offset = start
+            try:
+                while end is None or offset < end:
+                    size = chunk_size if end is None else min(chunk_size, end - offset)
+                    chunk = await reader.read(offset, size)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    self.write(chunk)
+                    SENT_BYTES.inc('transfer', amount=len(chunk))
+                    await self.flush()
+            except (TransferError, StreamClosedError) as e:
+                # headers are sent already, closed connection is the only way to tell client the body is truncated
+                self.logger.info('Sending of {} stopped after {} bytes: {}'.format(
+                    file_name, offset - start, e or type(e).__name__
+                ))
+                self.request.connection.close()
+        # with closed connection it only finishes the handler
         self.finish()
         return True
 
-    def _set_headers(self, path: str, file_name: str, stream: bool):
+    @staticmethod
+    async def _wait_transfer_size(transfer: Transfer, end: int) -> Optional[int]:
+        """
+        Content-Length must be exact, so range which may go past the end of file waits
+        until it is downloaded or the final size is known. Returns final size if it is known.
+        """
+        while (
+                transfer.final_size is None and end > max(transfer.written, transfer.min_size) and
+                not transfer.finished
+        ):
+            await transfer.wait(transfer.written)
+        return transfer.final_size
+
+    async def _seek_transfer(self, transfer: Transfer, seconds: float) -> Position:
+        """ Waits until frame at `seconds` is downloaded, returns its start time and offset """
+        frames = transfer.frames
+        while frames.duration <= seconds and not transfer.finished:
+            await transfer.wait(transfer.written)
+        if transfer.done and not frames.index.times:
+            # downloaded by other worker process
+            return await self.settings['seeker'].seek(transfer.path, os.stat(transfer.path).st_mtime, seconds)
+        return frames.index.seek(seconds)
+
+    def _get_start_time(self) -> Optional[float]:
+        value = self.get_argument('t', None)
+        if value is None:
+            return None
+        try:
+            start_time = float(value)
+            if not 0 <= start_time < 24 * 60 * 60:
+                raise ValueError()
+        except ValueError:
+            raise web.HTTPError(
+                status_code=400,
+                reason='Invalid start time (t): must be a number of seconds'
+            )
+        return start_time
+
+    def _set_headers(self, file_name: str):
         self.set_header('Cache-Control', 'private')
         self.set_header('Cache-Description', 'File Transfer')
         self.set_header('Content-Type', 'audio/mpeg')
-        if not stream:
-            self.set_header('Content-Length', self._get_content_size(path))
+        self.set_header('Accept-Ranges', 'bytes')
         self.set_header('Content-Disposition', 'attachment; filename={}'.format(file_name))
 
-    def _get_content_size(self, path: str):
-        stat_result = os.stat(path)
-        size = stat_result[stat.ST_SIZE]
-        self.logger.debug('File size: {:.02f}MB'.format(size / 1024 ** 2))
-        return size
-
     @staticmethod
-    def _get_content(path: str, chunk_size=64 * 1024):
-        with open(path, 'rb') as f:
-            for chunk in iter(lambda: f.read(chunk_size), b''):
-                yield chunk
+    def _build_etag(size: int, mtime: int, start: int = 0):
+        if start:
+            return '"{:x}-{:x}-{:x}"'.format(mtime, size, start)
+        return '"{:x}-{:x}"'.format(mtime, size)
+
+    def _is_not_modified(self, mtime: int):
+        if self.request.headers.get('If-None-Match'):
+            return self.check_etag_header()
+        modified_since = self.request.headers.get('If-Modified-Since')
+        if modified_since:
+            timestamp = parse_http_date(modified_since)
+            return timestamp is not None and mtime <= timestamp
+        return False
+
+    def _get_requested_ranges(self, size: int, etag: str, mtime: int):
+        range_header = self.request.headers.get('Range')
+        if range_header is None:
+            return None
+
+        if_range = self.request.headers.get('If-Range')
+        if if_range is not None:
+            if if_range.startswith(('"', 'W/')):
+                matches = if_range == etag  # strong comparison
+            else:
+                matches = parse_http_date(if_range) == mtime
+            if not matches:
+                return None
+
+        return parse_range_header(range_header, size)
+
+    def _get_requested_transfer_range(self):
+        range_header = self.request.headers.get('Range')
+        # there is no validator for incomplete file
+        if range_header is None or 'If-Range' in self.request.headers:
+            return None
+        ranges = parse_range_header(range_header)
+        if ranges is None or len(ranges) != 1:
+            return None
+        return ranges[0]
 
     def _get_audio_info_from_cached_search(self, cache_key: str, audio_id: str):
         self.logger.debug('Getting audio item from search cache')
@@ -105,26 +302,48 @@ class DownloadHandler(CachedHandler):
         if cached_search_result is None:
             return None
 
-        audio_info = None
-        for item in cached_search_result:
-            if item['id'] == audio_id:
-                audio_info = item
-                break
+        audio_info = cached_search_result.get(audio_id)
         if audio_info is None:
             return None
 
         self._cache_audio_info(audio_info)
         return audio_info
 
-    @staticmethod
-    def _build_file_path(audio_id: str):
-        file_name = '{}.mp3'.format(uni_hash(HASH['mp3'], audio_id))
-        file_path = os.path.join(PATHS['mp3'], file_name)
-        return file_path
+    async def _refresh_audio_info(self, audio_id: str, audio_info: Optional[AudioRecord]) -> Optional[AudioRecord]:
+        """
+        Replaces record with expired mp3 url with a fresh one.
+        Without record (search is expired) it is requested by VK id from the link.
+        """
+        if audio_info is not None and not audio_info.is_expired(REFRESH_SETTINGS['margin']):
+            return audio_info
+        vk_id = audio_info.vk_id if audio_info is not None else self._get_vk_id(audio_id)
+        if not vk_id:
+            return audio_info
+
+        try:
+            fresh = await self.settings['refresher'].get(vk_id)
+        except (VkError, aiohttp.ClientError, asyncio.TimeoutError):
+            # old url may still work
+            return audio_info
+        # id from the link must belong to the requested audio
+        if fresh is None or fresh.id != audio_id:
+            return audio_info
+        self._cache_audio_info(fresh)
+        return fresh
+
+    def _get_vk_id(self, audio_id: str) -> Optional[str]:
+        """ VK id from the link, only if it is well formed and belongs to the requested audio """
+        vk_id = self.get_argument('vk', '')
+        if not VK_ID_REGEX.match(vk_id):
+            return None
+        # the same way as id of the record is made from VK audio
+        if uni_hash(HASH['id'], vk_id.split('_')[1]) != audio_id:
+            return None
+        return vk_id
 
     @staticmethod
-    def _format_audio_name(audio_info: Dict):
-        name = '{} - {}'.format(audio_info['artist'], audio_info['title'])
+    def _format_audio_name(audio_info: AudioRecord):
+        name = '{} - {}'.format(audio_info.artist, audio_info.title)
         name = sanitize(name, to_lower=False, alpha_numeric_only=False)
         return '{}.mp3'.format(name)
 
@@ -133,4 +352,4 @@ class DownloadHandler(CachedHandler):
 class StreamHandler(DownloadHandler):
     @web.addslash
     async def get(self, *args, **kwargs):
-        await self.download(kwargs['key'], kwargs['id'], stream=True)
+        await self.download(kwargs['key'], kwargs['id'], stream=True, start_time=self._get_start_time())
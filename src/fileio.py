@@ -0,0 +1,39 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+
+from settings import SEND_SETTINGS
+
+
+# disk reads are done by small thread pool, so slow disk never stalls event loop
+_executor = ThreadPoolExecutor(
+    max_workers=SEND_SETTINGS['io_threads'], thread_name_prefix='file-io'
+)
+
+
+def run_io(func, *args) -> asyncio.Future:
+    """ Runs blocking disk operation in file io threads """
+    return asyncio.get_event_loop().run_in_executor(_executor, func, *args)
+
+
+async def pread(fd: int, size: int, offset: int) -> bytes:
+    return await run_io(os.pread, fd, size, offset)
+
+
+async def iter_file_range(path: str, start: int, end: int,
+                          chunk_size: int = SEND_SETTINGS['chunk_size']) -> AsyncIterator[bytes]:
+    """ Yields [start, end) range of file by chunks of at most chunk_size bytes """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_SEQUENTIAL)
+        offset = start
+        while offset < end:
+            chunk = await pread(fd, min(chunk_size, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
@@ -0,0 +1,342 @@
+"""
+MPEG audio frame index for time based seeking.
+
+Index is built while mp3 file is written (no second read of the file) and stored next to it:
+start time and offset of a frame every `SEEK_SETTINGS['interval']` seconds, so seeking is a binary search.
+Files without index (downloaded by older versions) are seeked by Xing TOC or by bitrate of CBR files.
+"""
+import os
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict
+
+from fileio import run_io
+from id3 import V2_HEADER_SIZE, v2_tag_size
+from settings import SEEK_SETTINGS
+
+
+Frame = Tuple[int, int, int]  # length in bytes, samples, sample rate
+Position = Tuple[float, int]  # start time in seconds, offset in bytes
+
+MPEG1 = 3
+LAYER3 = 1
+MONO = 3
+
+# kbps by version (MPEG1 or not) and layer
+BITRATES = {
+    (True, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+_frames = {}  # type: Dict[int, Optional[Frame]]  # parsed headers by their 2nd and 3rd bytes
+
+
+def _bitrate(data: bytes, position: int) -> int:
+    """ Bits per second of valid frame at `position` """
+    key = (data[position + 1] << 8) | data[position + 2]
+    return BITRATES[((key >> 11) & 3 == MPEG1, (key >> 9) & 3)][(key >> 4) & 15] * 1000
+
+
+def _parse_frame(key: int) -> Optional[Frame]:
+    version, layer = (key >> 11) & 3, (key >> 9) & 3
+    bitrate_index, rate_index, padding = (key >> 4) & 15, (key >> 2) & 3, (key >> 1) & 1
+    # free format bitrate is not supported
+    if (key >> 13) != 7 or version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == MPEG1
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    rate = SAMPLE_RATES[version][rate_index]
+    if layer == 3:  # layer I
+        return (12 * bitrate // rate + padding) * 4, 384, rate
+    samples = 1152 if mpeg1 or layer != LAYER3 else 576
+    return samples // 8 * bitrate // rate + padding, samples, rate
+
+
+def parse_frame(data: bytes, position: int = 0) -> Optional[Frame]:
+    """ Frame at `position`, None if there is no valid frame header """
+    if position + 4 > len(data) or data[position] != 0xff:
+        return None
+    key = (data[position + 1] << 8) | data[position + 2]
+    try:
+        return _frames[key]
+    except KeyError:
+        frame = _frames[key] = _parse_frame(key)
+        return frame
+
+
+def find_frame(data: bytes, position: int = 0) -> Optional[int]:
+    """ Position of the first frame followed by another frame (or end of data) """
+    while True:
+        position = data.find(b'\xff', position)
+        if position < 0:
+            return None
+        frame = parse_frame(data, position)
+        if frame is not None and (
+                position + frame[0] + 4 > len(data) or parse_frame(data, position + frame[0]) is not None
+        ):
+            return position
+        position += 1
+
+
+def _xing_position(data: bytes, position: int) -> int:
+    """ Position of Xing/Info tag in the frame, it goes after side information """
+    mpeg1 = (data[position + 1] >> 3) & 3 == MPEG1
+    mono = data[position + 3] >> 6 == MONO
+    if mpeg1:
+        return position + 4 + (17 if mono else 32)
+    return position + 4 + (9 if mono else 17)
+
+
+def frames_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.frames'
+
+
+class FrameIndex:
+    """ Start time (ms) and offset of frames, about every `interval` seconds """
+    MAGIC = b'MP3F'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBII')  # magic, version, duration in ms, number of points
+
+    def __init__(self, times: List[int] = None, offsets: List[int] = None, duration: int = 0):
+        self.times = times or []
+        self.offsets = offsets or []
+        self.duration = duration
+
+    def seek(self, seconds: float) -> Position:
+        """ Frame at or before `seconds` """
+        point = bisect_right(self.times, int(seconds * 1000)) - 1
+        if point < 0:
+            return 0.0, 0
+        return self.times[point] / 1000, self.offsets[point]
+
+    def to_bytes(self) -> bytes:
+        count = len(self.times)
+        return (
+            self.HEADER.pack(self.MAGIC, self.VERSION, self.duration, count) +
+            struct.pack('<{}I'.format(count), *self.times) + struct.pack('<{}I'.format(count), *self.offsets)
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Optional['FrameIndex']:
+        """ None if data is not a valid index """
+        if len(data) < cls.HEADER.size:
+            return None
+        magic, version, duration, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION or len(data) != cls.HEADER.size + 8 * count:
+            return None
+        times = list(struct.unpack_from('<{}I'.format(count), data, cls.HEADER.size))
+        offsets = list(struct.unpack_from('<{}I'.format(count), data, cls.HEADER.size + 4 * count))
+        return cls(times, offsets, duration)
+
+
+class FrameIndexer:
+    """
+    Builds FrameIndex of a file from its data as it is written, chunk by chunk.
+    ID3v2 tags are skipped, garbage between frames is skipped until the next pair of valid frames.
+    """
+
+    def __init__(self, interval: float = None):
+        self._interval = SEEK_SETTINGS['interval'] if interval is None else interval
+        self.index = FrameIndex()
+        self.frames = 0
+        self._time = 0.0
+        self._next_point = 0.0
+        self._offset = 0  # of `_pending` in the file
+        self._pending = b''  # not parsed yet: incomplete header or frame waiting for the next one
+        self._skip = 0  # rest of the last frame or tag
+        self._synced = False
+
+    @property
+    def duration(self) -> float:
+        """ Seconds of audio indexed so far """
+        return self._time
+
+    def feed(self, data: bytes):
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            self._offset += skipped
+            data = data[skipped:]
+        data = self._pending + data if self._pending else data
+
+        position, end = 0, len(data)
+        while position + 4 <= end:
+            frame = parse_frame(data, position)
+            if frame is not None and not self._synced:
+                # single valid header may be a random match
+                after = position + frame[0]
+                if after + 4 <= end and parse_frame(data, after) is None:
+                    frame = None
+                elif after + 4 > end:
+                    break  # wait for the next header
+            if frame is None:
+                self._synced = False
+                if data.startswith(b'ID3', position):
+                    if position + V2_HEADER_SIZE > end:
+                        break
+                    size = v2_tag_size(data[position:position + V2_HEADER_SIZE])
+                    if size:
+                        position += size
+                        continue
+                next_position = data.find(b'\xff', position + 1)
+                position = end if next_position < 0 else next_position
+                continue
+
+            length, samples, rate = frame
+            xing = _xing_position(data, position)
+            # VBR header frame has no audio
+            if self.frames or data[xing:xing + 4] not in (b'Xing', b'Info'):
+                if self._time >= self._next_point:
+                    self.index.times.append(int(self._time * 1000))
+                    self.index.offsets.append(self._offset + position)
+                    self._next_point = self._time + self._interval
+                self._time += samples / rate
+            self.frames += 1
+            self._synced = True
+            position += length
+
+        if position >= end:
+            self._skip = position - end
+            self._pending = b''
+            self._offset += end
+        else:
+            self._pending = data[position:]
+            self._offset += position
+        self.index.duration = int(self._time * 1000)
+
+
+def _toc_fraction(toc: Optional[bytes], percent: float) -> float:
+    """ Part of audio bytes before `percent` of duration, by Xing TOC if there is one """
+    if toc is None:
+        return percent / 100
+    point = int(percent)
+    low, high = toc[point], toc[point + 1] if point < 99 else 256
+    return (low + (high - low) * (percent - point)) / 256
+
+
+def _toc_percent(toc: Optional[bytes], fraction: float) -> float:
+    """ Reverse of _toc_fraction: percent of duration before `fraction` of audio bytes """
+    if toc is None:
+        return fraction * 100
+    scaled = fraction * 256
+    point = max(bisect_right(toc, scaled) - 1, 0)
+    low, high = toc[point], toc[point + 1] if point < 99 else 256
+    return min(100.0, point + ((scaled - low) / (high - low) if high > low else 0))
+
+
+def estimate_position(path: str, seconds: float, window: int = 16 * 1024) -> Optional[Position]:
+    """
+    Blocking. Position of file without index: by TOC of Xing header of VBR file
+    or by bitrate of the first frame, aligned to the next frame.
+    Returned time is estimated for that frame the same way.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(V2_HEADER_SIZE)
+        audio_start = v2_tag_size(head) or 0
+        f.seek(audio_start)
+        head = f.read(window)
+        first = find_frame(head)
+        if first is None:
+            return None
+        audio_start += first
+        _, samples, rate = parse_frame(head, first)
+
+        duration = audio_bytes = toc = None
+        xing = _xing_position(head, first)
+        if head[xing:xing + 4] in (b'Xing', b'Info'):
+            flags, = struct.unpack_from('>I', head, xing + 4)
+            fields = xing + 8
+            frames = None
+            if flags & 1:
+                frames, = struct.unpack_from('>I', head, fields)
+                fields += 4
+            if flags & 2:
+                audio_bytes, = struct.unpack_from('>I', head, fields)
+                fields += 4
+            if flags & 4:
+                toc = head[fields:fields + 100]
+                if len(toc) != 100:
+                    toc = None
+            if frames:
+                duration = frames * samples / rate
+                audio_bytes = audio_bytes or size - audio_start
+
+        if duration is not None:
+            percent = min(99.999, max(0.0, seconds / duration * 100))
+            offset = audio_start + int(_toc_fraction(toc, percent) * audio_bytes)
+        else:
+            # constant bitrate, frames differ by padding byte only
+            bytes_per_second = _bitrate(head, first) / 8
+            offset = audio_start + int(seconds * bytes_per_second)
+        if offset >= size:
+            return None
+
+        f.seek(offset)
+        found = find_frame(f.read(window))
+        if found is None:
+            return None
+        position = offset + found
+        if duration is not None:
+            start_time = _toc_percent(toc, (position - audio_start) / audio_bytes) / 100 * duration
+        else:
+            start_time = round((position - audio_start) / (bytes_per_second * samples / rate)) * samples / rate
+        return start_time, position
+
+
+class Seeker:
+    """ Positions in audio files by time, recently used indexes are kept in memory """
+
+    def __init__(self, settings: Dict = None):
+        self._settings = SEEK_SETTINGS if settings is None else settings
+        self._indexes = OrderedDict()  # type: OrderedDict[Tuple[str, float], FrameIndex]
+        self.indexed = 0
+        self.estimated = 0
+        self.failed = 0
+
+    async def seek(self, path: str, mtime: float, seconds: float) -> Position:
+        """ Start time and offset of the frame to start playback at `seconds` from """
+        # file may be replaced by other one with the same name
+        cache_key = (path, mtime)
+        index = self._indexes.get(cache_key)
+        if index is None:
+            index = await run_io(self._load, frames_path(path))
+        if index is not None:
+            self._indexes[cache_key] = index
+            self._indexes.move_to_end(cache_key)
+            while len(self._indexes) > self._settings['cache_size']:
+                self._indexes.popitem(last=False)
+            self.indexed += 1
+            return index.seek(seconds)
+
+        try:
+            position = await run_io(estimate_position, path, seconds)
+        except (OSError, struct.error):
+            position = None
+        if position is None:
+            self.failed += 1
+            return 0.0, 0
+        self.estimated += 1
+        return position
+
+    def stats(self) -> Dict:
+        return {
+            'cached': len(self._indexes),
+            'indexed': self.indexed,
+            'estimated': self.estimated,
+            'failed': self.failed
+        }
+
+    @staticmethod
+    def _load(path: str) -> Optional[FrameIndex]:
+        try:
+            with open(path, 'rb') as f:
+                return FrameIndex.from_bytes(f.read())
+        except FileNotFoundError:
+            return None
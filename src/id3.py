@@ -0,0 +1,115 @@
+"""
+ID3 tags built in memory while mp3 file is downloaded: ID3v2.4 tag with UTF-8 text
+before the audio and ID3v1 trailer (transliterated to ASCII) for old players.
+Tags which were already in the file are dropped on the fly, so the file is read only once.
+"""
+from typing import Optional
+
+from unidecode import unidecode
+
+from records import AudioRecord
+
+
+V2_HEADER_SIZE = 10
+V2_FOOTER_FLAG = 0x10
+V1_SIZE = 128
+V1_FIELD_SIZE = 30
+V1_NO_GENRE = 255
+
+UTF8 = b'\x03'
+
+
+def _synchsafe(value: int) -> bytes:
+    """ 28 bit integer in 4 bytes, 7 bits each """
+    return bytes((value >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+
+def v2_tag_size(header: bytes) -> Optional[int]:
+    """ Size of ID3v2 tag (header and footer included) which starts with `header`, None if there is no tag """
+    if len(header) < V2_HEADER_SIZE or header[:3] != b'ID3' or any(byte & 0x80 for byte in header[6:10]):
+        return None
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | byte
+    return V2_HEADER_SIZE + size + (V2_HEADER_SIZE if header[5] & V2_FOOTER_FLAG else 0)
+
+
+def build_v2_tag(audio_info: AudioRecord) -> bytes:
+    frames = b''
+    for frame_id, value in ((b'TIT2', audio_info.title), (b'TPE1', audio_info.artist)):
+        value = (value or '').strip()
+        if not value:
+            continue
+        data = UTF8 + value.encode('utf-8')
+        frames += frame_id + _synchsafe(len(data)) + b'\x00\x00' + data
+    return b'ID3\x04\x00\x00' + _synchsafe(len(frames)) + frames
+
+
+def build_v1_tag(audio_info: AudioRecord) -> bytes:
+    def field(value: str, size: int = V1_FIELD_SIZE) -> bytes:
+        return unidecode(value or '').strip().encode('ascii', 'replace')[:size].ljust(size, b'\x00')
+
+    return (
+        b'TAG' + field(audio_info.title) + field(audio_info.artist) + field('') + field('', 4) + field('') +
+        bytes([V1_NO_GENRE])
+    )
+
+
+class Id3Tagger:
+    """
+    Rewrites tags of mp3 stream chunk by chunk:
+
+        tagger = Id3Tagger(audio_info)
+        f.write(tagger.header())
+        for chunk in chunks:
+            f.write(tagger.feed(chunk))
+        f.write(tagger.finish())
+
+    The last 128 bytes are held back until the end, they may be an old ID3v1 tag.
+    """
+
+    def __init__(self, audio_info: AudioRecord):
+        self._audio_info = audio_info
+        self._head = b''  # first bytes until it is known whether they are ID3v2 tag
+        self._head_done = False
+        self._header_size = 0
+        self._old_v2_size = 0
+        self._skip = 0
+        self._tail = b''
+
+    def header(self) -> bytes:
+        header = build_v2_tag(self._audio_info)
+        self._header_size = len(header)
+        return header
+
+    def min_size(self, input_size: int) -> Optional[int]:
+        """
+        Output size is at least this for input of `input_size` bytes (128 bytes more without old ID3v1 tag),
+        None until the start of input is seen
+        """
+        if not self._head_done:
+            return None
+        return self._header_size + input_size - self._old_v2_size
+
+    def feed(self, chunk: bytes) -> bytes:
+        if not self._head_done:
+            self._head += chunk
+            if len(self._head) < V2_HEADER_SIZE:
+                return b''
+            chunk, self._head, self._head_done = self._head, b'', True
+            self._skip = self._old_v2_size = v2_tag_size(chunk) or 0
+
+        if self._skip:
+            skipped = min(self._skip, len(chunk))
+            self._skip -= skipped
+            chunk = chunk[skipped:]
+
+        data = self._tail + chunk
+        self._tail = data[-V1_SIZE:]
+        return data[:-V1_SIZE]
+
+    def finish(self) -> bytes:
+        tail = self._head + self._tail
+        if len(tail) == V1_SIZE and tail[:3] == b'TAG':
+            tail = b''
+        return tail + build_v1_tag(self._audio_info)
@@ -1,11 +1,31 @@
 import asyncio
 import logging
+import signal
+from typing import Optional
 
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from tornado.web import url, Application
 
+from cache import AppCache, MemoryRegion
+from client import HttpClient
+from disk_cache import DiskCache
 from download import DownloadHandler, StreamHandler
-from search import SearchHandler
+from frames import Seeker
+from prefetch import Prefetcher
+from responses import ResponseCache
+from scheduler import DownloadScheduler
+from search import SearchHandler, BatchSearchHandler
+from settings import PATHS, SERVER_SETTINGS, PREFETCH_SETTINGS, SEARCH_SETTINGS, SNAPSHOT_SETTINGS
+from singleflight import ProcessLeases
+from snapshot import Snapshots
+from stats import StatsHandler, MetricsHandler, SharedMetrics, collect_metrics
+from storage import LocalStorage, S3Storage, create_remote_storage
+from tokens import TokenPool, SharedTokenState
+from transfer import TransferManager
 from utils import setup_logger
+from vk import VkApi, SearchService, AudioRefresher
 
 
 # Disable unnecessary logging
@@ -13,20 +33,136 @@ logging.getLogger('tornado.general').disabled = True
 logging.getLogger('tornado.access').disabled = True
 
 
-def main():
-    logger = setup_logger('main')
-    loop = asyncio.get_event_loop()
+def make_app(cache: AppCache, http_client: HttpClient, storage: LocalStorage, disk_cache: DiskCache,
+             remote_storage: Optional[S3Storage] = None, leases: Optional[ProcessLeases] = None,
+             token_state: Optional[SharedTokenState] = None):
+    tokens = TokenPool(SEARCH_SETTINGS['access_tokens'], shared=token_state)
+    api = VkApi(http_client, tokens)
+    searcher = SearchService(api, cache, leases)
+    refresher = AudioRefresher(api)
+    responses = ResponseCache()
+    scheduler = DownloadScheduler()
+    transfers = TransferManager(http_client, storage, disk_cache, remote_storage, leases, scheduler)
+    seeker = Seeker()
+    prefetcher = Prefetcher(searcher, transfers, storage) if PREFETCH_SETTINGS['enabled'] else None
+    stats_sources = {
+        'cache': cache,
+        'http': http_client,
+        'disk_cache': disk_cache,
+        'search': searcher,
+        'tokens': tokens,
+        'refresh': refresher,
+        'responses': responses,
+        'transfers': transfers,
+        'scheduler': scheduler,
+        'seek': seeker
+    }
+    if remote_storage is not None:
+        stats_sources['remote_storage'] = remote_storage
+    if leases is not None:
+        stats_sources['leases'] = leases
+    if prefetcher is not None:
+        stats_sources['prefetch'] = prefetcher
 
-    app = Application(
+    return Application(
         handlers=[
             url(r'/search/?', SearchHandler, name='search'),
+            url(r'/search/batch/?', BatchSearchHandler, name='batch_search'),
             url(r'/dl/(?P<key>[^\/]+)/(?P<id>[^\/]+)/?', DownloadHandler, name='download'),
-            url(r'/stream/(?P<key>[^\/]+)/(?P<id>[^\/]+)/?', StreamHandler, name='stream')
-        ]
+            url(r'/stream/(?P<key>[^\/]+)/(?P<id>[^\/]+)/?', StreamHandler, name='stream'),
+            url(r'/stats/?', StatsHandler, name='stats'),
+            url(r'/metrics/?', MetricsHandler, name='metrics')
+        ],
+        cache=cache,
+        http_client=http_client,
+        storage=storage,
+        disk_cache=disk_cache,
+        searcher=searcher,
+        refresher=refresher,
+        responses=responses,
+        transfers=transfers,
+        seeker=seeker,
+        prefetcher=prefetcher,
+        stats_sources=stats_sources
+    )
+
+
+def main():
+    logger = setup_logger('main')
+    sockets = bind_sockets(SERVER_SETTINGS['port'])
+    task_id = None
+    leases = None
+    token_state = None
+    if SERVER_SETTINGS['workers'] != 1:
+        # fork before event loop is created, children must not share it
+        task_id = fork_processes(SERVER_SETTINGS['workers'] or None)
+        leases = ProcessLeases(PATHS['shared'])
+        # VK rate limits are per token, not per process
+        token_state = SharedTokenState(PATHS['shared'])
+
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+
+    cache = AppCache()
+    cache.open()
+    http_client = HttpClient()
+    loop.run_until_complete(http_client.open())
+    storage = LocalStorage(PATHS['mp3'])
+    loop.run_until_complete(storage.open())
+    # only the first worker evicts files downloaded by all of them
+    disk_cache = DiskCache(
+        storage, on_evict=cache.region('audio_info').remove,
+        evict=task_id in (None, 0), shared=task_id is not None
     )
-    app.listen(8000)
-    logger.info('Starting...')
-    loop.run_forever()
+    loop.run_until_complete(disk_cache.open())
+
+    app = make_app(cache, http_client, storage, disk_cache, create_remote_storage(), leases, token_state)
+    snapshots = None
+    if SNAPSHOT_SETTINGS['enabled']:
+        # sqlite region and storage index are persistent already, snapshots are loaded in background
+        snapshots = Snapshots(PATHS['snapshots'])
+        search_pages = cache.region('search_pages')
+        if isinstance(search_pages, MemoryRegion):
+            snapshots.add('search_pages', search_pages)
+        if task_id in (None, 0):
+            snapshots.add('disk_cache', disk_cache)
+        loop.run_until_complete(snapshots.open())
+        app.settings['stats_sources']['snapshots'] = snapshots
+    prefetcher = app.settings['prefetcher']
+    if prefetcher is not None:
+        loop.run_until_complete(prefetcher.open())
+    shared_metrics = None
+    if task_id is not None:
+        # workers share the socket, so scrape of any of them must return metrics of all
+        stats_sources = app.settings['stats_sources']
+        shared_metrics = SharedMetrics(PATHS['shared'], task_id, lambda extra: collect_metrics(stats_sources, extra))
+        loop.run_until_complete(shared_metrics.open())
+        app.settings['shared_metrics'] = shared_metrics
+    # downloads are scheduled per client address, so it must be the real one
+    HTTPServer(
+        app, xheaders=SERVER_SETTINGS['xheaders'], trusted_downstream=SERVER_SETTINGS['trusted_proxies']
+    ).add_sockets(sockets)
+    logger.info('Starting{}...'.format('' if task_id is None else ' worker {}'.format(task_id)))
+    try:
+        loop.run_forever()
+    finally:
+        logger.info('Shutting down...')
+        if shared_metrics is not None:
+            loop.run_until_complete(shared_metrics.close())
+        if snapshots is not None:
+            loop.run_until_complete(snapshots.close())
+        if prefetcher is not None:
+            loop.run_until_complete(prefetcher.close())
+        loop.run_until_complete(app.settings['transfers'].close())
+        loop.run_until_complete(disk_cache.close())
+        loop.run_until_complete(storage.close())
+        loop.run_until_complete(http_client.close())
+        cache.close()
+        if leases is not None:
+            leases.close()
+        if token_state is not None:
+            token_state.close()
 
 
 if __name__ == '__main__':
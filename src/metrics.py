@@ -0,0 +1,172 @@
+"""
+Minimal Prometheus metrics: histograms, counters and gauges with labels,
+rendered in text exposition format together with stats of app services.
+"""
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Iterator, Iterable, Any, Optional
+
+
+PREFIX = 'thatmusic_'
+
+# in seconds, from cache hits to long downloads
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = Tuple[str, ...]
+Family = Tuple[str, List[str], List[str]]  # metric name, HELP and TYPE lines, samples
+
+
+def _format_labels(names: Tuple[str, ...], values: Labels, *extra: str) -> str:
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    pairs.extend(label for label in extra if label)
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+def worker_label(worker: Optional[int]) -> str:
+    """ Label of samples of the worker process, empty for single process """
+    return '' if worker is None else 'worker="{}"'.format(worker)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.description = description
+        self.label_names = labels
+        self._values = {}  # type: Dict[Labels, Any]
+
+    def family(self, extra: str = '') -> Family:
+        """ Lines of the metric, `extra` label (for ex. worker) is added to all samples """
+        header = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.type)
+        ]
+        samples = []
+        for labels, value in sorted(self._values.items()):
+            samples.extend(self._render_value(labels, value, extra))
+        return self.name, header, samples
+
+    def _render_value(self, labels: Labels, value, extra: str = '') -> Iterator[str]:
+        yield '{}{} {}'.format(self.name, _format_labels(self.label_names, labels, extra), _format_value(value))
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value: float, *labels: str):
+        counts = self._values.get(labels)
+        if counts is None:
+            # per bucket (not cumulative) counts and sum
+            counts = self._values[labels] = [[0] * len(self.buckets), 0.0]
+        counts[0][bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def _render_value(self, labels: Labels, value, extra: str = '') -> Iterator[str]:
+        counts, total = value
+        cumulative = 0
+        for bucket, count in zip(self.buckets, counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                self.name, _format_labels(self.label_names, labels, extra, 'le="{}"'.format(_format_value(bucket))),
+                cumulative
+            )
+        yield '{}_sum{} {}'.format(self.name, _format_labels(self.label_names, labels, extra), repr(total))
+        yield '{}_count{} {}'.format(self.name, _format_labels(self.label_names, labels, extra), cumulative)
+
+
+REQUEST_DURATION = Histogram('request_duration_seconds', 'HTTP request latency', ('route', 'code'))
+REQUESTS_IN_FLIGHT = Gauge('requests_in_flight', 'HTTP requests being handled', ('route',))
+# cache_lookup, vk_search, vk_refresh, upstream_download, file_send, transfer_send
+PHASE_DURATION = Histogram('phase_duration_seconds', 'Latency of request handling phases', ('phase',))
+SENT_BYTES = Counter('sent_bytes_total', 'Audio bytes sent to clients', ('source',))
+
+METRICS = [REQUEST_DURATION, REQUESTS_IN_FLIGHT, PHASE_DURATION, SENT_BYTES]
+
+
+def stats_families(name: str, stats: Dict, extra: str = '') -> List[Family]:
+    """
+    Numeric stats of a service become untyped metrics. Nested dicts become
+    `name` label: a service made of named parts ({"search_pages": {"hits": 1}})
+    or a value split by something ({"queued": {"stream": 1}}).
+    """
+    values = {}  # type: Dict[str, List[Tuple[str, Any]]]
+    if stats and all(isinstance(value, dict) for value in stats.values()):
+        for part, part_stats in stats.items():
+            for key, value in part_stats.items():
+                values.setdefault(key, []).append((part, value))
+    else:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                values.setdefault(key, []).extend(value.items())
+            else:
+                values.setdefault(key, []).append((None, value))
+
+    families = []
+    for key, items in values.items():
+        metric_name = '{}{}_{}'.format(PREFIX, name, key)
+        samples = [(label, value) for label, value in items if isinstance(value, (int, float))]
+        if not samples:
+            continue
+        lines = []
+        for label, value in samples:
+            labels = _format_labels(('name',), (label,) if label is not None else (), extra)
+            value = int(value) if isinstance(value, bool) else value
+            lines.append('{}{} {}'.format(metric_name, labels, _format_value(value)))
+        families.append((metric_name, ['# TYPE {} untyped'.format(metric_name)], lines))
+    return families
+
+
+def merge_families(families: Iterable[Family]) -> List[str]:
+    """ Lines of all metrics, samples of the same metric (from several workers) go together """
+    merged = OrderedDict()  # type: OrderedDict[str, Tuple[List[str], List[str]]]
+    for name, header, samples in families:
+        merged.setdefault(name, (header, []))[1].extend(samples)
+    lines = []
+    for header, samples in merged.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return lines
+
@@ -0,0 +1,82 @@
+"""
+Moves audio files from old flat cache directory ({md5}.mp3) into fan-out layout
+and (re)builds storage index.
+
+Usage: python migrate_storage.py [--source DIR] [--target DIR] [--rebuild-index] [--dry-run]
+"""
+import argparse
+import os
+import re
+
+from settings import PATHS
+from storage import LocalStorage
+from utils import setup_logger
+
+
+logger = setup_logger('migrate')
+
+FILE_NAME_REGEX = re.compile(r'^([0-9a-f]{32})\.mp3$')
+
+
+def migrate_flat_files(storage: LocalStorage, source: str, dry_run: bool = False) -> int:
+    moved = 0
+    for item in os.scandir(source):
+        match = FILE_NAME_REGEX.match(item.name)
+        if match is None or not item.is_file():
+            continue
+        key = match.group(1)
+        path = storage.path_for(key)
+        if dry_run:
+            logger.info('{} -> {}'.format(item.path, path))
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(item.path, path)
+            stat_result = os.stat(path)
+            storage._index_put(key, None, stat_result.st_size, stat_result.st_mtime)
+        moved += 1
+    return moved
+
+
+def rebuild_index(storage: LocalStorage) -> int:
+    """ Adds files missing in index and removes entries without files """
+    indexed = {key: audio_id for key, audio_id, _, _ in storage._load_index()}
+    found = 0
+    for directory, _, files in os.walk(storage.root):
+        if os.path.relpath(directory, storage.root).startswith('.'):
+            continue
+        for name in files:
+            match = FILE_NAME_REGEX.match(name)
+            if match is None or directory == storage.root:
+                continue
+            key = match.group(1)
+            stat_result = os.stat(os.path.join(directory, name))
+            storage._index_put(key, indexed.pop(key, None), stat_result.st_size, stat_result.st_mtime)
+            found += 1
+    for key in indexed:
+        storage._index_remove(key)
+    logger.info('Removed {} index entries without files'.format(len(indexed)))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default=PATHS['mp3'], help='flat cache directory')
+    parser.add_argument('--target', default=PATHS['mp3'], help='storage root directory')
+    parser.add_argument('--rebuild-index', action='store_true', help='rebuild index from files on disk')
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be moved')
+    args = parser.parse_args()
+
+    storage = LocalStorage(args.target)
+    os.makedirs(storage.temp_dir, exist_ok=True)
+    storage._open_index()
+    try:
+        moved = migrate_flat_files(storage, args.source, args.dry_run)
+        logger.info('{} {} files'.format('Would move' if args.dry_run else 'Moved', moved))
+        if args.rebuild_index and not args.dry_run:
+            logger.info('Indexed {} files'.format(rebuild_index(storage)))
+    finally:
+        storage._close_index()
+
+
+if __name__ == '__main__':
+    main()
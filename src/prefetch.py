@@ -0,0 +1,177 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+import aiohttp
+
+from scheduler import SchedulerFull, PRIORITY_BACKGROUND
+from settings import PREFETCH_SETTINGS
+from storage import LocalStorage
+from text import clean_page
+from tokens import CAPTCHA_ERROR, RATE_ERROR, FLOOD_ERROR
+from transfer import TransferManager
+from utils import setup_logger
+from vk import SearchService, VkError
+
+
+Job = Tuple[str, str, int]  # kind ('page' or 'tracks'), query, page
+
+RATE_LIMIT_ERRORS = (CAPTCHA_ERROR, RATE_ERROR, FLOOD_ERROR)
+
+
+class Prefetcher:
+    """
+    Background prefetch of the next search page after a cache miss
+    and of the top tracks of popular searches into disk cache.
+    Jobs wait in a bounded queue (new ones are dropped when it is full)
+    and run only while there are no user requests to VK.
+    """
+    logger = setup_logger('prefetch')
+
+    def __init__(self, searcher: SearchService, transfers: TransferManager, storage: LocalStorage,
+                 settings: Dict = None):
+        self._searcher = searcher
+        self._transfers = transfers
+        self._storage = storage
+        self._settings = PREFETCH_SETTINGS if settings is None else settings
+        self._queue = None  # type: asyncio.Queue
+        self._queued = set()
+        self._workers = []
+        # prefetched and not requested yet, for hit rate
+        self._pages = OrderedDict()  # type: OrderedDict[Tuple[str, int], float]
+        self._tracks = OrderedDict()  # type: OrderedDict[str, float]
+        self._searches = OrderedDict()  # type: OrderedDict[Tuple[str, int], int]
+        self._last_request = 0
+        self._paused_until = 0
+        self.dropped = 0
+        self.errors = 0
+        self.pages = 0
+        self.page_hits = 0
+        self.tracks = 0
+        self.track_hits = 0
+
+    async def open(self):
+        self._queue = asyncio.Queue(self._settings['queue_size'])
+        self._workers = [asyncio.ensure_future(self._run()) for _ in range(self._settings['workers'])]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.wait(self._workers)
+        self._workers = []
+
+    def searched(self, query: str, page: int, hit: bool):
+        if not len(query):
+            # random artist, next page would be another artist
+            return
+        key = (query, page)
+        if hit and self._pages.pop(key, None) is not None:
+            self.page_hits += 1
+        if not hit and page + 1 <= self._settings['max_page']:
+            self._schedule(('page', query, page + 1))
+
+        count = self._searches.pop(key, 0) + 1
+        self._searches[key] = count
+        self._trim(self._searches)
+        if count == self._settings['hot_searches']:
+            self._schedule(('tracks', query, page))
+
+    def downloaded(self, key: str):
+        if self._tracks.pop(key, None) is not None:
+            self.track_hits += 1
+
+    def stats(self) -> Dict:
+        return {
+            'queued': len(self._queued),
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'paused': self._paused_until > time.time(),
+            'pages': self.pages,
+            'page_hits': self.page_hits,
+            'page_hit_rate': self.page_hits / self.pages if self.pages else 0,
+            'tracks': self.tracks,
+            'track_hits': self.track_hits,
+            'track_hit_rate': self.track_hits / self.tracks if self.tracks else 0
+        }
+
+    def _schedule(self, job: Job):
+        if self._queue is None or job in self._queued:
+            return
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self._queued.add(job)
+
+    async def _run(self):
+        while True:
+            job = await self._queue.get()
+            kind, query, page = job
+            try:
+                if kind == 'page':
+                    await self._prefetch_page(query, page)
+                else:
+                    await self._prefetch_tracks(query, page)
+            except VkError as e:
+                self.errors += 1
+                if e.code in RATE_LIMIT_ERRORS:
+                    self.logger.info('Prefetch paused: {}'.format(e))
+                    self._paused_until = time.time() + self._settings['backoff']
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.errors += 1
+                self.logger.error('Prefetch failed ({} {}): {}'.format(kind, page, e))
+            finally:
+                self._queued.discard(job)
+
+    async def _wait_turn(self, downloads: bool = False):
+        """ Waits until VK is not used by users and background requests are not too frequent """
+        interval = self._settings['interval']
+        while True:
+            delay = max(self._paused_until, self._last_request + interval) - time.time()
+            if delay <= 0 and not self._searcher.is_busy() and (
+                    not downloads or self._transfers.active < self._settings['max_transfers']
+            ):
+                break
+            await asyncio.sleep(max(delay, interval / 10))
+        self._last_request = time.time()
+
+    async def _prefetch_page(self, query: str, page: int):
+        if self._searcher.peek(query, page) is not None:
+            return
+        await self._wait_turn()
+        if self._searcher.peek(query, page) is not None:
+            return
+        await self._searcher.fetch(query, page, background=True)
+        self.pages += 1
+        self._pages[(query, page)] = time.time()
+        self._trim(self._pages)
+        self.logger.debug('Prefetched page %s of "%s"', page, query)
+
+    async def _prefetch_tracks(self, query: str, page: int):
+        audio_items = self._searcher.peek(query, page)
+        if audio_items is None:
+            return
+        # in the same order as they are shown
+        for audio, _, _ in clean_page(audio_items, query)[:self._settings['top_tracks']]:
+            key = self._storage.key_for(audio.id)
+            if self._transfers.get(audio.id) is not None or os.path.exists(self._storage.path_for(key)):
+                continue
+            await self._wait_turn(downloads=True)
+            try:
+                transfer = self._transfers.start(audio, priority=PRIORITY_BACKGROUND)
+            except SchedulerFull:
+                self.dropped += 1
+                return
+            self.tracks += 1
+            self._tracks[key] = time.time()
+            self._trim(self._tracks)
+            while not transfer.finished:
+                await transfer.wait(transfer.written)
+
+    def _trim(self, items: OrderedDict):
+        while len(items) > self._settings['history_size']:
+            items.popitem(last=False)
@@ -0,0 +1,98 @@
+import email.utils
+from typing import List, Optional, Tuple
+
+ByteRange = Tuple[int, int]  # [start, end)
+
+
+def parse_range_header(value: str, size: Optional[int] = None,
+                       max_ranges: int = 16) -> Optional[List[ByteRange]]:
+    """
+    Parses `Range: bytes=...` header into sorted list of merged [start, end) ranges.
+    Size may be unknown (file is still being downloaded), then only ranges
+    with explicit first and last byte positions are supported.
+
+    Returns None when header must be ignored (malformed, unsupported or too many ranges)
+    and empty list when none of the ranges is satisfiable.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [item.strip() for item in spec.split(',') if item.strip()]
+    if not specs or len(specs) > max_ranges:
+        return None
+
+    ranges = []
+    for item in specs:
+        first, sep, last = item.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:  # suffix range: last N bytes
+            if not last or size is None:
+                return None
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size
+        else:
+            start = int(first)
+            if last:
+                end = int(last) + 1
+                if end <= start:
+                    return None
+            elif size is None:
+                return None
+            else:
+                end = size
+
+        if size is not None:
+            if start >= size:
+                continue
+            end = min(end, size)
+        ranges.append((start, end))
+
+    return _merge_ranges(ranges)
+
+
+def _merge_ranges(ranges: List[ByteRange]) -> List[ByteRange]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def format_content_range(byte_range: Optional[ByteRange], size: Optional[int]) -> str:
+    total = '*' if size is None else size
+    if byte_range is None:
+        return 'bytes */{}'.format(total)
+    return 'bytes {}-{}/{}'.format(byte_range[0], byte_range[1] - 1, total)
+
+
+def parse_http_date(value: str) -> Optional[int]:
+    """ Returns unix timestamp or None if value is not a valid HTTP date """
+    date_tuple = email.utils.parsedate_tz(value)
+    if date_tuple is None:
+        return None
+    return email.utils.mktime_tz(date_tuple)
+
+
+def build_multipart_ranges(ranges: List[ByteRange], size: int, content_type: str,
+                           boundary: str) -> Tuple[List[Tuple[bytes, ByteRange]], bytes]:
+    """
+    Returns (part header, range) pairs and closing delimiter of
+    multipart/byteranges body (RFC 7233, appendix A).
+    """
+    parts = []
+    for byte_range in ranges:
+        header = '--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+            boundary, content_type, format_content_range(byte_range, size)
+        )
+        # every part except the first one starts with CRLF after previous part data
+        if parts:
+            header = '\r\n' + header
+        parts.append((header.encode(), byte_range))
+    return parts, '\r\n--{}--\r\n'.format(boundary).encode()
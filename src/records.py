@@ -0,0 +1,61 @@
+import time
+from typing import NamedTuple, Iterable, Dict, Optional
+
+
+class AudioRecord(NamedTuple):
+    id: str
+    artist: str
+    title: str
+    duration: int
+    mp3: str
+    # owner_id_id (and access key) for audio.getById, empty in records stored by older versions
+    vk_id: str = ''
+    expires: float = 0  # when mp3 url stops working, 0 if unknown
+
+    @classmethod
+    def from_dict(cls, item: Dict) -> 'AudioRecord':
+        return cls(
+            id=item['id'],
+            artist=item['artist'],
+            title=item['title'],
+            duration=item['duration'],
+            mp3=item['mp3'],
+            vk_id=item.get('vk_id', ''),
+            expires=item.get('expires', 0)
+        )
+
+    def is_expired(self, margin: float = 0) -> bool:
+        """ Whether mp3 url expires in `margin` seconds """
+        return bool(self.expires) and self.expires - margin <= time.time()
+
+
+class SearchPage:
+    """
+    Immutable page of search results with id -> record index.
+    Safe to share between requests without copying.
+    """
+    __slots__ = ('items', '_index')
+
+    def __init__(self, items: Iterable[AudioRecord]):
+        items = tuple(items)
+        object.__setattr__(self, 'items', items)
+        object.__setattr__(self, '_index', {item.id: item for item in items})
+
+    def __setattr__(self, key, value):
+        raise AttributeError('SearchPage is immutable')
+
+    def __delattr__(self, item):
+        raise AttributeError('SearchPage is immutable')
+
+    def __reduce__(self):
+        # the index is rebuilt on unpickling
+        return self.__class__, (self.items,)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, audio_id: str) -> Optional[AudioRecord]:
+        return self._index.get(audio_id)
@@ -0,0 +1,105 @@
+import gzip
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from settings import RESPONSE_CACHE_SETTINGS
+from utils import md5
+
+
+ResponseKey = Tuple[str, str, str]  # search cache key, protocol, host
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """ Whether `Accept-Encoding` header allows gzip: listed (or `*`) without q=0 """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+class EncodedResponse:
+    """ Response body encoded once and served as is to every client """
+    __slots__ = ('body', 'gzip_body', 'etag', 'expires')
+
+    def __init__(self, body: bytes, gzip_body: Optional[bytes], expires: float):
+        self.body = body
+        self.gzip_body = gzip_body
+        self.etag = '"{}"'.format(md5(body))
+        self.expires = expires
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + (0 if self.gzip_body is None else len(self.gzip_body))
+
+
+class ResponseCache:
+    """
+    In-process LRU of encoded responses within entries and bytes budget.
+    Responses contain absolute urls, so host is a part of the key.
+    """
+
+    def __init__(self, settings: Dict = None):
+        self._settings = RESPONSE_CACHE_SETTINGS if settings is None else settings
+        self._entries = OrderedDict()  # type: OrderedDict[ResponseKey, EncodedResponse]  # least recent first
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, key: ResponseKey) -> Optional[EncodedResponse]:
+        response = self._entries.get(key)
+        if response is not None and response.expires <= time.time():
+            self._remove(key)
+            response = None
+        if response is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key: ResponseKey, body: bytes) -> EncodedResponse:
+        gzip_body = None
+        if len(body) >= self._settings['gzip_min_size']:
+            gzip_body = gzip.compress(body, self._settings['gzip_level'])
+        response = EncodedResponse(body, gzip_body, time.time() + self._settings['expire'])
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = response
+        self._size += response.size
+        while self._entries and (
+                self._size > self._settings['max_bytes'] or len(self._entries) > self._settings['max_entries']
+        ):
+            self._remove(next(iter(self._entries)))
+            self.evicted += 1
+        return response
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'evicted': self.evicted
+        }
+
+    def _remove(self, key: ResponseKey):
+        self._size -= self._entries.pop(key).size
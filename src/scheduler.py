@@ -0,0 +1,147 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Deque, List
+
+from settings import DOWNLOAD_SETTINGS
+
+
+PRIORITY_STREAM = 0
+PRIORITY_DOWNLOAD = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ('stream', 'download', 'background')
+
+
+class SchedulerFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__('Download queue is full')
+        self.retry_after = retry_after
+
+
+class Ticket:
+    __slots__ = ('client', 'priority', 'created', 'granted', 'released', '_future')
+
+    def __init__(self, client: str, priority: int):
+        self.client = client
+        self.priority = priority
+        self.created = time.monotonic()
+        self.granted = False
+        self.released = False
+        self._future = asyncio.get_event_loop().create_future()
+
+
+class DownloadScheduler:
+    """
+    Limits number of upstream downloads running at the same time.
+    Others wait in a bounded queue: streams first, then downloads, then background ones;
+    clients with the same priority take turns, so one client can not hold up the rest.
+    """
+
+    def __init__(self, settings: Dict = None):
+        self._settings = DOWNLOAD_SETTINGS if settings is None else settings
+        # priority -> client -> tickets, clients in turn order
+        self._queues = [OrderedDict() for _ in PRIORITY_NAMES]  # type: List[OrderedDict[str, Deque[Ticket]]]
+        self._queued_by_client = {}  # type: Dict[str, int]
+        self.active = 0
+        self.queued = 0
+        self.granted = 0
+        self.rejected = 0
+        self.waited = 0  # granted after waiting in queue
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def enqueue(self, client: str, priority: int = PRIORITY_DOWNLOAD) -> Ticket:
+        """ Returns ticket to wait for or raises SchedulerFull """
+        ticket = Ticket(client, priority)
+        if self.active < self._settings['max_active'] and not self.queued:
+            self._grant(ticket)
+            return ticket
+
+        if (
+                self.queued >= self._settings['max_queue'] or
+                self._queued_by_client.get(client, 0) >= self._settings['max_queue_per_client']
+        ):
+            self.rejected += 1
+            raise SchedulerFull(self._settings['retry_after'])
+        self._push(ticket)
+        return ticket
+
+    async def wait(self, ticket: Ticket):
+        if not ticket.granted:
+            await asyncio.shield(ticket._future)
+
+    def promote(self, ticket: Ticket, priority: int):
+        """ Moves waiting ticket into a higher priority queue, e.g. when a stream joins a download """
+        if ticket.granted or ticket.released or priority >= ticket.priority:
+            return
+        self._pop(ticket)
+        ticket.priority = priority
+        self._push(ticket)
+
+    def release(self, ticket: Ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if not ticket.granted:
+            self._pop(ticket)
+            ticket._future.cancel()
+            return
+        self.active -= 1
+        self._grant_next()
+
+    def stats(self) -> Dict:
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'queued_by_priority': {
+                name: sum(map(len, queue.values())) for name, queue in zip(PRIORITY_NAMES, self._queues)
+            },
+            'max_active': self._settings['max_active'],
+            'max_queue': self._settings['max_queue'],
+            'granted': self.granted,
+            'rejected': self.rejected,
+            'avg_wait': self.wait_time / self.waited if self.waited else 0,
+            'max_wait': self.max_wait_time
+        }
+
+    def _push(self, ticket: Ticket):
+        self._queues[ticket.priority].setdefault(ticket.client, deque()).append(ticket)
+        self._queued_by_client[ticket.client] = self._queued_by_client.get(ticket.client, 0) + 1
+        self.queued += 1
+
+    def _pop(self, ticket: Ticket):
+        queue = self._queues[ticket.priority]
+        tickets = queue[ticket.client]
+        tickets.remove(ticket)
+        if not tickets:
+            del queue[ticket.client]
+        self._forget_queued(ticket.client)
+
+    def _forget_queued(self, client: str):
+        self.queued -= 1
+        self._queued_by_client[client] -= 1
+        if not self._queued_by_client[client]:
+            del self._queued_by_client[client]
+
+    def _grant(self, ticket: Ticket):
+        ticket.granted = True
+        self.active += 1
+        self.granted += 1
+        ticket._future.set_result(None)
+
+    def _grant_next(self):
+        while self.active < self._settings['max_active'] and self.queued:
+            queue = next(queue for queue in self._queues if queue)
+            client, tickets = next(iter(queue.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                queue.move_to_end(client)  # next client's turn
+            else:
+                del queue[client]
+            self._forget_queued(client)
+
+            wait_time = time.monotonic() - ticket.created
+            self.waited += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self._grant(ticket)
@@ -1,13 +1,18 @@
-import random
-import re
-from typing import List, Dict
+import asyncio
+from typing import List, Optional, Tuple
 
-from tornado import web
 import aiohttp
+from tornado import web
+from tornado.escape import json_decode, json_encode, utf8
+from tornado.httputil import url_concat
 
 from cache import CachedHandler
-from settings import SEARCH_SETTINGS, HASH, ARTISTS
-from utils import uni_hash, setup_logger, vk_url
+from records import AudioRecord, SearchPage
+from responses import EncodedResponse, accepts_gzip
+from settings import SEARCH_SETTINGS
+from text import clean_page
+from utils import setup_logger
+from vk import VkError
 
 
 class SearchHandler(CachedHandler):
@@ -33,139 +38,141 @@ class SearchHandler(CachedHandler):
         except web.MissingArgumentError:
             captcha_kwargs = {}
 
-        data = await self.search(query, page, **captcha_kwargs)
-        self.write_result(data)
+        response = await self._get_encoded_response(query, page, **captcha_kwargs)
+        self._write_encoded_response(response)
+
+    async def _get_encoded_response(self, query: str, page: int, **kwargs) -> EncodedResponse:
+        # popular pages are encoded once and then served as is
+        responses = self.settings['responses']
+        response_key = (self._get_search_cache_key(query, page), self.request.protocol, self.request.host)
+        response = responses.get(response_key)
+        if response is None:
+            data = await self.search(query, page, **kwargs)
+            response = responses.put(response_key, utf8(json_encode({'success': 1, 'data': data})))
+        else:
+            self._notify_prefetcher(query, page, True)
+        return response
+
+    def _write_encoded_response(self, response: EncodedResponse):
+        body, etag = response.body, response.etag
+        if response.gzip_body is not None and accepts_gzip(self.request.headers.get('Accept-Encoding', '')):
+            self.set_header('Content-Encoding', 'gzip')
+            body, etag = response.gzip_body, '{}-gzip"'.format(etag[:-1])
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+        else:
+            self.finish(body)
 
     async def search(self, query: str, page: int, **kwargs):
-        cache_key = self._get_search_cache_key(query, page)  # TODO do not cache random
-        cached_result = self._get_cached_search_result(cache_key)
-        if cached_result is not None:
-            return self._transform_search_response(query, page, cached_result)
-
-        response = await self._get_search_results(
-            query, offset=page * SEARCH_SETTINGS['page_size'], **kwargs
-        )
-        self._raise_for_error(response)
-        audio_items = self._get_audio_items(response)
-
-        self._cache_search_result(cache_key, audio_items)
+        searcher = self.settings['searcher']
+        audio_items = searcher.get_cached(query, page)
+        hit = audio_items is not None
+        if not hit:
+            try:
+                audio_items = await searcher.fetch(query, page, **kwargs)
+            except VkError as e:
+                # captcha fields are passed as (name, value) pairs, they are added to the error response
+                raise web.HTTPError(400, None, *(e.captcha or {}).items(), reason=str(e))
+        self._notify_prefetcher(query, page, hit)
         return self._transform_search_response(query, page, audio_items)
 
-    async def _get_search_results(self, query: str, offset: int, **kwargs):
-        if not len(query):
-            query = self._random_artist()
-
-        headers = {'User-Agent': SEARCH_SETTINGS['user_agent']}
-        params = {
-            'access_token': SEARCH_SETTINGS['access_token'],
-            'q': query,
-            'offset': offset,
-            # 'sort': 2,
-            'count': SEARCH_SETTINGS['page_size'],
-            'v': '5.72'
-        }
-
-        if 'captcha_key' in kwargs and 'captcha_sid' in kwargs:
-            params.update({
-                'captcha_sid': kwargs['captcha_sid'],
-                'captcha_key': kwargs['captcha_key']
-            })
-
-        self.logger.debug('Requesting search results (size={}) from vk...'.format(
-            SEARCH_SETTINGS['page_size']
-        ))
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                    url=vk_url('method/audio.search'),
-                    headers=headers,
-                    params=params
-            ) as response:
-                result = await response.json()
-
-        return result
-
-    def _raise_for_error(self, response: dict):
-        if 'error' not in response:
-            return
-        error_data = response['error']
-        error_message = '({code}) {message}'.format(
-            code=error_data['error_code'],
-            message=error_data['error_msg']
-        )
-        if error_data['error_code'] == 14:  # captcha
-            args = {
-                'captcha_sid': int(error_data['captcha_sid']),
-                'captcha_img': error_data['captcha_img']
-            }
-        else:
-            args = {}
-        self.logger.error(error_message)
-        raise web.HTTPError(
-            status_code=400,
-            reason=error_message,
-            args=args
-        )
-
-    @staticmethod
-    def _random_artist():
-        return random.choice(ARTISTS)
-
-    @staticmethod
-    def _get_audio_items(response: dict):
-        result = []
-        for audio_item in response['response']['items']:
-            if not len(audio_item['url']):
-                continue
-
-            result.append({
-                'id': uni_hash(HASH['id'], str(audio_item['id'])),
-                'artist': audio_item['artist'],
-                'title': audio_item['title'],
-                'duration': audio_item['duration'],
-                'mp3': audio_item['url']
-            })
-
-        return result
-
-    def _transform_search_response(self, query: str, page: int, data: List[Dict]):
-        self.logger.debug('Transforming search response...')
-        sortable = not self._is_bad_match([query])
+    def _notify_prefetcher(self, query: str, page: int, hit: bool):
+        prefetcher = self.settings['prefetcher']
+        if prefetcher is not None:
+            prefetcher.searched(query, page, hit)
 
-        head, tail = [], []
+    def _transform_search_response(self, query: str, page: int, data: SearchPage):
+        self.logger.debug('Transforming search response...')
         cache_key = self._get_search_cache_key(query, page)
-        for audio in data:
-            download_url = self.reverse_full_url('download', cache_key, audio['id'])
-            stream_url = self.reverse_full_url('stream', cache_key, audio['id'])
-            artist = self._clean_audio_string(audio['artist'])
-            title = self._clean_audio_string(audio['title'])
-            duration = audio['duration']
-
-            audio = {
+        return [
+            {
                 'artist': artist,
                 'title': title,
-                'duration': duration,
-                'download': download_url,
-                'stream': stream_url
+                'duration': audio.duration,
+                'download': self._reverse_audio_url('download', cache_key, audio),
+                'stream': self._reverse_audio_url('stream', cache_key, audio)
             }
-
-            if sortable and self._is_bad_match([artist, title]):
-                tail.append(audio)
+            for audio, artist, title in clean_page(data, query)
+        ]
+
+    def _reverse_audio_url(self, name: str, cache_key: str, audio: AudioRecord) -> str:
+        url = self.reverse_full_url(name, cache_key, audio.id)
+        # link keeps working after search is expired: fresh mp3 url is requested from VK by this id
+        return url_concat(url, {'vk': audio.vk_id}) if audio.vk_id else url
+
+
+# noinspection PyAbstractClass
+class BatchSearchHandler(SearchHandler):
+    """
+    Resolves many searches in one request: {"queries": [{"q": "...", "page": 0}, ...]}.
+    Results are streamed as NDJSON lines in completion order, cached pages come first.
+    """
+    SUPPORTED_METHODS = ('POST',)
+
+    async def post(self, *args, **kwargs):
+        queries = self._parse_queries()
+        self.set_header('Content-Type', 'application/x-ndjson')
+        searcher = self.settings['searcher']
+        semaphore = asyncio.Semaphore(SEARCH_SETTINGS['batch_concurrency'])
+        tasks = []
+        for index, (query, page) in enumerate(queries):
+            if searcher.peek(query, page) is not None:
+                self.write(await self._resolve(index, query, page))
             else:
-                head.append(audio)
-
-        return head + tail
+                tasks.append(asyncio.ensure_future(self._resolve(index, query, page, semaphore)))
+        await self.flush()
 
-    @staticmethod
-    def _is_bad_match(strings: List[str]):
-        if len(''.join(strings)) > 100:
-            return True
-
-        for string in strings:
-            if re.search(SEARCH_SETTINGS['sort_regex'], string):
-                return True
-
-        return False
+        try:
+            for task in asyncio.as_completed(tasks):
+                self.write(await task)
+                await self.flush()
+        finally:
+            for task in tasks:
+                task.cancel()
+        self.finish()
+
+    def _parse_queries(self) -> List[Tuple[str, int]]:
+        try:
+            queries = json_decode(self.request.body)['queries']
+            queries = [(item.get('q', ''), item.get('page', 0)) for item in queries]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise web.HTTPError(status_code=400, reason='Body must be {"queries": [{"q": "...", "page": 0}, ...]}')
 
-    @staticmethod
-    def _clean_audio_string(string: str):
-        return re.sub(SEARCH_SETTINGS['bad_words_regex'], '', string)
+        if len(queries) > SEARCH_SETTINGS['batch_max_queries']:
+            raise web.HTTPError(
+                status_code=400,
+                reason='At most {} queries are allowed'.format(SEARCH_SETTINGS['batch_max_queries'])
+            )
+        for query, page in queries:
+            # JSON true/false are ints in Python
+            if not isinstance(query, str) or not isinstance(page, int) or isinstance(page, bool) or page < 0:
+                raise web.HTTPError(
+                    status_code=400,
+                    reason='\'q\' must be a string and \'page\' a non-negative integer'
+                )
+        return queries
+
+    async def _resolve(self, index: int, query: str, page: int,
+                       semaphore: Optional[asyncio.Semaphore] = None) -> bytes:
+        """ Returns NDJSON line with search result or error """
+        try:
+            if semaphore is None:
+                body = (await self._get_encoded_response(query, page)).body
+            else:
+                async with semaphore:
+                    body = (await self._get_encoded_response(query, page)).body
+        except web.HTTPError as e:
+            error = {'success': 0, 'error': e.reason, 'error_code': e.status_code}
+            error.update(e.args)  # the same as in write_error
+            body = utf8(json_encode(error))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.error('Search failed ({}): {}'.format(query, e))
+            body = utf8(json_encode({'success': 0, 'error': 'Search failed', 'error_code': 502}))
+
+        # result is already encoded, so it is put into the line as is
+        head = json_encode({'index': index, 'q': query, 'page': page})
+        return utf8(head[:-1]) + b', "result": ' + body + b'}\n'
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import sqlite3
+import time
+from typing import Callable, Awaitable, Dict, Hashable, Any, Optional, Tuple
+
+
+class SingleFlight:
+    """
+    Registry of in-flight operations: concurrent callers with the same key
+    wait for a single operation and share its result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}  # type: Dict[Hashable, asyncio.Future]
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]):
+        future = self._calls.get(key)
+        if future is None:
+            self.leaders += 1
+            future = asyncio.ensure_future(factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.followers += 1
+
+        # operation keeps running even if the caller goes away
+        return await asyncio.shield(future)
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()  # mark as retrieved if nobody waits anymore
+
+    def stats(self) -> Dict:
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'followers': self.followers
+        }
+
+
+class ProcessLeases:
+    """
+    Leases in sqlite database shared by worker processes: only the process holding
+    a lease performs the operation, others wait for its result.
+    Leases expire, so a crashed process does not block others forever.
+    Lease may carry data for the waiting processes (for ex. path of the file being downloaded).
+    """
+
+    def __init__(self, data_dir: str, poll_interval: float = 0.05):
+        os.makedirs(data_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(data_dir, 'leases.sqlite'), timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            'key TEXT PRIMARY KEY, owner INTEGER NOT NULL, expires REAL NOT NULL, data TEXT'
+            ') WITHOUT ROWID'
+        )
+        if 'data' not in [row[1] for row in self._db.execute('PRAGMA table_info(leases)')]:
+            try:
+                self._db.execute('ALTER TABLE leases ADD COLUMN data TEXT')
+            except sqlite3.OperationalError:
+                pass  # added by other process right now
+        self._db.commit()
+        self._owner = os.getpid()
+        self.poll_interval = poll_interval
+        self.acquired = 0
+        self.waited = 0
+
+    def acquire(self, key: str, ttl: float, data: Optional[str] = None) -> bool:
+        now = time.time()
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT INTO leases (key, owner, expires, data) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires, '
+                'data = excluded.data WHERE leases.expires <= ?',
+                (key, self._owner, now + ttl, data, now)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, key: str):
+        with self._db:
+            self._db.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, self._owner))
+
+    def get(self, key: str) -> Optional[Tuple[int, Optional[str]]]:
+        """ Owner and data of the lease if it is held. Read only, it does not wait for writers like acquire does """
+        return self._db.execute(
+            'SELECT owner, data FROM leases WHERE key = ? AND expires > ?', (key, time.time())
+        ).fetchone()
+
+    def is_held(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    async def acquire_or_wait(self, key: str, ttl: float, lookup: Callable[[], Any], data: Optional[str] = None,
+                              follow: Optional[Callable[[str], Awaitable[Any]]] = None):
+        """
+        Returns result of lookup() as soon as other process has produced it,
+        or None when the lease is acquired (with `data`) and caller must do the operation and release the lease.
+        When other process holds the lease with data, result of follow(data) is returned unless it is None.
+        """
+        waited = False
+        followed = None
+        while True:
+            # lease is written only when it looks free, waiting processes just read it
+            lease = self.get(key)
+            if lease is None and self.acquire(key, ttl, data):
+                break
+            if not waited:
+                waited = True
+                self.waited += 1
+            if follow is not None and lease is not None and lease[1] is not None and lease[1] != followed:
+                followed = lease[1]
+                result = await follow(followed)
+                if result is not None:
+                    return result
+                continue
+            await asyncio.sleep(self.poll_interval)
+            result = lookup()
+            if result is not None:
+                return result
+
+        # other process could finish right before the lease was acquired
+        result = lookup() if waited else None
+        if result is not None:
+            self.release(key)
+            return result
+        self.acquired += 1
+        return None
+
+    def close(self):
+        self._db.close()
+
+    def stats(self) -> Dict:
+        return {
+            'acquired': self.acquired,
+            'waited': self.waited
+        }
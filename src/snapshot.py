@@ -0,0 +1,175 @@
+"""
+Snapshots of in-memory state (search pages, disk cache access times) in files,
+so restarted app starts with warm caches instead of sending every search to VK again.
+
+Snapshot file is zlib compressed stream of length prefixed pickled records. It is written
+by a thread from a copy of records and read back in batches, so neither saving nor loading
+blocks the event loop and requests are served while snapshots are still loading.
+"""
+import asyncio
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from settings import SNAPSHOT_SETTINGS
+from utils import setup_logger
+
+
+SnapshotRecord = Tuple[str, Optional[float], Any]  # key, expiration time (None for never), value
+
+MAGIC = b'TMSNAP1\n'
+LENGTH = struct.Struct('<I')
+READ_SIZE = 256 * 1024
+
+
+def write_snapshot(path: str, records: List[SnapshotRecord], level: int = 1) -> int:
+    """ Blocking. Replaces snapshot file atomically, returns its size """
+    # periodic save cancelled on close may still be writing in other thread
+    temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    compressor = zlib.compressobj(level)
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        for record in records:
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            f.write(compressor.compress(LENGTH.pack(len(data)) + data))
+        f.write(compressor.flush())
+    os.replace(temp_path, path)
+    return os.path.getsize(path)
+
+
+def read_snapshot(path: str, batch_size: int) -> Iterator[List[SnapshotRecord]]:
+    """ Blocking. Yields batches of records which are not expired yet """
+    decompressor = zlib.decompressobj()
+    batch = []
+    now = time.time()
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a snapshot file: {}'.format(path))
+        buffer = b''
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            buffer += decompressor.decompress(block)
+            position = 0
+            while position + LENGTH.size <= len(buffer):
+                length, = LENGTH.unpack_from(buffer, position)
+                end = position + LENGTH.size + length
+                if end > len(buffer):
+                    break
+                record = pickle.loads(buffer[position + LENGTH.size:end])
+                position = end
+                if record[1] is None or record[1] > now:
+                    batch.append(record)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            buffer = buffer[position:]
+        if not decompressor.eof or buffer:
+            raise EOFError('Snapshot is truncated')
+    if batch:
+        yield batch
+
+
+class Snapshots:
+    """
+    Saves state of sources periodically and on close, restores it on open.
+    Source is any object with `snapshot() -> List[SnapshotRecord]` and `restore(records)` methods.
+    Sources are saved only after their snapshot is loaded, so a restart during loading keeps the old one.
+    """
+    logger = setup_logger('snapshot')
+
+    def __init__(self, directory: str, settings: Dict = None):
+        self._directory = directory
+        self._settings = SNAPSHOT_SETTINGS if settings is None else settings
+        self._sources = {}  # type: Dict[str, Any]
+        self._loaded = set()
+        self._task = None  # type: Optional[asyncio.Future]
+        self.restored = 0
+        self.saved = 0
+        self.saved_bytes = 0
+        self.errors = 0
+        self.last_save = 0.0
+
+    def add(self, name: str, source):
+        self._sources[name] = source
+
+    async def open(self):
+        os.makedirs(self._directory, exist_ok=True)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+        await self.save()
+
+    async def save(self):
+        loop = asyncio.get_event_loop()
+        for name in [name for name in self._sources if name in self._loaded]:
+            # records are copied here, then pickled and written by a thread
+            records = self._sources[name].snapshot()
+            started = time.time()
+            try:
+                size = await loop.run_in_executor(
+                    None, write_snapshot, self._path(name), records, self._settings['compression']
+                )
+            except (OSError, pickle.PicklingError) as e:
+                self.errors += 1
+                self.logger.error('Snapshot of {} failed: {}'.format(name, e))
+                continue
+            self.saved += 1
+            self.saved_bytes = size
+            self.last_save = time.time()
+            self.logger.debug(
+                'Saved %s records of %s (%.2fMB, %.2fs)', len(records), name, size / 1024 ** 2, time.time() - started
+            )
+
+    def stats(self) -> Dict:
+        return {
+            'loading': len(self._loaded) < len(self._sources),
+            'restored': self.restored,
+            'saved': self.saved,
+            'saved_bytes': self.saved_bytes,
+            'errors': self.errors,
+            'last_save': self.last_save
+        }
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, '{}.snapshot'.format(name))
+
+    async def _run(self):
+        for name, source in self._sources.items():
+            await self._load(name, source)
+            self._loaded.add(name)
+        while True:
+            await asyncio.sleep(self._settings['interval'])
+            await self.save()
+
+    async def _load(self, name: str, source):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return
+        loop = asyncio.get_event_loop()
+        started = time.time()
+        restored = 0
+        batches = read_snapshot(path, self._settings['batch_size'])
+        try:
+            while True:
+                # every batch is read and unpickled by a thread, requests are served in between
+                batch = await loop.run_in_executor(None, next, batches, None)
+                if batch is None:
+                    break
+                source.restore(batch)
+                restored += len(batch)
+        except (OSError, ValueError, EOFError, zlib.error, pickle.UnpicklingError, AttributeError, ImportError) as e:
+            # records read before damaged part are kept
+            self.errors += 1
+            self.logger.error('Snapshot of {} is damaged: {}'.format(name, e))
+        self.restored += restored
+        self.logger.info('Restored {} records of {} ({:.02f}s)'.format(restored, name, time.time() - started))
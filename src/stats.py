@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Callable, Optional
+
+from tornado import web
+
+from metrics import METRICS, Family, stats_families, merge_families, worker_label
+from settings import METRICS_SETTINGS
+from utils import setup_logger, BasicHandler
+
+
+def collect_metrics(stats_sources: Dict, extra: str = '') -> List[Family]:
+    """ Metrics and stats of app services of this process """
+    families = [metric.family(extra) for metric in METRICS]
+    for name, source in stats_sources.items():
+        families.extend(stats_families(name, source.stats(), extra))
+    return families
+
+
+# noinspection PyAbstractClass
+class StatsHandler(BasicHandler):
+    logger = setup_logger('stats')
+
+    @web.addslash
+    def get(self, *args, **kwargs):
+        self.write_result({
+            name: source.stats() for name, source in self.settings['stats_sources'].items()
+        })
+
+
+# noinspection PyAbstractClass
+class MetricsHandler(BasicHandler):
+    """ Metrics and stats of app services in Prometheus text format """
+    logger = setup_logger('stats')
+
+    @web.addslash
+    def get(self, *args, **kwargs):
+        shared_metrics = self.settings.get('shared_metrics')
+        if shared_metrics is not None:
+            lines = shared_metrics.render()
+        else:
+            lines = merge_families(collect_metrics(self.settings['stats_sources']))
+        lines.append('')
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish('\n'.join(lines))
+
+
+class SharedMetrics:
+    """
+    Metrics of worker processes in sqlite database shared by them. Every worker publishes
+    its own metrics (labelled with its number) periodically and before rendering,
+    so /metrics answered by any worker has samples of all of them.
+    Metrics of a worker which stopped publishing expire.
+    """
+    logger = setup_logger('stats')
+
+    def __init__(self, data_dir: str, worker: int, collect: Callable[[str], List[Family]], settings: Dict = None):
+        """ collect(extra_label) returns metrics of this process """
+        self._settings = METRICS_SETTINGS if settings is None else settings
+        os.makedirs(data_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(data_dir, 'metrics.sqlite'), timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            'worker INTEGER PRIMARY KEY, expires REAL NOT NULL, data TEXT NOT NULL'
+            ')'
+        )
+        self._db.commit()
+        self._worker = worker
+        self._collect = collect
+        self._task = None  # type: Optional[asyncio.Future]
+
+    async def open(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+        with self._db:
+            self._db.execute('DELETE FROM metrics WHERE worker = ?', (self._worker,))
+        self._db.close()
+
+    def publish(self):
+        data = json.dumps(self._collect(worker_label(self._worker)))
+        expires = time.time() + 3 * self._settings['publish_interval']
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO metrics (worker, expires, data) VALUES (?, ?, ?)', (self._worker, expires, data)
+            )
+
+    def render(self) -> List[str]:
+        """ Fresh metrics of this worker and the last published ones of others """
+        self.publish()
+        rows = self._db.execute(
+            'SELECT data FROM metrics WHERE expires > ? ORDER BY worker', (time.time(),)
+        ).fetchall()
+        return merge_families(family for data, in rows for family in json.loads(data))
+
+    async def _run(self):
+        while True:
+            try:
+                self.publish()
+            except sqlite3.Error as e:
+                self.logger.error('Publishing of metrics failed: {}'.format(e))
+            await asyncio.sleep(self._settings['publish_interval'])
+
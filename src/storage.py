@@ -0,0 +1,256 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Optional
+
+from frames import frames_path
+from settings import HASH, STORAGE_SETTINGS
+from utils import uni_hash, setup_logger
+
+
+IndexEntry = Tuple[str, Optional[str], int, float]  # key, audio id, size, mtime
+AccessEntry = Tuple[str, float, int]  # key, last access, hits
+
+
+class LocalStorage:
+    """
+    Audio files layout on local disk: files are named by hash of audio id (key)
+    and spread over two levels of fan-out directories (ab/cd/abcd....mp3).
+    Compact sqlite index (key -> audio id, size, mtime) makes startup independent of directory scans.
+    """
+    logger = setup_logger('storage')
+
+    INDEX_NAME = 'index.sqlite'
+    TEMP_DIR = '.tmp'
+
+    def __init__(self, root: str, settings: Dict = None):
+        self.root = root
+        self.temp_dir = os.path.join(root, self.TEMP_DIR)
+        self._settings = STORAGE_SETTINGS if settings is None else settings
+        self._db = None  # type: Optional[sqlite3.Connection]
+        # single thread owns sqlite connection, so index writes never block event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage-index')
+
+    @staticmethod
+    def key_for(audio_id: str) -> str:
+        return uni_hash(HASH['mp3'], audio_id)
+
+    def path_for(self, key: str) -> str:
+        levels = self._settings['fan_out_levels']
+        shards = [key[2 * level:2 * level + 2] for level in range(levels)]
+        return os.path.join(self.root, *shards, '{}.mp3'.format(key))
+
+    def file_path(self, audio_id: str) -> str:
+        return self.path_for(self.key_for(audio_id))
+
+    def frames_path_for(self, key: str) -> str:
+        """ Frame index of the file, for seeking """
+        return frames_path(self.path_for(key))
+
+    def temp_file(self) -> str:
+        fd, path = tempfile.mkstemp(prefix='.part-', suffix='.mp3', dir=self.temp_dir)
+        os.close(fd)
+        return path
+
+    def commit_file(self, temp_path: str, key: str, audio_id: Optional[str] = None,
+                    frames: Optional[bytes] = None) -> int:
+        """ Moves complete file (and its frame index) into its place, returns file size """
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if frames is not None:
+            # index is in place before the file appears
+            frames_temp_path = frames_path(temp_path)
+            with open(frames_temp_path, 'wb') as f:
+                f.write(frames)
+            os.replace(frames_temp_path, frames_path(path))
+        os.replace(temp_path, path)
+        stat_result = os.stat(path)
+        self.index_put(key, audio_id, stat_result.st_size, stat_result.st_mtime)
+        return stat_result.st_size
+
+    async def open(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        await self._run(self._open_index)
+
+    async def close(self):
+        await self._run(self._close_index)
+
+    def index_put(self, key: str, audio_id: Optional[str], size: int, mtime: float):
+        self._executor.submit(self._index_put, key, audio_id, size, mtime)
+
+    def index_remove(self, key: str):
+        self._executor.submit(self._index_remove, key)
+
+    async def load_index(self, since: Optional[float] = None) -> List[IndexEntry]:
+        """ All files or files modified after `since` """
+        return await self._run(self._load_index, since)
+
+    def index_accesses(self, accesses: List[AccessEntry]):
+        """ Saves accesses of files for the process which evicts them """
+        self._executor.submit(self._index_accesses, accesses)
+
+    async def pop_accesses(self) -> List[AccessEntry]:
+        """ Accesses saved by all processes since the last call """
+        return await self._run(self._pop_accesses)
+
+    def _run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    # Blocking methods below are also used by the migration tool directly
+
+    def _open_index(self):
+        self._db = sqlite3.connect(os.path.join(self.root, self.INDEX_NAME), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'key TEXT PRIMARY KEY, audio_id TEXT, size INTEGER NOT NULL, mtime REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS accesses ('
+            'key TEXT PRIMARY KEY, last_access REAL NOT NULL, hits INTEGER NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self._db.commit()
+
+    def _close_index(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _index_put(self, key: str, audio_id: Optional[str], size: int, mtime: float):
+        with self._db:
+            self._db.execute(
+                'INSERT INTO files (key, audio_id, size, mtime) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET '
+                'audio_id = COALESCE(excluded.audio_id, audio_id), size = excluded.size, mtime = excluded.mtime',
+                (key, audio_id, size, mtime)
+            )
+
+    def _index_remove(self, key: str):
+        with self._db:
+            self._db.execute('DELETE FROM files WHERE key = ?', (key,))
+
+    def _load_index(self, since: Optional[float] = None) -> List[IndexEntry]:
+        if since is None:
+            return self._db.execute('SELECT key, audio_id, size, mtime FROM files').fetchall()
+        return self._db.execute('SELECT key, audio_id, size, mtime FROM files WHERE mtime > ?', (since,)).fetchall()
+
+    def _index_accesses(self, accesses: List[AccessEntry]):
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO accesses (key, last_access, hits) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET '
+                'last_access = MAX(last_access, excluded.last_access), hits = hits + excluded.hits',
+                accesses
+            )
+
+    def _pop_accesses(self) -> List[AccessEntry]:
+        with self._db:
+            # other processes must not add accesses between select and delete
+            self._db.execute('BEGIN IMMEDIATE')
+            accesses = self._db.execute('SELECT key, last_access, hits FROM accesses').fetchall()
+            self._db.execute('DELETE FROM accesses')
+        return accesses
+
+
+class S3Storage:
+    """
+    Durable copy of audio files in S3-compatible storage (AWS, minio, etc.).
+    Local disk stays a cache in front of it: files missing locally are fetched
+    from S3 before going to VK, new files are uploaded in background.
+    """
+    logger = setup_logger('storage')
+
+    def __init__(self, settings: Dict = None):
+        settings = STORAGE_SETTINGS['s3'] if settings is None else settings
+        try:
+            import boto3
+            from boto3.exceptions import S3UploadFailedError
+            from botocore.exceptions import BotoCoreError, ClientError
+        except ImportError:
+            raise RuntimeError('boto3 is required for S3 storage')
+
+        self._client_error = ClientError
+        # connection, credentials and upload errors are not ClientError
+        self._errors = (BotoCoreError, ClientError, S3UploadFailedError)
+        self._client = boto3.client(
+            's3',
+            endpoint_url=settings['endpoint_url'],
+            region_name=settings['region'],
+            aws_access_key_id=settings['access_key'],
+            aws_secret_access_key=settings['secret_key']
+        )
+        self._bucket = settings['bucket']
+        self._prefix = settings['prefix']
+        self._url_ttl = settings['url_ttl']
+        self._executor = ThreadPoolExecutor(max_workers=settings['threads'], thread_name_prefix='s3')
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.errors = 0
+
+    def object_key(self, key: str) -> str:
+        return '{}{}.mp3'.format(self._prefix, key)
+
+    async def get_url(self, key: str) -> Optional[str]:
+        """ Returns presigned download url or None if there is no such file or S3 is not available """
+        try:
+            await self._run(self._client.head_object, Bucket=self._bucket, Key=self.object_key(key))
+            url = self._client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': self._bucket, 'Key': self.object_key(key)},
+                ExpiresIn=self._url_ttl
+            )
+        except self._errors as e:
+            if not self._is_missing(e):
+                self.errors += 1
+                self.logger.error('S3 request failed: {}'.format(e))
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return url
+
+    async def upload(self, key: str, path: str):
+        started = time.time()
+        try:
+            await self._run(
+                self._client.upload_file, path, self._bucket, self.object_key(key),
+                ExtraArgs={'ContentType': 'audio/mpeg'}
+            )
+        except self._errors + (IOError,) as e:
+            self.errors += 1
+            self.logger.error('S3 upload failed ({}): {}'.format(key, e))
+            return
+        self.uploads += 1
+        self.logger.debug('Uploaded to S3: %s (%.02fs)', key, time.time() - started)
+
+    def stats(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'uploads': self.uploads,
+            'errors': self.errors
+        }
+
+    def _is_missing(self, error: Exception) -> bool:
+        return isinstance(error, self._client_error) and (
+            error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+        )
+
+    def _run(self, func, *args, **kwargs):
+        return asyncio.get_event_loop().run_in_executor(
+            self._executor, lambda: func(*args, **kwargs)
+        )
+
+
+def create_remote_storage() -> Optional[S3Storage]:
+    if STORAGE_SETTINGS['backend'] == 's3':
+        return S3Storage()
+    return None
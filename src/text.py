@@ -0,0 +1,82 @@
+"""
+Cleaning and classification of audio metadata strings.
+Patterns are compiled once and results are memoized,
+as the same artists and titles come up in search results again and again.
+"""
+import re
+from functools import lru_cache
+from typing import Iterable, List, Tuple, Optional
+
+from unidecode import unidecode
+
+from records import AudioRecord
+from settings import SEARCH_SETTINGS, TEXT_SETTINGS
+
+
+BAD_CHARS = '~`!@#$%^&*()_=+[{]}\\|;:"\'—–,<>/?‘’“”'
+
+SORT_REGEX = re.compile(SEARCH_SETTINGS['sort_regex'])
+BAD_WORDS_REGEX = re.compile(SEARCH_SETTINGS['bad_words_regex'])
+BAD_CHARS_REGEX = re.compile('[{}]'.format(re.escape(BAD_CHARS)))
+WORDS_REGEX = re.compile(r'\w+')
+SPACES_REGEX = re.compile(r'\s+')
+
+MAX_MATCH_LENGTH = 100
+
+CleanAudio = Tuple[AudioRecord, str, str]  # record, clean artist, clean title
+
+
+@lru_cache(maxsize=TEXT_SETTINGS['cache_size'])
+def clean_audio_string(string: str) -> str:
+    return BAD_WORDS_REGEX.sub('', string)
+
+
+@lru_cache(maxsize=TEXT_SETTINGS['cache_size'])
+def is_bad_string(string: str) -> bool:
+    return SORT_REGEX.search(string) is not None
+
+
+def is_bad_match(strings: Iterable[str]) -> bool:
+    """ Remixes, covers, etc. and too long names are worse matches than originals """
+    strings = list(strings)
+    if sum(map(len, strings)) > MAX_MATCH_LENGTH:
+        return True
+    return any(map(is_bad_string, strings))
+
+
+def clean_page(audios: Iterable[AudioRecord], query: str) -> List[CleanAudio]:
+    """
+    Cleans artists and titles of a whole page in one pass
+    and moves bad matches to the end unless query itself is one.
+    """
+    sortable = not is_bad_match([query])
+    head, tail = [], []
+    for audio in audios:
+        artist = clean_audio_string(audio.artist)
+        title = clean_audio_string(audio.title)
+        if sortable and is_bad_match([artist, title]):
+            tail.append((audio, artist, title))
+        else:
+            head.append((audio, artist, title))
+    return head + tail
+
+
+@lru_cache(maxsize=TEXT_SETTINGS['cache_size'])
+def sanitize(string: str, to_lower: bool = True, alpha_numeric_only: bool = False,
+             truncate: Optional[int] = None) -> str:
+    if alpha_numeric_only:
+        string = WORDS_REGEX.sub('', string)
+    else:
+        string = BAD_CHARS_REGEX.sub('', string)
+
+    string = unidecode(string)  # transliteration and other staff: converts to ascii
+    string = string.strip()
+    string = SPACES_REGEX.sub(' ', string)
+
+    if to_lower:
+        string = string.lower()
+    if truncate is not None:
+        string = string[:truncate]
+
+    return string
+
@@ -0,0 +1,289 @@
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from settings import TOKEN_SETTINGS
+from utils import setup_logger, md5
+
+
+CAPTCHA_ERROR = 14
+RATE_ERROR = 6  # too many requests per second
+FLOOD_ERROR = 9  # flood control
+
+
+class TokenBucket:
+    """ Allows `rate` operations per second on average and up to `burst` at once """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    @property
+    def tokens(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._tokens
+
+    def take(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def delay(self) -> float:
+        """ Seconds until next operation is allowed """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class SharedTokenState:
+    """
+    Rate limits, cooldowns and captchas of access tokens in sqlite database shared by worker processes,
+    so every token is used within its rate limit by all of them together.
+    Tokens are identified by hashes of their values, values themselves are not stored.
+    """
+
+    MAX_CAPTCHAS = 1000  # remembered captcha ids
+
+    def __init__(self, data_dir: str):
+        os.makedirs(data_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(data_dir, 'tokens.sqlite'), timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, cooldown_until REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS captchas ('
+            'sid TEXT PRIMARY KEY, key TEXT NOT NULL, created REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self._db.commit()
+
+    def add_bucket(self, key: str, burst: int):
+        with self._db:
+            self._db.execute(
+                'INSERT OR IGNORE INTO buckets (key, tokens, updated, cooldown_until) VALUES (?, ?, ?, 0)',
+                (key, burst, time.time())
+            )
+
+    def level(self, key: str, rate: float, burst: int) -> float:
+        """ Tokens in the bucket right now """
+        row = self._db.execute(
+            'SELECT MIN(?, tokens + (? - updated) * ?) FROM buckets WHERE key = ?', (burst, time.time(), rate, key)
+        ).fetchone()
+        return burst if row is None else row[0]
+
+    def take(self, key: str, rate: float, burst: int) -> bool:
+        # refill and take in one statement, so other processes can not take the same token
+        with self._db:
+            cursor = self._db.execute(
+                'UPDATE buckets SET tokens = MIN(:burst, tokens + (:now - updated) * :rate) - 1, updated = :now '
+                'WHERE key = :key AND tokens + (:now - updated) * :rate >= 1',
+                {'key': key, 'rate': rate, 'burst': burst, 'now': time.time()}
+            )
+        return cursor.rowcount == 1
+
+    def cooldowns(self) -> Dict[str, float]:
+        """ Time (from time.time()) until which tokens are out of rotation """
+        return dict(self._db.execute('SELECT key, cooldown_until FROM buckets'))
+
+    def cool_down(self, key: str, until: float):
+        with self._db:
+            self._db.execute('UPDATE buckets SET cooldown_until = ? WHERE key = ?', (until, key))
+
+    def add_captcha(self, sid: str, key: str):
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO captchas (sid, key, created) VALUES (?, ?, ?)', (sid, key, time.time())
+            )
+            self._db.execute(
+                'DELETE FROM captchas WHERE sid NOT IN (SELECT sid FROM captchas ORDER BY created DESC LIMIT ?)',
+                (self.MAX_CAPTCHAS,)
+            )
+
+    def pop_captcha(self, sid: str) -> Optional[str]:
+        """ Key of the token which got the captcha """
+        with self._db:
+            row = self._db.execute('SELECT key FROM captchas WHERE sid = ?', (sid,)).fetchone()
+            if row is not None:
+                self._db.execute('DELETE FROM captchas WHERE sid = ?', (sid,))
+        return None if row is None else row[0]
+
+    def close(self):
+        self._db.close()
+
+
+class SharedTokenBucket(TokenBucket):
+    """ Token bucket kept in shared state """
+
+    def __init__(self, state: SharedTokenState, key: str, rate: float, burst: int):
+        super().__init__(rate, burst)
+        self._state = state
+        self._key = key
+        state.add_bucket(key, burst)
+
+    @property
+    def tokens(self) -> float:
+        return self._state.level(self._key, self.rate, self.burst)
+
+    def take(self) -> bool:
+        return self._state.take(self._key, self.rate, self.burst)
+
+
+class AccessToken:
+    def __init__(self, value: str, bucket: TokenBucket):
+        self.value = value
+        self.key = md5(value)
+        self.bucket = bucket
+        self.in_flight = 0
+        self.cooldown_until = 0
+        self.requests = 0
+        self.captchas = 0
+        self.rate_errors = 0
+        self.flood_errors = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.cooldown_until <= time.time()
+
+    def stats(self) -> Dict:
+        return {
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'captchas': self.captchas,
+            'rate_errors': self.rate_errors,
+            'flood_errors': self.flood_errors,
+            'cooldown': max(0, round(self.cooldown_until - time.time(), 1)),
+            'tokens': round(self.bucket.tokens, 2)
+        }
+
+
+class TokenPool:
+    """
+    VK access tokens used in rotation. Each token is rate limited by its own token bucket;
+    the least loaded healthy one is picked for every request. Tokens which got captcha or flood
+    control errors cool down out of rotation. When all tokens cool down, the one which recovers first
+    is still used, so users get the captcha to solve.
+    With shared state the limits, cooldowns and captchas are common for all worker processes.
+    """
+    logger = setup_logger('tokens')
+
+    MAX_CAPTCHAS = 1000  # remembered captcha ids
+
+    def __init__(self, tokens: List[str], settings: Dict = None, shared: Optional[SharedTokenState] = None):
+        if not tokens:
+            raise ValueError('At least one access token is required')
+        self._settings = TOKEN_SETTINGS if settings is None else settings
+        self._shared = shared
+        self._tokens = [AccessToken(value, self._bucket(value)) for value in tokens]
+        # captcha must be answered with the token which got it
+        self._captchas = OrderedDict()  # type: OrderedDict[str, AccessToken]
+
+    @property
+    def size(self) -> int:
+        return len(self._tokens)
+
+    def has_healthy(self) -> bool:
+        self._load_cooldowns()
+        return any(token.healthy for token in self._tokens)
+
+    def has_spare(self) -> bool:
+        """ Whether some healthy token is idle and can be used right now """
+        self._load_cooldowns()
+        return any(
+            token.healthy and not token.in_flight and token.bucket.tokens >= 1 for token in self._tokens
+        )
+
+    async def acquire(self, captcha_sid: Optional[str] = None) -> AccessToken:
+        token = self._pop_captcha(str(captcha_sid)) if captcha_sid is not None else None
+        while True:
+            self._load_cooldowns()
+            candidates = [token] if token is not None else self._healthy_tokens()
+            levels = {candidate: candidate.bucket.tokens for candidate in candidates}
+            ready = [candidate for candidate in candidates if levels[candidate] >= 1]
+            if ready:
+                chosen = min(ready, key=lambda candidate: (candidate.in_flight, -levels[candidate]))
+                # shared bucket could be emptied by other process meanwhile
+                if chosen.bucket.take():
+                    chosen.in_flight += 1
+                    chosen.requests += 1
+                    return chosen
+                continue
+            await asyncio.sleep(min(candidate.bucket.delay() for candidate in candidates))
+
+    def release(self, token: AccessToken, error_code: Optional[int] = None, captcha_sid: Optional[str] = None):
+        token.in_flight -= 1
+        if error_code is None:
+            return
+
+        if error_code == CAPTCHA_ERROR:
+            token.captchas += 1
+            cooldown = self._settings['captcha_cooldown']
+            if captcha_sid is not None:
+                self._add_captcha(str(captcha_sid), token)
+        elif error_code == FLOOD_ERROR:
+            token.flood_errors += 1
+            cooldown = self._settings['flood_cooldown']
+        elif error_code == RATE_ERROR:
+            token.rate_errors += 1
+            cooldown = self._settings['rate_cooldown']
+        else:
+            return
+        self._cool_down(token, time.time() + cooldown)
+        self.logger.info('Access token #{} cools down for {}s after error {}'.format(
+            self._tokens.index(token), cooldown, error_code
+        ))
+
+    def solved(self, token: AccessToken):
+        """ Captcha answer was accepted, so token can be used again """
+        self._cool_down(token, 0)
+
+    def stats(self) -> Dict:
+        self._load_cooldowns()
+        return {str(number): token.stats() for number, token in enumerate(self._tokens)}
+
+    def _bucket(self, value: str) -> TokenBucket:
+        if self._shared is None:
+            return TokenBucket(self._settings['rate'], self._settings['burst'])
+        return SharedTokenBucket(self._shared, md5(value), self._settings['rate'], self._settings['burst'])
+
+    def _cool_down(self, token: AccessToken, until: float):
+        token.cooldown_until = until
+        if self._shared is not None:
+            self._shared.cool_down(token.key, until)
+
+    def _load_cooldowns(self):
+        """ Cooldowns after errors got by other processes """
+        if self._shared is None:
+            return
+        cooldowns = self._shared.cooldowns()
+        for token in self._tokens:
+            token.cooldown_until = cooldowns.get(token.key, token.cooldown_until)
+
+    def _add_captcha(self, captcha_sid: str, token: AccessToken):
+        if self._shared is not None:
+            self._shared.add_captcha(captcha_sid, token.key)
+            return
+        self._captchas[captcha_sid] = token
+        while len(self._captchas) > self.MAX_CAPTCHAS:
+            self._captchas.popitem(last=False)
+
+    def _pop_captcha(self, captcha_sid: str) -> Optional[AccessToken]:
+        if self._shared is None:
+            return self._captchas.pop(captcha_sid, None)
+        key = self._shared.pop_captcha(captcha_sid)
+        return next((token for token in self._tokens if token.key == key), None)
+
+    def _healthy_tokens(self) -> List[AccessToken]:
+        healthy = [token for token in self._tokens if token.healthy]
+        if healthy:
+            return healthy
+        return [min(self._tokens, key=lambda token: token.cooldown_until)]
@@ -0,0 +1,356 @@
+import asyncio
+import os
+from typing import Callable, Dict, Optional, List
+
+import aiohttp
+
+from client import HttpClient
+from disk_cache import DiskCache
+from fileio import pread
+from frames import FrameIndexer
+from id3 import Id3Tagger
+from metrics import PHASE_DURATION
+from records import AudioRecord
+from scheduler import DownloadScheduler, Ticket, PRIORITY_DOWNLOAD
+from settings import DOWNLOAD_SETTINGS
+from singleflight import ProcessLeases
+from storage import LocalStorage, S3Storage
+from utils import setup_logger
+
+
+class TransferError(Exception):
+    pass
+
+
+class Transfer:
+    """
+    Upstream download of a single audio file.
+    Data is written into temporary file which can be read by any number
+    of clients while it grows; on success the file is moved into its path.
+    With several worker processes the file may be written by other process, then its temporary file is read.
+    """
+
+    def __init__(self, audio_info: AudioRecord, key: str, path: str, temp_path: str,
+                 ticket: Optional[Ticket] = None):
+        self.audio_info = audio_info
+        self.ticket = ticket
+        self.key = key
+        self.path = path
+        self.temp_path = temp_path
+        self.data_path = temp_path  # file being written, by this or other worker process
+        self.written = 0
+        self.content_length = None  # type: Optional[int]
+        self.size = None  # type: Optional[int]  # final size of the file when it is known before the end
+        self.min_size = 0  # final size is at least this
+        self.frames = FrameIndexer()  # of data written so far
+        self.readers = 0
+        self.done = False
+        self.failed = False
+        self._waiters = []  # type: List[asyncio.Future]
+
+    @property
+    def finished(self):
+        return self.done or self.failed
+
+    @property
+    def final_size(self) -> Optional[int]:
+        return self.written if self.done else self.size
+
+    def open(self) -> 'TransferReader':
+        return TransferReader(self)
+
+    async def wait(self, offset: int):
+        """ Wait until there is data after offset or transfer is finished """
+        while offset >= self.written and not self.finished:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def _advance(self, size: int):
+        self.written += size
+        self._notify()
+
+    def _finish(self, success: bool):
+        self.done = success
+        self.failed = not success
+        self._notify()
+
+    def _notify(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class TransferReader:
+    def __init__(self, transfer: Transfer):
+        self._transfer = transfer
+        self._fd = None
+        self._closed = False
+        transfer.readers += 1
+
+    async def read(self, offset: int, size: int) -> bytes:
+        """ Returns empty bytes at the end of complete file """
+        transfer = self._transfer
+        await transfer.wait(offset)
+        if transfer.failed:
+            raise TransferError('Upstream download failed')
+        size = min(size, transfer.written - offset)
+        if size <= 0:
+            return b''
+        if self._fd is None:
+            self._fd = self._open(transfer)
+        return await pread(self._fd, size, offset)
+
+    @staticmethod
+    def _open(transfer: Transfer) -> int:
+        # temporary file is already renamed when transfer is done
+        if transfer.done:
+            return os.open(transfer.path, os.O_RDONLY)
+        try:
+            return os.open(transfer.data_path, os.O_RDONLY)
+        except FileNotFoundError:
+            # just moved into its place by other worker process
+            return os.open(transfer.path, os.O_RDONLY)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._transfer.readers -= 1
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TransferManager:
+    logger = setup_logger('transfer')
+
+    def __init__(self, http_client: HttpClient, storage: LocalStorage, disk_cache: DiskCache,
+                 remote_storage: Optional[S3Storage] = None, leases: Optional[ProcessLeases] = None,
+                 scheduler: Optional[DownloadScheduler] = None, chunk_size: int = 64 * 1024):
+        self._http_client = http_client
+        self._storage = storage
+        self._disk_cache = disk_cache
+        self._remote_storage = remote_storage
+        self._leases = leases
+        self._scheduler = scheduler
+        self._chunk_size = chunk_size
+        self._transfers = {}  # type: Dict[str, Transfer]
+        self._tasks = set()
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes_downloaded = 0
+
+    @property
+    def active(self) -> int:
+        return len(self._transfers)
+
+    def get(self, audio_id: str) -> Optional[Transfer]:
+        return self._transfers.get(audio_id)
+
+    def start(self, audio_info: AudioRecord, client: str = '', priority: int = PRIORITY_DOWNLOAD) -> Transfer:
+        """
+        Starts download in background or returns already running one.
+        Raises SchedulerFull when there are too many downloads waiting.
+        """
+        transfer = self._transfers.get(audio_info.id)
+        if transfer is not None:
+            if transfer.ticket is not None:
+                self._scheduler.promote(transfer.ticket, priority)
+            return transfer
+
+        ticket = None if self._scheduler is None else self._scheduler.enqueue(client, priority)
+        key = self._storage.key_for(audio_info.id)
+        transfer = Transfer(audio_info, key, self._storage.path_for(key), self._storage.temp_file(), ticket)
+        self._transfers[audio_info.id] = transfer
+        self.started += 1
+        self._spawn(self._run(transfer))
+        return transfer
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Future):
+        self._tasks.discard(task)
+        # nobody awaits background tasks, so their errors are logged here
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error('Background task failed: {!r}'.format(task.exception()))
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    async def _run(self, transfer: Transfer):
+        success = False
+        try:
+            with self._disk_cache.pinned(transfer.key):
+                if transfer.ticket is not None:
+                    await self._scheduler.wait(transfer.ticket)
+                success = await self._download(transfer)
+        finally:
+            if transfer.ticket is not None:
+                self._scheduler.release(transfer.ticket)
+            if os.path.exists(transfer.temp_path):
+                os.remove(transfer.temp_path)
+            del self._transfers[transfer.audio_info.id]
+            transfer._finish(success)
+
+    async def _download(self, transfer: Transfer) -> bool:
+        if self._leases is None:
+            return await self._download_file(transfer)
+
+        # other worker processes may be downloading the same file
+        lease_key = 'audio:{}'.format(transfer.key)
+
+        def lookup():
+            return self._get_file_size(transfer.path)
+
+        try:
+            size = await self._leases.acquire_or_wait(
+                lease_key, 2 * DOWNLOAD_SETTINGS['timeout'], lookup, transfer.temp_path,
+                lambda path: self._follow(transfer, lease_key, path, lookup)
+            )
+        except (TransferError, IOError) as e:
+            self.logger.error('Download failed ({}): {}'.format(transfer.audio_info.id, e))
+            self.failed += 1
+            return False
+        if size is not None:
+            # readers which are not following the temporary file open the final one when transfer is done
+            transfer.written = size
+            return True
+        try:
+            return await self._download_file(transfer)
+        finally:
+            self._leases.release(lease_key)
+
+    async def _download_file(self, transfer: Transfer) -> bool:
+        audio_info = transfer.audio_info
+        url = None
+        if self._remote_storage is not None:
+            try:
+                url = await self._remote_storage.get_url(transfer.key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # remote storage is only a cache, file is downloaded from VK without it
+                self.logger.error('Remote storage lookup failed ({}): {!r}'.format(audio_info.id, e))
+        # file in remote storage is already tagged
+        from_vk = url is None
+        if from_vk:
+            url = audio_info.mp3
+
+        self.logger.debug('Downloading from %s: %s', 'vk' if from_vk else 'remote storage', url)
+        # tags are written while file is downloaded, so it is not read again
+        tagger = Id3Tagger(audio_info) if from_vk else None
+        try:
+            # unbuffered, so readers see every chunk as soon as it is written
+            with open(transfer.temp_path, 'wb', buffering=0) as f, PHASE_DURATION.time('upstream_download'):
+                async with self._http_client.get(
+                    url,
+                    timeout=self._http_client.timeout(total=DOWNLOAD_SETTINGS['timeout'])
+                ) as response:
+                    response.raise_for_status()
+                    transfer.content_length = response.content_length
+                    if tagger is not None:
+                        self._write(f, transfer, tagger.header())
+                    elif transfer.content_length is not None:
+                        transfer.size = transfer.min_size = transfer.content_length
+                    async for chunk in response.content.iter_chunked(self._chunk_size):
+                        self.bytes_downloaded += len(chunk)
+                        if tagger is None:
+                            self._write(f, transfer, chunk)
+                            continue
+                        data = tagger.feed(chunk)
+                        if not transfer.min_size and transfer.content_length is not None:
+                            # known as soon as the old ID3v2 tag is seen
+                            transfer.min_size = tagger.min_size(transfer.content_length) or 0
+                        self._write(f, transfer, data)
+                if tagger is not None:
+                    self._write(f, transfer, tagger.finish())
+            frames = transfer.frames.index
+            size = self._storage.commit_file(
+                transfer.temp_path, transfer.key, audio_info.id, frames.to_bytes() if frames.times else None
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            self.logger.error('Download failed ({}): {}'.format(audio_info.id, e))
+            self.failed += 1
+            return False
+
+        self._disk_cache.add(transfer.key, size, audio_info.id)
+        if from_vk and self._remote_storage is not None:
+            self._spawn(self._remote_storage.upload(transfer.key, transfer.path))
+        self.completed += 1
+        return True
+
+    async def _follow(self, transfer: Transfer, lease_key: str, path: str, lookup: Callable[[], Optional[int]]):
+        """
+        Reads temporary file written by other worker process as it grows, so readers do not wait until it is done.
+        Returns file size when it is complete, None when nothing was read and the other process is gone.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            # committed or failed right now
+            return lookup()
+        transfer.data_path = path
+        try:
+            # temporary file is renamed on commit, open descriptor still reads the same data
+            while True:
+                size = lookup()
+                available = os.fstat(fd).st_size if size is None else size
+                if transfer.written < available:
+                    data = await pread(fd, min(self._chunk_size, available - transfer.written), transfer.written)
+                    if data:
+                        self._append(transfer, data)
+                        continue
+                if size is not None:
+                    return size
+                if not self._leases.is_held(lease_key) and lookup() is None:
+                    if transfer.written:
+                        raise TransferError('Download by other worker process failed')
+                    return None
+                await asyncio.sleep(self._leases.poll_interval)
+        finally:
+            transfer.data_path = transfer.temp_path
+            os.close(fd)
+
+    @classmethod
+    def _write(cls, f, transfer: Transfer, data: bytes):
+        if data:
+            f.write(data)
+            cls._append(transfer, data)
+
+    @staticmethod
+    def _append(transfer: Transfer, data: bytes):
+        if data:
+            transfer.frames.feed(data)
+            transfer._advance(len(data))
+
+    @staticmethod
+    def _get_file_size(path: str) -> Optional[int]:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+
+    def stats(self) -> Dict:
+        return {
+            'active': self.active,
+            'readers': sum(transfer.readers for transfer in self._transfers.values()),
+            'started': self.started,
+            'completed': self.completed,
+            'failed': self.failed,
+            'bytes_downloaded': self.bytes_downloaded
+        }
@@ -1,30 +1,33 @@
 import hashlib
-import re
-from typing import Union, Optional, Dict
+from typing import Union
 from urllib.parse import urljoin
 import binascii
 import logging
 
-import eyed3
-from eyed3.id3 import ID3_V1
-from unidecode import unidecode
 from tornado import web
 
-from settings import LOG_LEVEL
+from metrics import REQUEST_DURATION, REQUESTS_IN_FLIGHT
+from settings import LOG_LEVEL, SEARCH_SETTINGS
 
 
 class BasicHandler(web.RequestHandler):
     logger = None
+    _in_flight = False
 
     def prepare(self):
-        self.logger.debug('{} request from {}: {}'.format(
-            self.request.method.capitalize(),
-            self.request.remote_ip,
-            self.request.uri)
+        self._in_flight = True
+        REQUESTS_IN_FLIGHT.inc(type(self).__name__)
+        self.logger.debug(
+            '%s request from %s: %s', self.request.method.capitalize(), self.request.remote_ip, self.request.uri
         )
-        self.logger.debug('Request body: {}'.format(self.request.body.decode()))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Request body: %s', self.request.body.decode())
 
     def on_finish(self):
+        route = type(self).__name__
+        if self._in_flight:
+            REQUESTS_IN_FLIGHT.dec(route)
+        REQUEST_DURATION.observe(self.request.request_time(), route, str(self.get_status()))
         self.log_request()
 
     def write_result(self, result):
@@ -35,7 +38,7 @@ class BasicHandler(web.RequestHandler):
         if 'exc_info' in kwargs:
             exception = kwargs['exc_info'][1]
             if isinstance(exception, web.HTTPError):
-                result.update(exception.args)  # TODO
+                result.update(exception.args)  # (name, value) pairs, for ex. captcha
         self.finish(result)
 
     def log_request(self):
@@ -57,21 +60,22 @@ class BasicHandler(web.RequestHandler):
         return urljoin(host_url, self.reverse_url(name, *args))
 
 
-def setup_logger(name, lvl=logging.DEBUG):
+def setup_logger(name, lvl=LOG_LEVEL):
     logger = logging.getLogger(name)
     logger.setLevel(lvl)
+    if logger.handlers:  # already configured
+        return logger
     basic_stream_handler = logging.StreamHandler()
     basic_stream_handler.setFormatter(
         logging.Formatter('%(levelname)-8s %(asctime)s %(message)s')
     )
-    basic_stream_handler.setLevel(LOG_LEVEL)
     logger.addHandler(basic_stream_handler)
     logger.propagate = False
     return logger
 
 
 def vk_url(path: str):
-    return urljoin('https://api.vk.com/', path)
+    return urljoin(SEARCH_SETTINGS['api_url'], path)
 
 
 def crc32(string: Union[str, bytes]):
@@ -93,32 +97,3 @@ def uni_hash(hash_func: str, string):
         return md5(string)
 
     raise ValueError('Unknown hash function: {}'.format(hash_func))
-
-
-def sanitize(string, to_lower: bool = True, alpha_numeric_only: bool = False, truncate: Optional[int] = None):
-    if alpha_numeric_only:
-        string = re.sub(r'\w+', '', string)
-    else:
-        bad_chars = ['~', '`', '!', '@', '#', '$', '%', '^', '&', '*', '(', ')', '_', '=', '+',
-                     '[', '{', ']', '}', '\\', '|', ';', ':', '"', "'", '—', '–', ',', '<', '>', '/', '?',
-                     '‘', '’', '“', '”']
-        string = re.sub(r'|'.join(map(re.escape, bad_chars)), '', string)
-
-    string = unidecode(string)  # transliteration and other staff: converts to ascii
-    string = string.strip()
-    string = re.sub(r'\s+', ' ', string)
-
-    if to_lower:
-        string = string.lower()
-    if truncate is not None:
-        string = string[:truncate]
-
-    return string
-
-
-def set_id3_tag(path: str, audio_info: Dict):
-    audio = eyed3.load(path)
-    audio.initTag(version=ID3_V1)
-    audio.tag.title = unidecode(audio_info['title']).strip()
-    audio.tag.artist = unidecode(audio_info['artist']).strip()
-    audio.tag.save(version=ID3_V1)
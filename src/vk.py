@@ -0,0 +1,308 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+from urllib.parse import urlparse, parse_qs
+
+import aiohttp
+
+from cache import AppCache, search_cache_key
+from client import HttpClient
+from metrics import PHASE_DURATION
+from records import AudioRecord, SearchPage
+from settings import SEARCH_SETTINGS, REFRESH_SETTINGS, HASH, ARTISTS
+from singleflight import SingleFlight, ProcessLeases
+from tokens import TokenPool, CAPTCHA_ERROR, RATE_ERROR, FLOOD_ERROR
+from utils import uni_hash, setup_logger, vk_url
+
+
+class VkError(Exception):
+    """ Error response of VK api """
+
+    def __init__(self, code: int, message: str, captcha: Optional[Dict] = None):
+        super().__init__('({}) {}'.format(code, message))
+        self.code = code
+        self.message = message
+        self.captcha = captcha  # captcha_sid and captcha_img, when captcha is needed
+
+
+def url_expires(url: str) -> Optional[float]:
+    """ Expiration time of signed mp3 url, None if it is not in the url """
+    values = parse_qs(urlparse(url).query).get('expires')
+    try:
+        return float(values[0]) if values else None
+    except ValueError:
+        return None
+
+
+def audio_record(item: Dict) -> Optional[AudioRecord]:
+    """ Record of audio object returned by VK, None if it can not be downloaded """
+    if not len(item.get('url') or ''):
+        return None
+    vk_id = '{}_{}'.format(item['owner_id'], item['id'])
+    if item.get('access_key'):
+        vk_id = '{}_{}'.format(vk_id, item['access_key'])
+    return AudioRecord(
+        id=uni_hash(HASH['id'], str(item['id'])),
+        artist=item['artist'],
+        title=item['title'],
+        duration=item['duration'],
+        mp3=item['url'],
+        vk_id=vk_id,
+        expires=url_expires(item['url']) or time.time() + REFRESH_SETTINGS['url_ttl']
+    )
+
+
+class VkApi:
+    """ Calls of VK api methods with access tokens from the pool """
+    logger = setup_logger('vk')
+
+    API_VERSION = '5.72'
+    RETRY_ERRORS = (CAPTCHA_ERROR, RATE_ERROR, FLOOD_ERROR)  # other token may succeed
+
+    def __init__(self, http_client: HttpClient, tokens: TokenPool):
+        self._http_client = http_client
+        self.tokens = tokens
+
+    async def call(self, method: str, params: Dict, captcha_sid: Optional[str] = None,
+                   captcha_key: Optional[str] = None) -> Dict:
+        """ Returns response of the method or raises VkError """
+        # captcha answer is valid only for the token which got the captcha
+        attempts = 1 if captcha_sid is not None else self.tokens.size
+        for _ in range(attempts):
+            token = await self.tokens.acquire(captcha_sid)
+            error = None
+            try:
+                result = await self._request(method, params, token.value, captcha_sid, captcha_key)
+                error = self._get_error(result)
+            finally:
+                self.tokens.release(
+                    token,
+                    None if error is None else error.code,
+                    None if error is None or error.captcha is None else error.captcha['captcha_sid']
+                )
+            if error is None:
+                if captcha_sid is not None:
+                    self.tokens.solved(token)
+                return result['response']
+            if error.code not in self.RETRY_ERRORS or not self.tokens.has_healthy():
+                break
+            self.logger.info('{} failed with {}, retrying with other token'.format(method, error))
+
+        self.logger.error(str(error))
+        raise error
+
+    async def _request(self, method: str, params: Dict, access_token: str,
+                       captcha_sid: Optional[str], captcha_key: Optional[str]) -> Dict:
+        headers = {'User-Agent': SEARCH_SETTINGS['user_agent']}
+        params = dict(params, access_token=access_token, v=self.API_VERSION)
+        if captcha_sid is not None and captcha_key is not None:
+            params.update({
+                'captcha_sid': captcha_sid,
+                'captcha_key': captcha_key
+            })
+
+        async with self._http_client.get(
+                vk_url('method/{}'.format(method)),
+                headers=headers,
+                params=params
+        ) as response:
+            return await response.json()
+
+    @staticmethod
+    def _get_error(result: Dict) -> Optional[VkError]:
+        if 'error' not in result:
+            return None
+        error_data = result['error']
+        if error_data['error_code'] == CAPTCHA_ERROR:
+            captcha = {
+                'captcha_sid': int(error_data['captcha_sid']),
+                'captcha_img': error_data['captcha_img']
+            }
+        else:
+            captcha = None
+        return VkError(error_data['error_code'], error_data['error_msg'], captcha)
+
+
+class SearchService:
+    """
+    Search pages from VK api. Every page is requested once per cache key,
+    however many requests (and worker processes) ask for it at the same time.
+    """
+    logger = setup_logger('search')
+
+    def __init__(self, api: VkApi, cache: AppCache, leases: Optional[ProcessLeases] = None):
+        self._api = api
+        self._pages = cache.region('search_pages')
+        self._leases = leases
+        self.flight = SingleFlight()
+        self.active = 0  # requests to VK made for users, background ones wait for them
+
+    def get_cached(self, query: str, page: int) -> Optional[SearchPage]:
+        cache_key = search_cache_key(query, page)
+        self.logger.debug('Trying to get search result from cache: %s', cache_key)
+        result = self._pages.get(cache_key)
+        if result is None:
+            self.logger.debug('Cache miss')
+        return result
+
+    def is_busy(self) -> bool:
+        """ Whether background requests would take VK capacity from users """
+        return self.active > 0 or not self._api.tokens.has_spare()
+
+    def peek(self, query: str, page: int) -> Optional[SearchPage]:
+        """ Same as get_cached, but not counted in cache stats """
+        return self._pages.peek(search_cache_key(query, page))
+
+    async def fetch(self, query: str, page: int, background: bool = False, **kwargs) -> SearchPage:
+        cache_key = search_cache_key(query, page)  # TODO do not cache random
+        # requests with captcha answer must not join a request which will fail again
+        flight_key = (cache_key, kwargs.get('captcha_sid'))
+        if not background:
+            self.active += 1
+        try:
+            return await self.flight.do(flight_key, lambda: self._fetch(query, page, cache_key, **kwargs))
+        finally:
+            if not background:
+                self.active -= 1
+
+    async def _fetch(self, query: str, page: int, cache_key: str, **kwargs) -> SearchPage:
+        # other worker processes may be searching the same
+        leases = self._leases
+        lease_key = 'search:{}'.format(cache_key)
+        if leases is not None and not kwargs:
+            audio_items = await leases.acquire_or_wait(
+                lease_key, SEARCH_SETTINGS['lease_ttl'], lambda: self._pages.peek(cache_key)
+            )
+            if audio_items is not None:
+                return audio_items
+        else:
+            leases = None
+
+        try:
+            response = await self._request(query, offset=page * SEARCH_SETTINGS['page_size'], **kwargs)
+            audio_items = self._get_audio_items(response)
+
+            self.logger.debug('Store search result into cache...')
+            self._pages.put(cache_key, audio_items)
+        finally:
+            if leases is not None:
+                leases.release(lease_key)
+        return audio_items
+
+    async def _request(self, query: str, offset: int, **kwargs) -> Dict:
+        if not len(query):
+            query = self._random_artist()
+
+        params = {
+            'q': query,
+            'offset': offset,
+            # 'sort': 2,
+            'count': SEARCH_SETTINGS['page_size']
+        }
+        self.logger.debug('Requesting search results (size=%s) from vk...', SEARCH_SETTINGS['page_size'])
+        with PHASE_DURATION.time('vk_search'):
+            return await self._api.call('audio.search', params, **kwargs)
+
+    @staticmethod
+    def _random_artist():
+        return random.choice(ARTISTS)
+
+    @staticmethod
+    def _get_audio_items(response: Dict) -> SearchPage:
+        records = (audio_record(audio_item) for audio_item in response['items'])
+        return SearchPage(record for record in records if record is not None)
+
+    def stats(self) -> Dict:
+        return dict(self.flight.stats(), active=self.active)
+
+
+class AudioRefresher:
+    """
+    Fresh records (with new mp3 urls) of audios whose urls expired.
+    Ids requested at about the same time are sent to VK in one audio.getById call.
+    """
+    logger = setup_logger('refresh')
+
+    def __init__(self, api: VkApi, settings: Dict = None):
+        self._api = api
+        self._settings = REFRESH_SETTINGS if settings is None else settings
+        self._pending = OrderedDict()  # type: OrderedDict[str, asyncio.Future]
+        self._flush_handle = None  # type: Optional[asyncio.Handle]
+        self._tasks = set()  # type: Set[asyncio.Task]
+        self.requests = 0
+        self.refreshed = 0
+        self.missing = 0
+        self.errors = 0
+
+    async def get(self, vk_id: str) -> Optional[AudioRecord]:
+        """ Returns None when VK does not return the audio, raises VkError or HTTP client errors """
+        future = self._pending.get(vk_id)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = self._pending[vk_id] = loop.create_future()
+            if len(self._pending) >= self._settings['batch_size']:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self._settings['batch_delay'], self._flush)
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict:
+        return {
+            'pending': len(self._pending),
+            'requests': self.requests,
+            'refreshed': self.refreshed,
+            'missing': self.missing,
+            'errors': self.errors
+        }
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, OrderedDict()
+        # event loop keeps only weak references to tasks
+        task = asyncio.ensure_future(self._refresh(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, batch: Dict[str, asyncio.Future]):
+        self.requests += 1
+        self.logger.debug('Refreshing %s audios', len(batch))
+        error = None  # type: Optional[BaseException]
+        try:
+            with PHASE_DURATION.time('vk_refresh'):
+                response = await self._api.call('audio.getById', {'audios': ','.join(batch)})
+
+            # access key is not part of ids in response
+            records = {}
+            for item in response:
+                record = audio_record(item)
+                if record is not None:
+                    records['{}_{}'.format(item['owner_id'], item['id'])] = record
+            for vk_id, future in batch.items():
+                record = records.get('_'.join(vk_id.split('_')[:2]))
+                if record is None:
+                    self.missing += 1
+                else:
+                    self.refreshed += 1
+                if not future.done():
+                    future.set_result(record)
+        except (VkError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.errors += 1
+            self.logger.error('Refresh of {} audios failed: {}'.format(len(batch), e))
+            error = e
+        except Exception as e:
+            self.errors += 1
+            self.logger.exception('Refresh of {} audios failed'.format(len(batch)))
+            error = e
+        finally:
+            # waiting requests must not hang whatever happened to the batch
+            for future in batch.values():
+                if future.done():
+                    continue
+                if error is None:
+                    future.cancel()
+                else:
+                    future.set_exception(error)
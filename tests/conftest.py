@@ -0,0 +1,29 @@
+import asyncio
+import os
+import sys
+
+# modules of the app are imported from src the same way as in the container
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('ACCESS_TOKEN', 'test')
+
+from cache import MemoryRegion  # noqa: E402
+
+
+def run(coro):
+    """ Runs coroutine in a new event loop, tornado test cases close the default one """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class FakeCache:
+    """ AppCache with regions in memory """
+
+    def __init__(self):
+        self._regions = {'search_pages': MemoryRegion('search_pages'), 'audio_info': MemoryRegion('audio_info')}
+
+    def region(self, name: str):
+        return self._regions[name]
@@ -0,0 +1,38 @@
+import time
+
+import pytest
+
+from cache import CacheRegion, MemoryRegion
+
+
+def test_incomplete_region_fails_on_creation():
+    class IncompleteRegion(CacheRegion):
+        def _load(self, key: str):
+            return None
+
+    with pytest.raises(TypeError):
+        IncompleteRegion('incomplete')
+
+
+def test_memory_region():
+    region = MemoryRegion('pages', expire=60)
+    assert region.get('key') is None
+    region.put('key', 'value')
+    assert region.get('key') == 'value'
+    assert region.peek('missing') is None
+    assert region.stats() == {'hits': 1, 'misses': 1, 'puts': 1, 'entries': 1}
+    region.remove('key')
+    assert region.get('key') is None
+
+
+def test_memory_region_snapshot():
+    region = MemoryRegion('pages', expire=60)
+    region.put('key', 'value')
+    records = region.snapshot()
+    restored = MemoryRegion('pages', expire=60)
+    restored.put('newer', 'kept')
+    restored.restore(records + [('newer', None, 'old'), ('expired', time.time() - 1, 'value')])
+    assert restored.get('key') == 'value'
+    # entries stored since start are not overwritten, expired ones are not returned
+    assert restored.get('newer') == 'kept'
+    assert restored.get('expired') is None
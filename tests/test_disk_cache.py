@@ -0,0 +1,182 @@
+import contextlib
+import os
+import time
+
+from conftest import run
+from disk_cache import DiskCache
+from storage import LocalStorage
+
+
+def test_load_index_since(tmp_path):
+    async def main():
+        storage = LocalStorage(str(tmp_path))
+        await storage.open()
+        now = time.time()
+        storage.index_put('old', '1', 10, now - 3600)
+        storage.index_put('new', '2', 20, now)
+        try:
+            return now, await storage.load_index(), await storage.load_index(now - 60)
+        finally:
+            await storage.close()
+
+    now, everything, recent = run(main())
+    assert sorted(key for key, _, _, _ in everything) == ['new', 'old']
+    assert recent == [('new', '2', 20, now)]
+
+
+def test_shared_merge_adds_files_of_other_processes(tmp_path):
+    async def main():
+        storage = LocalStorage(str(tmp_path))
+        await storage.open()
+        now = time.time()
+        storage.index_put('a', '1', 10, now - 3600)
+        disk_cache = DiskCache(storage, shared=True)
+        await disk_cache._scan()
+        # downloaded by other worker process
+        storage.index_put('b', '2', 20, time.time())
+        await disk_cache._maintain()
+        try:
+            return list(disk_cache._entries), disk_cache.stats()
+        finally:
+            await storage.close()
+
+    keys, stats = run(main())
+    # new file is the most recent one
+    assert keys == ['a', 'b']
+    assert stats['bytes'] == 30
+
+
+def test_accesses_in_other_processes(tmp_path):
+    async def main():
+        storage = LocalStorage(str(tmp_path))
+        await storage.open()
+        now = time.time()
+        storage.index_put('a', '1', 10, now - 3600)
+        storage.index_put('b', '2', 20, now - 1800)
+        disk_cache = DiskCache(storage, shared=True)
+        await disk_cache._scan()
+
+        # worker process which does not evict, with its own connection to the index
+        other_storage = LocalStorage(str(tmp_path))
+        await other_storage.open()
+        other = DiskCache(other_storage, shared=True, evict=False)
+        other.touch('a')
+        other.touch('a')
+        other.add('c', 30)
+        await other.close()
+        await other_storage.close()
+
+        await disk_cache._maintain()
+        try:
+            return list(disk_cache._entries), disk_cache._entries['a'].hits, other.stats(), await storage.pop_accesses()
+        finally:
+            await storage.close()
+
+    keys, hits, other_stats, left = run(main())
+    # accessed file is the most recent one
+    assert keys == ['b', 'a']
+    assert hits == 2
+    assert other_stats['entries'] == 0
+    assert left == []
+
+
+SETTINGS = {
+    'max_bytes': 100, 'max_entries': 10, 'max_age': None, 'policy': 'lru', 'low_watermark': 1,
+    'eviction_interval': 60, 'access_save_interval': 10
+}
+
+
+def evict(tmp_path, settings, prepare):
+    """ Keys evicted from cache with files added and accessed by prepare(disk_cache) """
+    async def main():
+        storage = LocalStorage(str(tmp_path))
+        await storage.open()
+        evicted = []
+        disk_cache = DiskCache(storage, settings, on_evict=evicted.append)
+        await disk_cache.open()
+        await disk_cache._scan()
+        try:
+            with prepare(disk_cache) or contextlib.ExitStack():
+                await disk_cache.evict()
+            return evicted, disk_cache.stats()
+        finally:
+            await disk_cache.close()
+            await storage.close()
+
+    return run(main())
+
+
+def add_files(disk_cache: DiskCache, count: int, size: int = 30):
+    for number in range(count):
+        disk_cache.add('key{}'.format(number), size, 'id{}'.format(number))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    def prepare(disk_cache):
+        add_files(disk_cache, 5)
+        disk_cache.touch('key0')
+
+    evicted, stats = evict(tmp_path, SETTINGS, prepare)
+    assert evicted == ['id1', 'id2']
+    assert (stats['entries'], stats['bytes'], stats['evicted'], stats['evicted_bytes']) == (3, 90, 2, 60)
+
+
+def test_low_watermark(tmp_path):
+    evicted, _ = evict(tmp_path, dict(SETTINGS, low_watermark=0.5), lambda cache: add_files(cache, 4))
+    assert evicted == ['id0', 'id1', 'id2']
+
+
+def test_max_entries(tmp_path):
+    evicted, _ = evict(tmp_path, dict(SETTINGS, max_entries=2), lambda cache: add_files(cache, 3, 1))
+    assert evicted == ['id0']
+
+
+def test_pinned_file_is_not_evicted(tmp_path):
+    def prepare(disk_cache):
+        add_files(disk_cache, 5)
+        return disk_cache.pinned('key0')
+
+    evicted, _ = evict(tmp_path, SETTINGS, prepare)
+    assert evicted == ['id1', 'id2']
+
+
+def test_evicts_least_frequently_used(tmp_path):
+    def prepare(disk_cache):
+        add_files(disk_cache, 5)
+        for key in ('key0', 'key0', 'key1', 'key3', 'key4'):
+            disk_cache.touch(key)
+
+    evicted, _ = evict(tmp_path, dict(SETTINGS, policy='lfu'), prepare)
+    assert evicted == ['id2', 'id1']
+
+
+def test_evicts_old_files_within_budget(tmp_path):
+    def prepare(disk_cache):
+        add_files(disk_cache, 2)
+        disk_cache._entries['key1'].created -= 3600
+
+    evicted, stats = evict(tmp_path, dict(SETTINGS, max_age=60), prepare)
+    assert evicted == ['id1']
+    assert stats['entries'] == 1
+
+
+def test_evicted_file_is_removed(tmp_path):
+    async def main():
+        storage = LocalStorage(str(tmp_path))
+        await storage.open()
+        temp_path = storage.temp_file()
+        with open(temp_path, 'wb') as f:
+            f.write(bytes(30))
+        size = storage.commit_file(temp_path, 'key0', 'id0')
+        disk_cache = DiskCache(storage, dict(SETTINGS, max_bytes=10))
+        await disk_cache._scan()
+        try:
+            await disk_cache.evict()
+            return size, os.path.exists(storage.path_for('key0')), await storage.load_index()
+        finally:
+            await storage.close()
+
+    size, exists, index = run(main())
+    assert size == 30
+    assert not exists
+    assert index == []
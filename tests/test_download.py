@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from tornado.httpclient import HTTPClientError
+from tornado.testing import AsyncHTTPTestCase, ExpectLog
+from tornado.web import Application, HTTPError
+
+from conftest import FakeCache
+from download import DownloadHandler
+from records import AudioRecord
+from scheduler import DownloadScheduler
+from settings import HASH
+from transfer import Transfer
+from utils import uni_hash
+
+
+# noinspection PyAbstractClass
+class TransferHandler(DownloadHandler):
+    async def get(self):
+        if not await self._send_from_transfer(self.settings['transfer'], 'song.mp3'):
+            self.set_status(502)
+            self.finish()
+
+
+# noinspection PyAbstractClass
+class RefreshHandler(DownloadHandler):
+    async def get(self):
+        record = await self._refresh_audio_info(self.get_argument('id'), None)
+        self.finish({'vk_id': None if record is None else record.vk_id})
+
+
+class FakeRefresher:
+    def __init__(self):
+        self.requested = []
+
+    async def get(self, vk_id: str):
+        self.requested.append(vk_id)
+        audio_id = uni_hash(HASH['id'], vk_id.split('_')[1])
+        return AudioRecord(audio_id, 'Artist', 'Title', 60, 'https://cdn/1.mp3', vk_id=vk_id)
+
+
+class RefreshValidationTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.refresher = FakeRefresher()
+        return Application([('/', RefreshHandler)], cache=FakeCache(), refresher=self.refresher)
+
+    def refresh(self, audio_id: str, vk_id: str):
+        response = self.fetch('/?id={}&vk={}'.format(audio_id, vk_id))
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body.decode())['vk_id']
+
+    def test_valid_id(self):
+        audio_id = uni_hash(HASH['id'], '456')
+        self.assertEqual(self.refresh(audio_id, '-123_456_abc0'), '-123_456_abc0')
+        self.assertEqual(self.refresh(audio_id, '123_456'), '123_456')
+        self.assertEqual(self.refresher.requested, ['-123_456_abc0', '123_456'])
+
+    def test_malformed_id_is_not_requested(self):
+        audio_id = uni_hash(HASH['id'], '456')
+        for vk_id in ('', '456', '123_456_', '123_456,1_2', '123_456_a-b', 'x_456'):
+            self.assertIsNone(self.refresh(audio_id, vk_id))
+        self.assertEqual(self.refresher.requested, [])
+
+    def test_id_of_other_audio_is_not_requested(self):
+        self.assertIsNone(self.refresh(uni_hash(HASH['id'], '456'), '123_457'))
+        self.assertEqual(self.refresher.requested, [])
+
+
+class TransferRangeTest(AsyncHTTPTestCase):
+    DATA = bytes(range(256)) * 40
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'song.mp3')
+        self.transfer = Transfer(AudioRecord('1', 'Artist', 'Title', 60, ''), 'key', path, path + '.tmp')
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def get_app(self):
+        return Application([('/', TransferHandler)], cache=FakeCache(), transfer=self.transfer)
+
+    def download(self, data: bytes, size=None, min_size=0, done=True, chunk_size=1024, delay=0.01):
+        """ Writes `data` into transfer in background, like TransferManager does """
+        transfer = self.transfer
+        transfer.size, transfer.min_size = size, min_size
+
+        async def run():
+            with open(transfer.temp_path, 'wb', buffering=0) as f:
+                for start in range(0, len(data), chunk_size):
+                    await asyncio.sleep(delay)
+                    chunk = data[start:start + chunk_size]
+                    f.write(chunk)
+                    transfer._advance(len(chunk))
+            if done:
+                os.rename(transfer.temp_path, transfer.path)
+            transfer._finish(done)
+
+        self.io_loop.spawn_callback(run)
+
+    def fetch_range(self, value: str):
+        return self.fetch('/', headers={'Range': value})
+
+    def test_range_within_file(self):
+        self.download(self.DATA)
+        response = self.fetch_range('bytes=100-1999')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.DATA[100:2000])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 100-1999/*')
+
+    def test_range_past_end_of_unknown_size(self):
+        self.download(self.DATA)
+        response = self.fetch_range('bytes=0-9999999')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.DATA)
+        self.assertEqual(int(response.headers['Content-Length']), len(self.DATA))
+        self.assertEqual(response.headers['Content-Range'], 'bytes 0-{}/{}'.format(len(self.DATA) - 1, len(self.DATA)))
+
+    def test_range_clamped_to_known_size(self):
+        self.download(self.DATA, size=len(self.DATA), min_size=len(self.DATA), delay=0.05)
+        response = self.fetch_range('bytes=8000-9999999')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.DATA[8000:])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 8000-10239/10240')
+
+    def test_range_within_min_size(self):
+        # tagged file: final size is not exact, but the range surely fits
+        self.download(self.DATA, min_size=len(self.DATA) - 128)
+        response = self.fetch_range('bytes=0-5000')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.DATA[:5001])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 0-5000/*')
+
+    def test_range_start_past_end(self):
+        self.download(self.DATA)
+        response = self.fetch_range('bytes=20000-29999')
+        self.assertEqual(response.code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */10240')
+
+    def test_range_start_past_known_size(self):
+        self.download(self.DATA, size=len(self.DATA), min_size=len(self.DATA))
+        response = self.fetch_range('bytes=20000-29999')
+        self.assertEqual(response.code, 416)
+
+    def test_failed_transfer(self):
+        self.download(self.DATA, done=False)
+        response = self.fetch_range('bytes=0-9999999')
+        self.assertEqual(response.code, 502)
+
+    def test_failure_after_headers_are_sent(self):
+        self.download(self.DATA, done=False, delay=0.05)
+        with self.assertLogs('cache', 'INFO') as logs, ExpectLog('tornado.application', '.*', required=False) as errors:
+            with self.assertRaises(HTTPClientError):
+                self.fetch('/', raise_error=True)
+        # client sees the connection closed before the end of body instead of a complete response
+        self.assertIn('Upstream download failed', logs.output[0])
+        self.assertFalse(errors.logged_stack)
+
+    def test_no_range(self):
+        self.download(self.DATA)
+        response = self.fetch('/')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.DATA)
+
+
+class FakeStorage:
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    @staticmethod
+    def key_for(audio_id: str):
+        return audio_id
+
+    def path_for(self, key: str):
+        return os.path.join(self._directory, key)
+
+
+class FakeTransfers:
+    """ Only schedules downloads """
+
+    def __init__(self, scheduler: DownloadScheduler):
+        self.scheduler = scheduler
+
+    @staticmethod
+    def get(audio_id: str):
+        return None
+
+    def start(self, audio_info: AudioRecord, client: str, priority: int):
+        self.scheduler.enqueue(client, priority)
+        raise HTTPError(504, reason='Queued')
+
+
+class DownloadQueueTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def get_app(self):
+        cache = FakeCache()
+        record = AudioRecord('1', 'Artist', 'Title', 60, 'https://cdn/1.mp3', expires=time.time() + 3600)
+        cache.region('audio_info').put(record.id, record)
+        scheduler = DownloadScheduler({'max_active': 0, 'max_queue': 10, 'max_queue_per_client': 1, 'retry_after': 5})
+        return Application(
+            [('/dl/(?P<key>[^/]+)/(?P<id>[^/]+)/', DownloadHandler)], cache=cache, prefetcher=None,
+            storage=FakeStorage(self.directory.name), transfers=FakeTransfers(scheduler)
+        )
+
+    def get_httpserver_options(self):
+        return {'xheaders': True}
+
+    def download(self, address: str):
+        return self.fetch('/dl/key/1/', headers={'X-Real-IP': address})
+
+    def test_queue_is_per_client_address(self):
+        self.assertEqual(self.download('10.0.0.1').code, 504)
+        response = self.download('10.0.0.1')
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(json.loads(response.body.decode())['error_code'], 503)
+        # other client behind the same proxy still gets into the queue
+        self.assertEqual(self.download('10.0.0.2').code, 504)
@@ -0,0 +1,154 @@
+import random
+import struct
+
+import pytest
+
+from frames import FrameIndex, FrameIndexer, estimate_position, find_frame, parse_frame
+from id3 import build_v2_tag
+from records import AudioRecord
+
+
+# MPEG-1 Layer III, 128 kbps, 48 kHz: every frame is 384 bytes without padding
+HEADER = bytes([0xFF, 0xFB, 0x94, 0x64])
+FRAME_SIZE = 384
+SAMPLES = 1152
+RATE = 48000
+FRAME_TIME = SAMPLES / RATE
+
+
+def make_frames(count: int) -> bytes:
+    return (HEADER + b'\x00' * (FRAME_SIZE - len(HEADER))) * count
+
+
+def make_xing_frame(frames: int, audio_bytes: int, toc: bytes) -> bytes:
+    # stereo MPEG-1: Xing tag goes after 32 bytes of side information
+    data = HEADER + b'\x00' * 32 + b'Xing' + struct.pack('>III', 7, frames, audio_bytes) + toc
+    return data + b'\x00' * (FRAME_SIZE - len(data))
+
+
+def index_of(data: bytes, chunk_sizes=None, interval: float = 0.5) -> FrameIndexer:
+    indexer = FrameIndexer(interval)
+    position = 0
+    while position < len(data):
+        size = len(data) if chunk_sizes is None else next(chunk_sizes)
+        indexer.feed(data[position:position + size])
+        position += size
+    return indexer
+
+
+def random_sizes(seed: int):
+    rng = random.Random(seed)
+    while True:
+        yield rng.choice((1, 3, 4, 10, 100, 383, 384, 385, 4096))
+
+
+def test_parse_frame():
+    assert parse_frame(HEADER) == (FRAME_SIZE, SAMPLES, RATE)
+    assert parse_frame(bytes([0xFF, 0xFB, 0x90, 0x64])) == (417, 1152, 44100)
+    assert parse_frame(bytes([0xFF, 0xFB, 0x92, 0x64])) == (418, 1152, 44100)  # padding
+    assert parse_frame(bytes([0xFF, 0xF3, 0x94, 0x64])) == (240, 576, 24000)  # MPEG-2, 80 kbps
+    assert parse_frame(bytes([0xFF, 0xFB, 0xF4, 0x64])) is None  # bad bitrate
+    assert parse_frame(bytes([0xFF, 0xFB, 0x9C, 0x64])) is None  # bad sample rate
+    assert parse_frame(b'\x00\xFB\x94\x64') is None
+    assert parse_frame(HEADER[:3]) is None
+
+
+def test_find_frame():
+    data = b'\xff\x00garbage\xff' + make_frames(2)
+    assert find_frame(data) == 10
+    assert find_frame(b'\xff' * 3) is None
+
+
+def test_indexer_sync():
+    indexer = index_of(make_frames(100))
+    assert indexer.frames == 100
+    assert indexer.duration == pytest.approx(100 * FRAME_TIME)
+    index = indexer.index
+    assert index.duration == int(100 * FRAME_TIME * 1000)
+    # a point every 0.5 seconds at frame boundaries
+    assert len(index.times) == int(100 * FRAME_TIME / 0.5) + 1
+    assert all(offset % FRAME_SIZE == 0 for offset in index.offsets)
+    for time, offset in zip(index.times, index.offsets):
+        assert time == int(offset // FRAME_SIZE * FRAME_TIME * 1000)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_indexer_chunking(seed):
+    data = build_v2_tag(AudioRecord('1', 'Artist', 'Title', 60, '')) + make_frames(200)
+    whole = index_of(data).index
+    chunked = index_of(data, random_sizes(seed)).index
+    assert (chunked.times, chunked.offsets, chunked.duration) == (whole.times, whole.offsets, whole.duration)
+
+
+def test_indexer_skips_id3_tag():
+    tag = build_v2_tag(AudioRecord('1', 'Artist', 'Title', 60, ''))
+    index = index_of(tag + make_frames(50)).index
+    assert index.offsets[0] == len(tag)
+    assert all((offset - len(tag)) % FRAME_SIZE == 0 for offset in index.offsets)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_indexer_resync_after_garbage(seed):
+    garbage = b'\xff\xfb\x00\x00junk\xff' * 20
+    data = make_frames(100) + garbage + make_frames(100)
+    indexer = index_of(data, random_sizes(seed))
+    assert indexer.frames == 200
+    assert indexer.duration == pytest.approx(200 * FRAME_TIME)
+    for offset in indexer.index.offsets:
+        assert data[offset:offset + 4] == HEADER
+    second_part = [offset for offset in indexer.index.offsets if offset >= 100 * FRAME_SIZE]
+    assert second_part and all(offset >= 100 * FRAME_SIZE + len(garbage) for offset in second_part)
+
+
+def test_indexer_random_header_match_is_not_a_frame():
+    # single valid looking header followed by garbage
+    data = b'\x00' * 10 + HEADER + b'\x01' * 500 + make_frames(10)
+    indexer = index_of(data)
+    assert indexer.frames == 10
+    assert indexer.index.offsets[0] == 10 + len(HEADER) + 500
+
+
+def test_indexer_skips_xing_frame():
+    data = make_xing_frame(100, 100 * FRAME_SIZE, bytes(range(100))) + make_frames(100)
+    indexer = index_of(data)
+    # VBR header frame has no audio
+    assert indexer.frames == 101
+    assert indexer.duration == pytest.approx(100 * FRAME_TIME)
+    assert indexer.index.offsets[0] == FRAME_SIZE
+
+
+def test_frame_index_bytes():
+    index = index_of(make_frames(100)).index
+    restored = FrameIndex.from_bytes(index.to_bytes())
+    assert (restored.times, restored.offsets, restored.duration) == (index.times, index.offsets, index.duration)
+    assert FrameIndex.from_bytes(b'garbage') is None
+    assert FrameIndex.from_bytes(index.to_bytes()[:-1]) is None
+    assert restored.seek(0) == (0.0, 0)
+    assert restored.seek(1.1) == (index.times[2] / 1000, index.offsets[2])
+
+
+def test_estimate_position_cbr(tmp_path):
+    tag = build_v2_tag(AudioRecord('1', 'Artist', 'Title', 60, ''))
+    path = tmp_path / 'song.mp3'
+    path.write_bytes(tag + make_frames(1000))
+    start_time, offset = estimate_position(str(path), 10.01)
+    assert (offset - len(tag)) % FRAME_SIZE == 0
+    # time of the frame it landed on, not the requested one
+    assert start_time == (offset - len(tag)) // FRAME_SIZE * FRAME_TIME
+    assert abs(start_time - 10.01) <= FRAME_TIME
+    assert estimate_position(str(path), 1000) is None
+
+
+def test_estimate_position_xing(tmp_path):
+    frames = 1000
+    # first half of the duration takes a quarter of the bytes
+    toc = bytes(int(percent * 64 / 50) if percent < 50 else int(64 + (percent - 50) * 192 / 50) for percent in range(100))
+    path = tmp_path / 'song.mp3'
+    path.write_bytes(make_xing_frame(frames, (frames + 1) * FRAME_SIZE, toc) + make_frames(frames))
+    duration = frames * FRAME_TIME
+    start_time, offset = estimate_position(str(path), duration / 4)
+    assert offset % FRAME_SIZE == 0
+    assert offset == pytest.approx((frames + 1) * FRAME_SIZE / 8, abs=FRAME_SIZE)
+    # reverse of TOC at the frame found
+    assert start_time == pytest.approx(duration / 4, abs=duration / 100)
+    assert start_time != duration / 4
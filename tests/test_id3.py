@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from id3 import Id3Tagger, V1_SIZE, build_v1_tag, build_v2_tag, v2_tag_size
+from records import AudioRecord
+
+
+AUDIO_INFO = AudioRecord('1', 'Исполнитель', 'Song «title»', 60, '')
+OLD_INFO = AudioRecord('2', 'Old artist', 'Old title', 60, '')
+AUDIO = bytes(range(256)) * 20
+
+
+def tag_stream(data: bytes, seed=None) -> bytes:
+    tagger = Id3Tagger(AUDIO_INFO)
+    output = tagger.header()
+    rng = random.Random(seed)
+    position = 0
+    while position < len(data):
+        size = len(data) if seed is None else rng.choice((1, 5, 10, 127, 128, 129, 1000))
+        output += tagger.feed(data[position:position + size])
+        position += size
+    return output + tagger.finish()
+
+
+def test_v2_tag():
+    tag = build_v2_tag(AUDIO_INFO)
+    assert tag.startswith(b'ID3\x04\x00\x00')
+    assert v2_tag_size(tag[:10]) == len(tag)
+    assert 'Исполнитель'.encode() in tag and 'Song «title»'.encode() in tag
+
+
+def test_v2_tag_without_values():
+    tag = build_v2_tag(AudioRecord('1', '', ' ', 60, ''))
+    assert tag == b'ID3\x04\x00\x00\x00\x00\x00\x00'
+
+
+def test_v2_tag_size():
+    assert v2_tag_size(b'ID3\x04\x00\x00\x00\x00\x02\x01') == 10 + 257
+    assert v2_tag_size(b'ID3\x04\x00\x10\x00\x00\x00\x01') == 10 + 1 + 10  # with footer
+    assert v2_tag_size(b'ID3\x04\x00\x00\x80\x00\x00\x00') is None  # not synchsafe
+    assert v2_tag_size(b'\xff\xfb\x94\x64\x00\x00\x00\x00\x00\x00') is None
+    assert v2_tag_size(b'ID3') is None
+
+
+def test_v1_tag():
+    tag = build_v1_tag(AUDIO_INFO)
+    assert len(tag) == V1_SIZE
+    assert tag.startswith(b'TAGSong <<title>>')
+    assert tag[33:63].rstrip(b'\x00') == b"Ispolnitel'"
+    assert tag[-1] == 255
+
+
+@pytest.mark.parametrize('seed', [None] + list(range(10)))
+def test_tagger_replaces_old_tags(seed):
+    expected = build_v2_tag(AUDIO_INFO) + AUDIO + build_v1_tag(AUDIO_INFO)
+    assert tag_stream(build_v2_tag(OLD_INFO) + AUDIO + build_v1_tag(OLD_INFO), seed) == expected
+    assert tag_stream(AUDIO, seed) == expected
+
+
+def test_tagger_short_input():
+    assert tag_stream(b'abc') == build_v2_tag(AUDIO_INFO) + b'abc' + build_v1_tag(AUDIO_INFO)
+    assert tag_stream(b'') == build_v2_tag(AUDIO_INFO) + build_v1_tag(AUDIO_INFO)
+
+
+@pytest.mark.parametrize('data, v1_size', [
+    (build_v2_tag(OLD_INFO) + AUDIO + build_v1_tag(OLD_INFO), 0),
+    (AUDIO, V1_SIZE),
+])
+def test_tagger_min_size(data, v1_size):
+    tagger = Id3Tagger(AUDIO_INFO)
+    output = tagger.header()
+    assert tagger.min_size(len(data)) is None
+    output += tagger.feed(data[:100])
+    min_size = tagger.min_size(len(data))
+    output += tagger.feed(data[100:]) + tagger.finish()
+    # exact when old ID3v1 tag is replaced, new one is added otherwise
+    assert len(output) == min_size + v1_size
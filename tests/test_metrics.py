@@ -0,0 +1,80 @@
+import time
+
+from metrics import Counter, Histogram, merge_families, stats_families, worker_label
+from stats import SharedMetrics
+
+
+def sent_bytes(amount: int) -> Counter:
+    counter = Counter('test_sent_bytes_total', 'Sent bytes', ('source',))
+    counter.inc('cache', amount=amount)
+    return counter
+
+
+def test_histogram_lines():
+    histogram = Histogram('test_duration_seconds', 'Duration', ('phase',), buckets=(0.1, 1))
+    histogram.observe(0.05, 'send')
+    histogram.observe(0.5, 'send')
+    lines = merge_families([histogram.family(worker_label(1))])
+    assert lines == [
+        '# HELP thatmusic_test_duration_seconds Duration',
+        '# TYPE thatmusic_test_duration_seconds histogram',
+        'thatmusic_test_duration_seconds_bucket{phase="send",worker="1",le="0.1"} 1',
+        'thatmusic_test_duration_seconds_bucket{phase="send",worker="1",le="1"} 2',
+        'thatmusic_test_duration_seconds_bucket{phase="send",worker="1",le="+Inf"} 2',
+        'thatmusic_test_duration_seconds_sum{phase="send",worker="1"} 0.55',
+        'thatmusic_test_duration_seconds_count{phase="send",worker="1"} 2'
+    ]
+
+
+def test_stats_lines():
+    lines = merge_families(stats_families('disk_cache', {'ready': True, 'entries': 3, 'policy': 'lru'}))
+    assert lines == [
+        '# TYPE thatmusic_disk_cache_ready untyped',
+        'thatmusic_disk_cache_ready 1',
+        '# TYPE thatmusic_disk_cache_entries untyped',
+        'thatmusic_disk_cache_entries 3'
+    ]
+    lines = merge_families(stats_families('scheduler', {'active': 1, 'queued': {'stream': 1}}, worker_label(0)))
+    assert lines[-1] == 'thatmusic_scheduler_queued{name="stream",worker="0"} 1'
+
+
+def test_metrics_of_all_workers(tmp_path):
+    settings = {'publish_interval': 5}
+    workers = [
+        SharedMetrics(str(tmp_path), worker, lambda extra, amount=amount: [
+            sent_bytes(amount).family(extra), *stats_families('scheduler', {'active': amount}, extra)
+        ], settings)
+        for worker, amount in ((0, 10), (1, 20))
+    ]
+    try:
+        workers[1].publish()
+        lines = workers[0].render()
+    finally:
+        for worker in workers:
+            worker._db.close()
+
+    # samples of every metric go together after its header
+    assert lines == [
+        '# HELP thatmusic_test_sent_bytes_total Sent bytes',
+        '# TYPE thatmusic_test_sent_bytes_total counter',
+        'thatmusic_test_sent_bytes_total{source="cache",worker="0"} 10',
+        'thatmusic_test_sent_bytes_total{source="cache",worker="1"} 20',
+        '# TYPE thatmusic_scheduler_active untyped',
+        'thatmusic_scheduler_active{worker="0"} 10',
+        'thatmusic_scheduler_active{worker="1"} 20'
+    ]
+
+
+def test_metrics_of_stopped_worker_expire(tmp_path):
+    stopped = SharedMetrics(str(tmp_path), 1, lambda extra: [sent_bytes(20).family(extra)], {'publish_interval': -1})
+    running = SharedMetrics(str(tmp_path), 0, lambda extra: [sent_bytes(10).family(extra)], {'publish_interval': 5})
+    try:
+        stopped.publish()
+        time.sleep(0.01)
+        lines = running.render()
+    finally:
+        stopped._db.close()
+        running._db.close()
+    assert [line for line in lines if not line.startswith('#')] == [
+        'thatmusic_test_sent_bytes_total{source="cache",worker="0"} 10'
+    ]
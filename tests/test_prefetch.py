@@ -0,0 +1,178 @@
+import asyncio
+
+from conftest import run
+from prefetch import Prefetcher
+from records import AudioRecord
+from scheduler import PRIORITY_BACKGROUND
+from tokens import CAPTCHA_ERROR
+from vk import VkError
+
+SETTINGS = {
+    'queue_size': 2, 'workers': 1, 'interval': 0.01, 'backoff': 60, 'max_page': 2, 'hot_searches': 2,
+    'top_tracks': 2, 'max_transfers': 1, 'history_size': 100
+}
+
+
+class FakeSearcher:
+    def __init__(self, error=None):
+        self.pages = {}
+        self.fetched = []
+        self.busy = False
+        self.error = error
+
+    def is_busy(self):
+        return self.busy
+
+    def peek(self, query: str, page: int):
+        return self.pages.get((query, page))
+
+    async def fetch(self, query: str, page: int, background: bool = False):
+        assert background
+        self.fetched.append((query, page))
+        if self.error is not None:
+            raise self.error
+        self.pages[(query, page)] = []
+        return []
+
+
+class FakeTransfer:
+    finished = True
+    written = 0
+
+
+class FakeTransfers:
+    def __init__(self):
+        self.active = 0
+        self.started = []
+
+    @staticmethod
+    def get(audio_id: str):
+        return None
+
+    def start(self, audio_info: AudioRecord, priority: int):
+        self.started.append((audio_info.id, priority))
+        return FakeTransfer()
+
+
+class FakeStorage:
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+
+    @staticmethod
+    def key_for(audio_id: str):
+        return 'key' + audio_id
+
+    def path_for(self, key: str):
+        # this file stands for the downloaded ones
+        return __file__ if key in self.existing else '/nonexistent/{}.mp3'.format(key)
+
+
+async def wait_done(prefetcher: Prefetcher):
+    while prefetcher.stats()['queued']:
+        await asyncio.sleep(0.01)
+
+
+def prefetch(searcher: FakeSearcher, actions, transfers=None, storage=None):
+    """ Stats of prefetcher after `actions(prefetcher)` and all the jobs they scheduled """
+    async def main():
+        prefetcher = Prefetcher(searcher, transfers or FakeTransfers(), storage or FakeStorage(), SETTINGS)
+        await prefetcher.open()
+        try:
+            await actions(prefetcher)
+            await asyncio.wait_for(wait_done(prefetcher), 1)
+            return prefetcher.stats()
+        finally:
+            await prefetcher.close()
+
+    return run(main())
+
+
+def test_next_page_after_miss():
+    searcher = FakeSearcher()
+
+    async def actions(prefetcher):
+        prefetcher.searched('query', 0, hit=False)
+        prefetcher.searched('query', 1, hit=True)
+        await wait_done(prefetcher)
+        # prefetched page is requested by user
+        prefetcher.searched('query', 1, hit=True)
+        # pages after max_page and random artists are not prefetched
+        prefetcher.searched('query', 2, hit=False)
+        prefetcher.searched('', 0, hit=False)
+
+    stats = prefetch(searcher, actions)
+    assert searcher.fetched == [('query', 1)]
+    assert (stats['pages'], stats['page_hits'], stats['page_hit_rate']) == (1, 1, 1)
+
+
+def test_cached_page_is_not_fetched():
+    searcher = FakeSearcher()
+    searcher.pages[('query', 1)] = []
+
+    async def actions(prefetcher):
+        prefetcher.searched('query', 0, hit=False)
+
+    assert prefetch(searcher, actions)['pages'] == 0
+    assert searcher.fetched == []
+
+
+def test_waits_while_users_search():
+    searcher = FakeSearcher()
+    searcher.busy = True
+
+    async def actions(prefetcher):
+        prefetcher.searched('query', 0, hit=False)
+        await asyncio.sleep(0.05)
+        fetched = list(searcher.fetched)
+        searcher.busy = False
+        assert fetched == []
+
+    prefetch(searcher, actions)
+    assert searcher.fetched == [('query', 1)]
+
+
+def test_full_queue_drops_jobs():
+    searcher = FakeSearcher()
+    searcher.busy = True
+
+    async def actions(prefetcher):
+        prefetcher.searched('a', 0, hit=False)
+        # the first job is taken by the worker, the next ones fill the queue
+        await asyncio.sleep(0.02)
+        for query in ('b', 'c', 'd'):
+            prefetcher.searched(query, 0, hit=False)
+        searcher.busy = False
+
+    stats = prefetch(searcher, actions)
+    assert stats['dropped'] == 1
+    assert searcher.fetched == [('a', 1), ('b', 1), ('c', 1)]
+
+
+def test_pause_after_captcha():
+    searcher = FakeSearcher(VkError(CAPTCHA_ERROR, 'Captcha needed'))
+
+    async def actions(prefetcher):
+        prefetcher.searched('query', 0, hit=False)
+
+    stats = prefetch(searcher, actions)
+    assert (stats['errors'], stats['paused'], stats['pages']) == (1, True, 0)
+
+
+def test_top_tracks_of_hot_search():
+    searcher = FakeSearcher()
+    searcher.pages[('query', 0)] = [
+        AudioRecord(str(number), 'Artist', 'Title {}'.format(number), 60, '') for number in range(3)
+    ]
+    searcher.pages[('query', 1)] = []
+    transfers = FakeTransfers()
+
+    async def actions(prefetcher):
+        prefetcher.searched('query', 0, hit=True)
+        prefetcher.searched('query', 0, hit=True)
+        await wait_done(prefetcher)
+        prefetcher.downloaded('key1')
+
+    # the first track is downloaded already
+    stats = prefetch(searcher, actions, transfers, FakeStorage(['key0']))
+    assert transfers.started == [('1', PRIORITY_BACKGROUND)]
+    assert (stats['tracks'], stats['track_hits']) == (1, 1)
@@ -0,0 +1,58 @@
+import pytest
+
+from ranges import parse_range_header, format_content_range, build_multipart_ranges
+
+
+@pytest.mark.parametrize('value, size, expected', [
+    ('bytes=0-99', 1000, [(0, 100)]),
+    ('bytes=100-', 1000, [(100, 1000)]),
+    ('bytes=-100', 1000, [(900, 1000)]),
+    ('bytes=-2000', 1000, [(0, 1000)]),
+    ('bytes=900-2000', 1000, [(900, 1000)]),
+    ('bytes=0-9,5-19,30-39', 1000, [(0, 20), (30, 40)]),
+    ('bytes=30-39, 0-9', 1000, [(0, 10), (30, 40)]),
+    ('bytes=0-9,10-19', 1000, [(0, 20)]),
+    ('BYTES = 0-0', 1000, [(0, 1)]),
+])
+def test_parse_range_header(value, size, expected):
+    assert parse_range_header(value, size) == expected
+
+
+@pytest.mark.parametrize('value', [
+    'items=0-9',
+    'bytes=',
+    'bytes=abc',
+    'bytes=5',
+    'bytes=9-5',
+    'bytes=-',
+    'bytes=1-2-3',
+    'bytes=' + ','.join('{0}-{0}'.format(i * 10) for i in range(17)),
+])
+def test_parse_range_header_ignored(value):
+    assert parse_range_header(value, 1000) is None
+
+
+@pytest.mark.parametrize('value', ['bytes=1000-', 'bytes=2000-2999', 'bytes=-0'])
+def test_parse_range_header_unsatisfiable(value):
+    assert parse_range_header(value, 1000) == []
+
+
+def test_parse_range_header_unknown_size():
+    assert parse_range_header('bytes=0-9999999') == [(0, 10000000)]
+    assert parse_range_header('bytes=100-') is None
+    assert parse_range_header('bytes=-100') is None
+
+
+def test_format_content_range():
+    assert format_content_range((0, 100), 1000) == 'bytes 0-99/1000'
+    assert format_content_range((0, 100), None) == 'bytes 0-99/*'
+    assert format_content_range(None, 1000) == 'bytes */1000'
+
+
+def test_build_multipart_ranges():
+    parts, closing = build_multipart_ranges([(0, 10), (20, 30)], 100, 'audio/mpeg', 'b')
+    assert parts == [
+        (b'--b\r\nContent-Type: audio/mpeg\r\nContent-Range: bytes 0-9/100\r\n\r\n', (0, 10)),
+        (b'\r\n--b\r\nContent-Type: audio/mpeg\r\nContent-Range: bytes 20-29/100\r\n\r\n', (20, 30)),
+    ]
+    assert closing == b'\r\n--b--\r\n'
@@ -0,0 +1,32 @@
+import pytest
+
+from responses import ResponseCache, accepts_gzip
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('gzip', True),
+    ('gzip, deflate, br', True),
+    ('deflate, GZIP;q=0.5', True),
+    ('x-gzip', True),
+    ('*', True),
+    ('br;q=1.0, *;q=0.1', True),
+    ('', False),
+    ('identity', False),
+    ('gzip;q=0', False),
+    ('gzip; q=0.0, deflate', False),
+    ('identity, x-gzip-not', False),
+    ('*;q=0', False),
+    ('*, gzip;q=0', False),
+    ('gzip;q=abc', False),
+])
+def test_accepts_gzip(value, expected):
+    assert accepts_gzip(value) is expected
+
+
+def test_response_cache_gzip():
+    cache = ResponseCache({'max_entries': 10, 'max_bytes': 10 ** 6, 'expire': 60, 'gzip_min_size': 100, 'gzip_level': 6})
+    small = cache.put(('small', 'http', 'host'), b'{}')
+    large = cache.put(('large', 'http', 'host'), b'{"data": "' + b'x' * 1000 + b'"}')
+    assert small.gzip_body is None
+    assert large.gzip_body is not None and len(large.gzip_body) < len(large.body)
+    assert cache.get(('large', 'http', 'host')) is large
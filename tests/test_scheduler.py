@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from conftest import run
+from scheduler import DownloadScheduler, SchedulerFull, PRIORITY_STREAM, PRIORITY_DOWNLOAD, PRIORITY_BACKGROUND
+
+SETTINGS = {'max_active': 1, 'max_queue': 4, 'max_queue_per_client': 2, 'retry_after': 5}
+
+
+def granted_order(scheduler: DownloadScheduler, tickets):
+    """ Releases granted tickets one by one, returns tickets in the order they were granted """
+    order = []
+    pending = list(tickets)
+    while pending:
+        ticket = next(ticket for ticket in pending if ticket.granted)
+        pending.remove(ticket)
+        order.append(ticket)
+        scheduler.release(ticket)
+    return order
+
+
+def test_granted_immediately_while_not_busy():
+    async def main():
+        scheduler = DownloadScheduler(dict(SETTINGS, max_active=2))
+        first, second = scheduler.enqueue('a'), scheduler.enqueue('a')
+        await asyncio.wait_for(asyncio.gather(scheduler.wait(first), scheduler.wait(second)), 1)
+        return scheduler.stats()
+
+    stats = run(main())
+    assert (stats['active'], stats['queued'], stats['granted']) == (2, 0, 2)
+
+
+def test_clients_take_turns():
+    async def main():
+        scheduler = DownloadScheduler(dict(SETTINGS, max_queue=10, max_queue_per_client=3))
+        running = scheduler.enqueue('a')
+        tickets = [scheduler.enqueue(client) for client in ('a', 'a', 'a', 'b', 'c')]
+        scheduler.release(running)
+        return [ticket.client for ticket in granted_order(scheduler, tickets)]
+
+    assert run(main()) == ['a', 'b', 'c', 'a', 'a']
+
+
+def test_priority():
+    async def main():
+        scheduler = DownloadScheduler(SETTINGS)
+        running = scheduler.enqueue('a')
+        background = scheduler.enqueue('a', PRIORITY_BACKGROUND)
+        download = scheduler.enqueue('b', PRIORITY_DOWNLOAD)
+        stream = scheduler.enqueue('c', PRIORITY_STREAM)
+        scheduler.release(running)
+        return granted_order(scheduler, [background, download, stream]), [stream, download, background]
+
+    order, expected = run(main())
+    assert order == expected
+
+
+def test_promote():
+    async def main():
+        scheduler = DownloadScheduler(SETTINGS)
+        running = scheduler.enqueue('a')
+        download = scheduler.enqueue('b')
+        joined = scheduler.enqueue('c', PRIORITY_BACKGROUND)
+        # stream joins the background download
+        scheduler.promote(joined, PRIORITY_STREAM)
+        queued = scheduler.stats()['queued_by_priority']
+        scheduler.release(running)
+        return granted_order(scheduler, [download, joined]), [joined, download], queued
+
+    order, expected, queued = run(main())
+    assert order == expected
+    assert queued == {'stream': 1, 'download': 1, 'background': 0}
+
+
+def test_full_queue():
+    async def main():
+        scheduler = DownloadScheduler(SETTINGS)
+        scheduler.enqueue('a')
+        scheduler.enqueue('a')
+        scheduler.enqueue('a')
+        # one client can not take the whole queue
+        with pytest.raises(SchedulerFull) as per_client:
+            scheduler.enqueue('a')
+        scheduler.enqueue('b')
+        scheduler.enqueue('c')
+        with pytest.raises(SchedulerFull):
+            scheduler.enqueue('d')
+        return per_client.value.retry_after, scheduler.stats()
+
+    retry_after, stats = run(main())
+    assert retry_after == 5
+    assert (stats['queued'], stats['rejected']) == (4, 2)
+
+
+def test_released_while_waiting():
+    async def main():
+        scheduler = DownloadScheduler(SETTINGS)
+        running = scheduler.enqueue('a')
+        gone, waiting = scheduler.enqueue('b'), scheduler.enqueue('c')
+        scheduler.release(gone)
+        scheduler.release(running)
+        await asyncio.wait_for(scheduler.wait(waiting), 1)
+        return gone, waiting, scheduler.stats()
+
+    gone, waiting, stats = run(main())
+    assert not gone.granted and waiting.granted
+    assert (stats['active'], stats['queued']) == (1, 0)
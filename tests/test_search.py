@@ -0,0 +1,68 @@
+import json
+
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from conftest import FakeCache
+from responses import ResponseCache
+from search import SearchHandler, BatchSearchHandler
+from tokens import CAPTCHA_ERROR
+from vk import VkError
+
+CAPTCHA = {'captcha_sid': 123, 'captcha_img': 'https://vk.com/captcha.php?sid=123'}
+
+
+class CaptchaSearcher:
+    """ Every search needs captcha """
+
+    @staticmethod
+    def peek(query: str, page: int):
+        return None
+
+    get_cached = peek
+
+    async def fetch(self, query: str, page: int, **kwargs):
+        raise VkError(CAPTCHA_ERROR, 'Captcha needed', CAPTCHA)
+
+
+class BatchSearchValidationTest(AsyncHTTPTestCase):
+    def get_app(self):
+        # invalid batches are rejected before anything is searched
+        return Application([('/search/batch', BatchSearchHandler)], cache=FakeCache(), searcher=None)
+
+    def post(self, queries):
+        return self.fetch('/search/batch', method='POST', body=json.dumps({'queries': queries}))
+
+    def test_invalid_page(self):
+        for page in (True, False, -1, '1', 1.5, None):
+            response = self.post([{'q': 'query', 'page': page}])
+            self.assertEqual(response.code, 400, page)
+
+    def test_invalid_query(self):
+        self.assertEqual(self.post([{'q': 1}]).code, 400)
+        self.assertEqual(self.post('queries').code, 400)
+        self.assertEqual(self.fetch('/search/batch', method='POST', body='{').code, 400)
+
+
+class CaptchaTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application(
+            [('/search/', SearchHandler), ('/search/batch', BatchSearchHandler)],
+            cache=FakeCache(), searcher=CaptchaSearcher(), responses=ResponseCache(), prefetcher=None
+        )
+
+    def test_search(self):
+        response = self.fetch('/search/?q=query')
+        self.assertEqual(response.code, 400)
+        result = json.loads(response.body.decode())
+        self.assertEqual((result['error_code'], result['captcha_sid'], result['captcha_img']), (
+            400, CAPTCHA['captcha_sid'], CAPTCHA['captcha_img']
+        ))
+
+    def test_batch(self):
+        response = self.fetch('/search/batch', method='POST', body=json.dumps({'queries': [{'q': 'query'}]}))
+        self.assertEqual(response.code, 200)
+        result = json.loads(response.body.decode())['result']
+        self.assertEqual((result['error_code'], result['captcha_sid'], result['captcha_img']), (
+            400, CAPTCHA['captcha_sid'], CAPTCHA['captcha_img']
+        ))
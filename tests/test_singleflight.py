@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from conftest import run
+from singleflight import SingleFlight, ProcessLeases
+
+
+@pytest.fixture
+def leases(tmp_path):
+    """ Leases of two worker processes """
+    first, second = ProcessLeases(str(tmp_path), poll_interval=0.01), ProcessLeases(str(tmp_path), poll_interval=0.01)
+    second._owner = first._owner + 1
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_acquire(leases):
+    first, second = leases
+    assert first.acquire('key', 10)
+    assert first.is_held('key')
+    assert not second.acquire('key', 10)
+    first.release('key')
+    assert not first.is_held('key')
+    assert second.acquire('key', 10)
+
+
+def test_expired_lease(leases):
+    first, second = leases
+    assert first.acquire('key', -1)
+    assert not second.is_held('key')
+    assert second.acquire('key', 10)
+
+
+def test_wait_for_result(leases):
+    first, second = leases
+    results = {}
+
+    async def main():
+        assert first.acquire('key', 10)
+        waiting = asyncio.ensure_future(second.acquire_or_wait('key', 10, lambda: results.get('key')))
+        await asyncio.sleep(0.1)
+        results['key'] = 'done'
+        first.release('key')
+        return await waiting
+
+    assert run(main()) == 'done'
+    # every wait is counted once, not once per poll
+    assert second.stats() == {'acquired': 0, 'waited': 1}
+
+
+def test_acquire_after_holder_is_gone(leases):
+    first, second = leases
+
+    async def main():
+        assert first.acquire('key', 10)
+        waiting = asyncio.ensure_future(second.acquire_or_wait('key', 10, lambda: None))
+        await asyncio.sleep(0.1)
+        first.release('key')
+        return await waiting
+
+    assert run(main()) is None
+    assert second.is_held('key')
+    assert second.stats() == {'acquired': 1, 'waited': 1}
+
+
+def test_single_flight_shares_result():
+    calls = []
+
+    async def search():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do('query', search) for _ in range(3)))
+        in_flight = flight.in_flight('query')
+        # next call after the result is ready starts a new operation
+        await flight.do('query', search)
+        return results, in_flight, flight.stats()
+
+    results, in_flight, stats = run(main())
+    assert results == ['result'] * 3
+    assert not in_flight
+    assert len(calls) == 2
+    assert stats == {'in_flight': 0, 'leaders': 2, 'followers': 2}
+
+
+def test_single_flight_shares_exception():
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError('upstream failed')
+
+    async def main():
+        flight = SingleFlight()
+        return await asyncio.gather(*(flight.do('query', failing) for _ in range(2)), return_exceptions=True)
+
+    first, second = run(main())
+    assert isinstance(first, ValueError) and first is second
+
+
+def test_single_flight_survives_cancelled_caller():
+    async def search():
+        await asyncio.sleep(0.02)
+        return 'result'
+
+    async def main():
+        flight = SingleFlight()
+        leader = asyncio.ensure_future(flight.do('query', search))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do('query', search))
+        await asyncio.sleep(0)
+        # client of the first request went away
+        leader.cancel()
+        return await follower, flight.stats()
+
+    result, stats = run(main())
+    assert result == 'result'
+    assert (stats['leaders'], stats['followers']) == (1, 1)
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import run
+from snapshot import Snapshots, write_snapshot, read_snapshot
+
+SETTINGS = {'enabled': True, 'interval': 60, 'batch_size': 2, 'compression': 1}
+
+
+class Source:
+    def __init__(self, records=None):
+        self.records = list(records or [])
+
+    def snapshot(self):
+        return list(self.records)
+
+    def restore(self, records):
+        self.records.extend(records)
+
+
+def records(count: int, expires=None):
+    return [('key{}'.format(number), expires, {'value': number}) for number in range(count)]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'test.snapshot')
+    expired = ('expired', time.time() - 1, None)
+    write_snapshot(path, records(5) + [expired] + records(1, time.time() + 60))
+    batches = list(read_snapshot(path, 2))
+    assert [len(batch) for batch in batches] == [2, 2, 2]
+    assert [record[0] for batch in batches for record in batch] == ['key0', 'key1', 'key2', 'key3', 'key4', 'key0']
+
+
+def test_truncated(tmp_path):
+    path = str(tmp_path / 'test.snapshot')
+    size = write_snapshot(path, records(100))
+    with open(path, 'r+b') as f:
+        f.truncate(size - 10)
+    with pytest.raises(EOFError):
+        for _ in read_snapshot(path, 1000):
+            pass
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / 'test.snapshot'
+    path.write_bytes(b'something else')
+    with pytest.raises(ValueError):
+        list(read_snapshot(str(path), 10))
+
+
+def test_save_and_load(tmp_path):
+    async def main():
+        saved = Snapshots(str(tmp_path), SETTINGS)
+        saved.add('source', Source(records(3)))
+        await saved.open()
+        # source without snapshot file is loaded at once, then it can be saved
+        await asyncio.sleep(0)
+        await saved.close()
+
+        source = Source()
+        loaded = Snapshots(str(tmp_path), SETTINGS)
+        loaded.add('source', source)
+        await loaded._load('source', source)
+        return source.records, loaded.stats()
+
+    restored, stats = run(main())
+    assert restored == records(3)
+    assert (stats['restored'], stats['errors']) == (3, 0)
+
+
+def test_load_keeps_records_before_damaged_part(tmp_path):
+    path = str(tmp_path / 'source.snapshot')
+    # not compressed, so half of the file is about half of the records
+    size = write_snapshot(path, [(str(number), None, bytes(64 * 1024)) for number in range(64)], level=0)
+    with open(path, 'r+b') as f:
+        f.truncate(size // 2)
+
+    async def main():
+        source = Source()
+        snapshots = Snapshots(str(tmp_path), SETTINGS)
+        snapshots.add('source', source)
+        await snapshots._load('source', source)
+        return source.records, snapshots.stats()
+
+    restored, stats = run(main())
+    assert 0 < len(restored) < 64
+    assert [record[0] for record in restored] == [str(number) for number in range(len(restored))]
+    assert (stats['restored'], stats['errors']) == (len(restored), 1)
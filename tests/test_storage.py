@@ -0,0 +1,54 @@
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from conftest import run
+from storage import S3Storage
+
+
+SETTINGS = {
+    'endpoint_url': 'http://127.0.0.1:1', 'region': 'us-east-1', 'access_key': 'key', 'secret_key': 'secret',
+    'bucket': 'bucket', 'prefix': 'audio/', 'url_ttl': 60, 'threads': 1
+}
+
+
+class FailingClient:
+    def __init__(self, error: Exception):
+        self._error = error
+
+    def head_object(self, **kwargs):
+        raise self._error
+
+    def upload_file(self, *args, **kwargs):
+        raise self._error
+
+
+@pytest.fixture
+def storage():
+    return S3Storage(SETTINGS)
+
+
+@pytest.mark.parametrize('error, errors', [
+    (ClientError({'Error': {'Code': '404'}}, 'HeadObject'), 0),
+    (ClientError({'Error': {'Code': '403'}}, 'HeadObject'), 1),
+    (EndpointConnectionError(endpoint_url='http://127.0.0.1:1'), 1),
+])
+def test_get_url_errors(storage, error, errors):
+    storage._client = FailingClient(error)
+    assert run(storage.get_url('abcd')) is None
+    assert storage.stats() == {'hits': 0, 'misses': 1, 'uploads': 0, 'errors': errors}
+
+
+@pytest.mark.parametrize('error', [
+    EndpointConnectionError(endpoint_url='http://127.0.0.1:1'),
+    S3UploadFailedError('Failed to upload'),
+    ClientError({'Error': {'Code': '500'}}, 'PutObject'),
+    IOError('No such file'),
+])
+def test_upload_errors(storage, error):
+    storage._client = FailingClient(error)
+    run(storage.upload('abcd', '/nonexistent.mp3'))
+    assert storage.stats()['errors'] == 1
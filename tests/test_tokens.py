@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+from conftest import run
+from tokens import TokenPool, SharedTokenState, CAPTCHA_ERROR, FLOOD_ERROR, RATE_ERROR
+
+SETTINGS = {'rate': 1, 'burst': 2, 'captcha_cooldown': 300, 'flood_cooldown': 3600, 'rate_cooldown': 1}
+
+
+def test_least_loaded_token_is_used():
+    pool = TokenPool(['a', 'b'], SETTINGS)
+
+    async def main():
+        first = await pool.acquire()
+        second = await pool.acquire()
+        pool.release(first)
+        third = await pool.acquire()
+        return first.value, second.value, third.value
+
+    first, second, third = run(main())
+    assert first != second
+    # released token is idle again
+    assert third == first
+
+
+def test_rate_limit():
+    pool = TokenPool(['a'], SETTINGS)
+
+    async def main():
+        for _ in range(SETTINGS['burst']):
+            pool.release(await pool.acquire())
+        spare = pool.has_spare()
+        started = time.monotonic()
+        token = await asyncio.wait_for(pool.acquire(), 5)
+        return spare, time.monotonic() - started, token.stats()['requests']
+
+    spare, waited, requests = run(main())
+    assert not spare
+    assert waited >= 0.5
+    assert requests == 3
+
+
+def test_cooldown():
+    pool = TokenPool(['a', 'b'], SETTINGS)
+
+    async def main():
+        flooded = await pool.acquire()
+        pool.release(flooded, FLOOD_ERROR)
+        used = {(await pool.acquire()).value for _ in range(2)}
+        return flooded.value, used
+
+    flooded, used = run(main())
+    assert flooded not in used
+    assert pool.stats()[str(['a', 'b'].index(flooded))]['flood_errors'] == 1
+
+
+def test_all_tokens_cool_down():
+    pool = TokenPool(['a', 'b'], SETTINGS)
+
+    async def main():
+        first, second = await pool.acquire(), await pool.acquire()
+        pool.release(first, FLOOD_ERROR)
+        pool.release(second, RATE_ERROR)
+        healthy = pool.has_healthy()
+        # the one which recovers first is still used
+        return healthy, second.value, (await pool.acquire()).value
+
+    healthy, recovers_first, used = run(main())
+    assert not healthy
+    assert used == recovers_first
+
+
+def test_captcha_is_answered_with_its_token():
+    pool = TokenPool(['a', 'b', 'c'], SETTINGS)
+
+    async def main():
+        token = await pool.acquire()
+        pool.release(token, CAPTCHA_ERROR, captcha_sid=42)
+        answered = await pool.acquire(captcha_sid=42)
+        pool.release(answered)
+        pool.solved(answered)
+        # captcha id is used once, then any token is used
+        return token, answered, await pool.acquire(captcha_sid=42)
+
+    token, answered, unknown = run(main())
+    assert answered is token
+    assert token.healthy and token.captchas == 1
+    assert unknown is not None
+
+
+def shared_pools(tmp_path, tokens, count=2):
+    """ Pools of worker processes, each with its own connection to the shared database """
+    states = [SharedTokenState(str(tmp_path)) for _ in range(count)]
+    return [TokenPool(tokens, SETTINGS, state) for state in states], states
+
+
+def test_shared_rate_limit(tmp_path):
+    (first, second), states = shared_pools(tmp_path, ['a'])
+
+    async def main():
+        await first.acquire()
+        await second.acquire()
+        started = time.monotonic()
+        # burst is used by both processes together
+        await asyncio.wait_for(first.acquire(), 5)
+        return time.monotonic() - started
+
+    try:
+        assert run(main()) >= 0.5
+    finally:
+        for state in states:
+            state.close()
+
+
+def test_shared_cooldown(tmp_path):
+    (first, second), states = shared_pools(tmp_path, ['a', 'b'])
+
+    async def main():
+        token = await first.acquire()
+        first.release(token, FLOOD_ERROR)
+        return token.value, [(await second.acquire()).value for _ in range(2)]
+
+    try:
+        flooded, used = run(main())
+        assert flooded not in used
+        assert second.stats()[str(['a', 'b'].index(flooded))]['cooldown'] > 0
+    finally:
+        for state in states:
+            state.close()
+
+
+def test_shared_captcha_is_answered_with_its_token(tmp_path):
+    (first, second), states = shared_pools(tmp_path, ['a', 'b', 'c'])
+
+    async def main():
+        token = await first.acquire()
+        first.release(token, CAPTCHA_ERROR, captcha_sid=42)
+        # the answer comes to other process
+        return token.value, (await second.acquire(captcha_sid=42)).value
+
+    try:
+        got, answered = run(main())
+        assert got == answered
+        assert states[0].pop_captcha('42') is None
+    finally:
+        for state in states:
+            state.close()
@@ -0,0 +1,89 @@
+import asyncio
+import os
+
+import pytest
+
+from conftest import run
+from records import AudioRecord
+from singleflight import ProcessLeases
+from transfer import Transfer, TransferManager
+
+
+DATA = bytes(range(256)) * 400
+
+
+@pytest.fixture
+def leases(tmp_path):
+    """ Leases of this worker process and of the other one, which downloads the file """
+    ours, other = ProcessLeases(str(tmp_path), poll_interval=0.01), ProcessLeases(str(tmp_path), poll_interval=0.01)
+    other._owner = ours._owner + 1
+    yield ours, other
+    ours.close()
+    other.close()
+
+
+def make_transfer(tmp_path, name: str) -> Transfer:
+    path = str(tmp_path / 'song.mp3')
+    temp_path = str(tmp_path / name)
+    open(temp_path, 'wb').close()
+    return Transfer(AudioRecord('1', 'Artist', 'Title', 60, ''), 'key', path, temp_path)
+
+
+async def download_in_other_process(other: ProcessLeases, transfer: Transfer, success: bool = True):
+    """ Writes the file like TransferManager of other worker process """
+    assert other.acquire('audio:key', 10, transfer.temp_path)
+    with open(transfer.temp_path, 'wb', buffering=0) as f:
+        for start in range(0, len(DATA), 10000):
+            await asyncio.sleep(0.01)
+            f.write(DATA[start:start + 10000])
+            if not success and start >= len(DATA) // 2:
+                break
+    if success:
+        os.replace(transfer.temp_path, transfer.path)
+    else:
+        os.remove(transfer.temp_path)
+    other.release('audio:key')
+
+
+def test_follow_download_of_other_process(tmp_path, leases):
+    ours, other = leases
+    transfer = make_transfer(tmp_path, 'ours.part')
+    other_transfer = make_transfer(tmp_path, 'other.part')
+    manager = TransferManager(None, None, None, leases=ours, chunk_size=4096)
+
+    async def main():
+        downloading = asyncio.ensure_future(download_in_other_process(other, other_transfer))
+        await asyncio.sleep(0.005)
+        following = asyncio.ensure_future(manager._download(transfer))
+        # data is available while the other process is still downloading
+        with transfer.open() as reader:
+            first = await reader.read(0, 100)
+            assert not downloading.done()
+            await downloading
+            success = await following
+            transfer._finish(success)
+            return success, first + await reader.read(100, len(DATA))
+
+    success, data = run(main())
+    assert success
+    assert data == DATA
+    assert transfer.written == len(DATA)
+    assert ours.stats() == {'acquired': 0, 'waited': 1}
+
+
+def test_follow_failed_download(tmp_path, leases):
+    ours, other = leases
+    transfer = make_transfer(tmp_path, 'ours.part')
+    other_transfer = make_transfer(tmp_path, 'other.part')
+    manager = TransferManager(None, None, None, leases=ours)
+
+    async def main():
+        downloading = asyncio.ensure_future(download_in_other_process(other, other_transfer, success=False))
+        await asyncio.sleep(0.005)
+        success = await manager._download(transfer)
+        await downloading
+        return success
+
+    assert not run(main())
+    assert 0 < transfer.written < len(DATA)
+    assert manager.stats()['failed'] == 1
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from conftest import run
+from vk import AudioRefresher, VkError
+
+SETTINGS = {'batch_size': 100, 'batch_delay': 0.01}
+
+
+def item(audio_id: int, **fields):
+    result = {'owner_id': 1, 'id': audio_id, 'artist': 'Artist', 'title': 'Title', 'duration': 60,
+              'url': 'https://cdn/{}.mp3'.format(audio_id)}
+    result.update(fields)
+    return result
+
+
+class FakeApi:
+    def __init__(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.calls = []
+
+    async def call(self, method: str, params):
+        self.calls.append((method, params))
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+def refresh(api: FakeApi, *vk_ids: str):
+    async def main():
+        refresher = AudioRefresher(api, SETTINGS)
+        results = await asyncio.wait_for(
+            asyncio.gather(*(refresher.get(vk_id) for vk_id in vk_ids), return_exceptions=True), 1
+        )
+        return results, refresher.stats()
+
+    return run(main())
+
+
+def test_batch_in_one_call():
+    api = FakeApi([item(1), item(2)])
+    (first, second, missing), stats = refresh(api, '1_1_key', '1_2', '1_3')
+    assert [first.vk_id, second.vk_id, missing] == ['1_1', '1_2', None]
+    assert api.calls == [('audio.getById', {'audios': '1_1_key,1_2,1_3'})]
+    assert (stats['refreshed'], stats['missing'], stats['pending']) == (2, 1, 0)
+
+
+def test_api_error_fails_all_requests():
+    api = FakeApi(error=VkError(6, 'Too many requests'))
+    results, stats = refresh(api, '1_1', '1_2')
+    assert all(isinstance(result, VkError) for result in results)
+    assert stats['errors'] == 1
+
+
+def test_broken_response_fails_all_requests():
+    broken = item(2)
+    del broken['artist']
+    results, stats = refresh(FakeApi([item(1), broken]), '1_1', '1_2')
+    # requests must not hang on unexpected errors
+    assert all(isinstance(result, KeyError) for result in results)
+    assert stats['errors'] == 1
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_full_batch_is_sent_at_once(batch_size):
+    api = FakeApi([item(1), item(2)])
+
+    async def main():
+        refresher = AudioRefresher(api, {'batch_size': batch_size, 'batch_delay': 60})
+        return await asyncio.wait_for(asyncio.gather(refresher.get('1_1'), refresher.get('1_2')), 1)
+
+    assert [record.vk_id for record in run(main())] == ['1_1', '1_2']
+    assert len(api.calls) == 2 // batch_size